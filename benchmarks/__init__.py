@@ -0,0 +1,14 @@
+"""
+benchmarks for django-iapauth.
+
+these are not run as part of the test suite. Run them all with:
+
+    $ python runtests.py bench
+
+or one directly, e.g.:
+
+    $ PYTHONPATH=src python -m benchmarks.authenticators
+
+`python runtests.py stress` fires concurrent requests at a cold worker
+to count the upstream fetches they cause; see benchmarks.stress.
+"""
@@ -0,0 +1,70 @@
+"""
+compare the jose based JWTAuthenticator with the direct ES256Authenticator.
+
+both are run with the verified token cache turned off, so every call
+does a full verification of a real ES256 token signed with a locally
+generated key.
+"""
+import sys
+import timeit
+from unittest import mock
+
+
+def configure():
+    import django
+    from django.conf import settings
+
+    if not settings.configured:
+        settings.configure(
+            INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes"],
+        )
+        django.setup()
+
+
+def run(iterations: int = 2000, repeat: int = 5):
+    from django.test import override_settings
+
+    from iapauth import middleware
+    from iapauth.keys import KeyStore
+    from iapauth.middleware import ES256Authenticator, JWTAuthenticator
+    from tests.utils import AUDIENCE, make_key, make_token
+
+    private_pem, public_pem = make_key()
+    token = make_token(private_pem, "k1")
+    store = KeyStore(fetch=lambda: {"k1": public_pem})
+
+    results = {}
+    with mock.patch.object(middleware, "KEY_STORE", store), mock.patch.object(
+        middleware, "TOKEN_CACHE", None
+    ), override_settings(IAPAUTH_TOKEN_CACHE_SIZE=0):
+        for authenticator in (JWTAuthenticator(), ES256Authenticator()):
+            name = type(authenticator).__name__
+            # sanity check before timing anything
+            assert authenticator.authenticate(token, AUDIENCE)[0], name
+            best = min(
+                timeit.repeat(
+                    lambda: authenticator.authenticate(token, AUDIENCE),
+                    number=iterations,
+                    repeat=repeat,
+                )
+            )
+            results[name] = best / iterations
+    return results
+
+
+def main():
+    configure()
+    results = run()
+    print("full verification, token cache off")
+    baseline = results["JWTAuthenticator"]
+    for name, seconds in results.items():
+        print(
+            "{:<20} {:>8.1f} us/token  {:>5.2f}x".format(
+                name, seconds * 1e6, baseline / seconds
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
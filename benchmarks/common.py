@@ -0,0 +1,125 @@
+"""
+timing and allocation helpers shared by the benchmarks.
+"""
+import gc
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple, Union
+
+
+class Result(NamedTuple):
+    name: str
+    samples: List[int]  # nanoseconds per call
+    alloc_peak: Union[int, None] = None  # bytes per call
+    alloc_retained: Union[int, None] = None  # bytes per call
+    queries: Union[float, None] = None  # database queries per call
+
+    def percentile(self, p: float) -> float:
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    @property
+    def mean(self) -> float:
+        return sum(self.samples) / len(self.samples)
+
+    @property
+    def throughput(self) -> float:
+        """calls per second, one thread"""
+        return 1e9 / self.mean
+
+
+def _noop():
+    return None
+
+
+def measure(
+    name: str,
+    func: Callable[[Any], Any],
+    setup: Callable[[], Any] = _noop,
+    iterations: int = 1000,
+    warmup: int = 50,
+    allocations: bool = True,
+) -> Result:
+    """time `func(setup())`. Only `func` is timed, `setup` is not.
+
+    allocations are measured in a separate pass with tracemalloc, since
+    tracing slows everything down.
+    """
+    for i in range(warmup):
+        func(setup())
+    gc.collect()
+    samples = []
+    clock = time.perf_counter_ns
+    for i in range(iterations):
+        arg = setup()
+        start = clock()
+        func(arg)
+        samples.append(clock() - start)
+    peak = retained = None
+    if allocations:
+        peak, retained = _allocations(func, setup, max(1, iterations // 10))
+    return Result(name, samples, peak, retained)
+
+
+def _allocations(func, setup, iterations):
+    args = [setup() for i in range(iterations)]
+    peak = 0
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for arg in args:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            func(arg)
+            peak += tracemalloc.get_traced_memory()[1] - start
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return peak // iterations, retained // iterations
+
+
+COLUMNS = "{:<28} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10} {:>10} {:>8}"
+ROW = "{:<28} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.0f} {:>10} {:>10} {:>8}"
+
+
+def report(results: List[Result], title: str = ""):
+    if title:
+        print(title)
+    header = COLUMNS.format(
+        "scenario",
+        "p50 us",
+        "p90 us",
+        "p99 us",
+        "max us",
+        "req/s",
+        "peak B",
+        "kept B",
+        "queries",
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            ROW.format(
+                r.name,
+                r.percentile(50) / 1e3,
+                r.percentile(90) / 1e3,
+                r.percentile(99) / 1e3,
+                max(r.samples) / 1e3,
+                r.throughput,
+                "-" if r.alloc_peak is None else r.alloc_peak,
+                "-" if r.alloc_retained is None else r.alloc_retained,
+                "-" if r.queries is None else "{:g}".format(r.queries),
+            )
+        )
+    print()
+
+
+def summary(result: Result) -> Dict[str, float]:
+    return {
+        "p50_us": result.percentile(50) / 1e3,
+        "p99_us": result.percentile(99) / 1e3,
+        "req_per_s": result.throughput,
+    }
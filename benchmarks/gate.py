@@ -0,0 +1,86 @@
+"""
+cost of turning away a request without a valid assertion, through the
+whole Django stack (session, CSRF and auth middleware, then
+IAPJWTAuthMiddleware and a `login_required` view) and through
+iapauth.gate.WSGIGate in front of it.
+
+needs the test suite's settings: run it with `python runtests.py bench`.
+"""
+import sys
+import timeit
+from typing import Dict
+from unittest import mock
+from wsgiref.util import setup_testing_defaults
+
+
+CASES = ("no assertion", "malformed", "bad signature")
+
+
+def environ(token=None) -> dict:
+    env = {"PATH_INFO": "/protected", "HTTP_HOST": "testserver"}
+    if token is not None:
+        env["HTTP_X_GOOG_IAP_JWT_ASSERTION"] = token
+    setup_testing_defaults(env)
+    return env
+
+
+def run(iterations: int = 2000, repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test import override_settings
+
+    from iapauth import middleware
+    from iapauth.gate import WSGIGate
+    from iapauth.keys import KeyStore
+    from tests.utils import AUDIENCE, make_key, make_token
+
+    private_pem, public_pem = make_key()
+    other_pem = make_key()[0]
+    store = KeyStore(fetch=lambda: {"k1": public_pem})
+    tokens = (None, "totally.not.legit", make_token(other_pem, "k1"))
+
+    handler = WSGIHandler()
+    applications = (("django", handler), ("gate", WSGIGate(handler)))
+    results: Dict[str, Dict[str, float]] = {}
+    with mock.patch.object(middleware, "KEY_STORE", store), override_settings(
+        JWT_AUDIENCE=AUDIENCE, ALLOWED_HOSTS=["testserver"]
+    ):
+        for case, token in zip(CASES, tokens):
+            template = environ(token)
+            row = results[case] = {}
+            for name, application in applications:
+                statuses = []
+
+                def start_response(status, headers):
+                    statuses[:] = [status]
+
+                def request():
+                    response = application(dict(template), start_response)
+                    if hasattr(response, "close"):
+                        response.close()
+
+                request()
+                # Django redirects to the login page, the gate refuses
+                assert statuses[0][:3] in ("302", "401", "403"), statuses
+                best = min(timeit.repeat(request, number=iterations, repeat=repeat))
+                row[name] = best / iterations
+    return results
+
+
+def main():
+    results = run()
+    print("rejected requests, WSGI")
+    print("{:<15} {:>10} {:>10} {:>8}".format("", "django us", "gate us", "speedup"))
+    for case, row in results.items():
+        print(
+            "{:<15} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+                case,
+                row["django"] * 1e6,
+                row["gate"] * 1e6,
+                row["django"] / row["gate"],
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+per-request cost of IAPJWTAuthMiddleware.process_request.
+
+real ES256 tokens are signed with a locally generated key, and the key
+set is served by the stand-in server from the test suite, so the full
+verification path runs without the network. Each scenario builds its
+request (session and AuthenticationMiddleware included) untimed, then
+times only `process_request`. The database queries made by resolving
+`request.user` and by `process_request` are counted per scenario.
+"""
+import argparse
+import itertools
+import os
+import sys
+from typing import List
+from unittest import mock
+
+
+AUDIENCE = "/projects/1234/apps/bench"
+STATELESS_PATH = "/api/"
+
+AUTHENTICATORS = {
+    "jose": "iapauth.middleware.JWTAuthenticator",
+    "es256": "iapauth.middleware.ES256Authenticator",
+}
+
+
+class Scenarios(object):
+    def __init__(self, private_pem: str):
+        from django.contrib.auth.middleware import AuthenticationMiddleware
+        from django.contrib.sessions.middleware import SessionMiddleware
+        from django.test import RequestFactory
+
+        from iapauth.middleware import IAPJWTAuthMiddleware
+        from tests.utils import make_token
+
+        self.private_pem = private_pem
+        self.make_token = make_token
+        self.factory = RequestFactory()
+        self.session_middleware = SessionMiddleware(lambda r: None)
+        self.auth_middleware = AuthenticationMiddleware(lambda r: None)
+        self.middleware = IAPJWTAuthMiddleware(lambda r: None)
+        self.counter = itertools.count()
+
+    def token(self, email: str) -> str:
+        return self.make_token(self.private_pem, "k1", email=email, audience=AUDIENCE)
+
+    def request(self, token=None, session_key=None, path="/"):
+        headers = {}
+        if token is not None:
+            headers["HTTP_X_GOOG_IAP_JWT_ASSERTION"] = token
+        request = self.factory.get(path, **headers)
+        if session_key is not None:
+            from django.conf import settings
+
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+        self.session_middleware.process_request(request)
+        self.auth_middleware.process_request(request)
+        return request
+
+    def logged_in_session(self, email: str) -> str:
+        """a saved session, logged in as `email` through the middleware"""
+        request = self.request(self.token(email))
+        self.middleware.process_request(request)
+        request.session.save()
+        return request.session.session_key
+
+    def process(self, request):
+        self.middleware.process_request(request)
+
+    def no_header(self):
+        return self.request()
+
+    def bad_token(self):
+        return self.request("totally.not.legit")
+
+    def already_authenticated(self):
+        if not hasattr(self, "_session_key"):
+            self._token = self.token("steady@example.com")
+            self._session_key = self.logged_in_session("steady@example.com")
+        return self.request(self._token, self._session_key)
+
+    def first_login(self):
+        email = "new{}@example.com".format(next(self.counter))
+        return self.request(self.token(email))
+
+    def stateless(self):
+        if not hasattr(self, "_stateless_token"):
+            self._stateless_token = self.token("api@example.com")
+        return self.request(self._stateless_token, path=STATELESS_PATH)
+
+    def user_switch(self):
+        if not hasattr(self, "_switch_token"):
+            self._switch_token = self.token("switched@example.com")
+        session_key = self.logged_in_session("original@example.com")
+        return self.request(self._switch_token, session_key)
+
+
+def count_queries(func, setup, iterations: int = 10) -> float:
+    """average number of database queries made by `func(setup())`"""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    total = 0
+    for i in range(iterations):
+        arg = setup()
+        with CaptureQueriesContext(connection) as queries:
+            func(arg)
+        total += len(queries)
+    return total / iterations
+
+
+def run(
+    iterations: int = 1000,
+    authenticator: str = "jose",
+    allocations=True,
+    user_cache: int = 0,
+    metrics: bool = False,
+):
+    from django.test import override_settings
+    from django.utils.module_loading import import_string
+
+    from iapauth import middleware
+    from tests.server import StubServer
+    from tests.utils import make_key
+
+    from .common import measure
+
+    private_pem, public_pem = make_key()
+    results = []
+    with StubServer({"k1": public_pem}) as server, mock.patch.object(
+        middleware, "KEY_STORE", None
+    ), mock.patch.object(middleware, "TOKEN_CACHE", None), override_settings(
+        JWT_AUDIENCE=AUDIENCE,
+        IAPAUTH_PUBLIC_KEY_URL=server.key_url,
+        IAPAUTH_JWT_AUTHENTICATOR=import_string(AUTHENTICATORS[authenticator])(),
+        IAPAUTH_USER_CACHE_SIZE=user_cache,
+        IAPAUTH_STATELESS_PATHS=[STATELESS_PATH],
+        IAPAUTH_METRICS=metrics,
+    ):
+        scenarios = Scenarios(private_pem)
+        for name in (
+            "no_header",
+            "bad_token",
+            "already_authenticated",
+            "first_login",
+            "user_switch",
+            "stateless",
+        ):
+            setup = getattr(scenarios, name)
+            result = measure(
+                name,
+                scenarios.process,
+                setup,
+                iterations=iterations,
+                allocations=allocations,
+            )
+            queries = count_queries(scenarios.process, setup)
+            results.append(result._replace(queries=queries))
+        assert server.key_hits() == 1, server.hits
+    return results
+
+
+def main(argv: List[str] = None):
+    from .common import report
+
+    parser = argparse.ArgumentParser(prog="middleware benchmark")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument(
+        "--authenticator", choices=sorted(AUTHENTICATORS), default="jose"
+    )
+    parser.add_argument("--no-allocations", action="store_true")
+    parser.add_argument(
+        "--user-cache",
+        type=int,
+        default=0,
+        metavar="SIZE",
+        help="IAPAUTH_USER_CACHE_SIZE (default 0, off)",
+    )
+    parser.add_argument(
+        "--metrics", action="store_true", help="turn on IAPAUTH_METRICS"
+    )
+    args = parser.parse_args(argv)
+    results = run(
+        args.iterations,
+        args.authenticator,
+        not args.no_allocations,
+        args.user_cache,
+        args.metrics,
+    )
+    report(
+        results,
+        "IAPJWTAuthMiddleware.process_request ({}, pid {})".format(
+            args.authenticator, os.getpid()
+        ),
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+cost of the compiled path matcher as the number of patterns grows.
+
+each pattern set is half prefixes and half regexes. PathMatcher is
+compared with the obvious loop over every pattern, for a path that
+matches nothing (the common case: an ordinary page) and one that matches
+the last pattern added.
+"""
+import re
+import sys
+import timeit
+from typing import Callable, Dict, List, Tuple
+
+from .authenticators import configure
+
+
+SIZES = (1, 10, 100, 1000)
+MISS = "/app/dashboard/reports/2021"
+
+
+def patterns(n: int) -> List[str]:
+    result = []
+    for i in range(n):
+        if i % 2:
+            result.append(r"^/svc{}/v\d+/status$".format(i))
+        else:
+            result.append("/probe{}/".format(i))
+    return result
+
+
+def hit(n: int) -> str:
+    i = n - 1
+    return "/svc{}/v2/status".format(i) if i % 2 else "/probe{}/ready".format(i)
+
+
+def naive(pats: List[str]):
+    prefixes = tuple(p for p in pats if not p.startswith("^"))
+    regexes = [re.compile(p) for p in pats if p.startswith("^")]
+
+    def match(path: str) -> bool:
+        return path.startswith(prefixes) or any(r.match(path) for r in regexes)
+
+    return match
+
+
+def run(iterations: int = 20000, repeat: int = 5) -> Dict[int, Dict[str, float]]:
+    from iapauth.paths import PathMatcher
+
+    results = {}
+    for n in SIZES:
+        pats = patterns(n)
+        matchers: List[Tuple[str, Callable[[str], bool]]] = [
+            ("PathMatcher", PathMatcher(pats).match),
+            ("loop", naive(pats)),
+        ]
+        row = {}
+        for name, match in matchers:
+            for label, path, expected in (("miss", MISS, False), ("hit", hit(n), True)):
+                assert match(path) is expected, (name, n, path)
+                best = min(
+                    timeit.repeat(lambda: match(path), number=iterations, repeat=repeat)
+                )
+                row["{} {}".format(name, label)] = best / iterations
+        results[n] = row
+    return results
+
+
+def main():
+    configure()
+    results = run()
+    columns = list(results[SIZES[0]])
+    print("path matching, ns per path")
+    print("{:>9} ".format("patterns") + " ".join("{:>17}".format(c) for c in columns))
+    for n, row in results.items():
+        print(
+            "{:>9} ".format(n)
+            + " ".join("{:>17.0f}".format(row[c] * 1e9) for c in columns)
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
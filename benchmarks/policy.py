@@ -0,0 +1,106 @@
+"""
+cost of deciding a user's role as the role policy grows.
+
+each policy is a third domain rules, a third email rules and a third
+email patterns. The compiled Policy (without its decision cache, and
+with it) is compared with checking every rule in turn, for an email no
+rule matches and for one matched by the last email rule.
+"""
+import re
+import sys
+import timeit
+from typing import Any, Callable, Dict, List, Mapping, Tuple, Union
+
+from .authenticators import configure
+
+
+SIZES = (10, 100, 1000, 5000)
+MISS = "someone@elsewhere.org"
+
+
+def rules(n: int) -> List[Dict[str, Any]]:
+    result: List[Dict[str, Any]] = []
+    for i in range(n):
+        if i % 3 == 0:
+            result.append({"domain": "team{}.example.com".format(i), "is_staff": True})
+        elif i % 3 == 1:
+            result.append({"email": "user{}@example.com".format(i), "is_staff": True})
+        else:
+            pattern = r"svc{}-.*@example\.com".format(i)
+            result.append({"pattern": pattern, "groups": ["svc"]})
+    return result
+
+
+def hit(n: int) -> str:
+    last = max(i for i in range(n) if i % 3 == 1)
+    return "user{}@example.com".format(last)
+
+
+def naive(policy: List[Mapping[str, Any]]):
+    compiled: List[Tuple[str, Any]] = []
+    for rule in policy:
+        for kind in ("domain", "email", "pattern"):
+            if kind in rule:
+                value = rule[kind]
+                if kind == "pattern":
+                    value = re.compile(value)
+                compiled.append((kind, value))
+
+    def decide(email: str) -> Union[bool, None]:
+        found = None
+        domain = email.rpartition("@")[2]
+        for kind, value in compiled:
+            if kind == "domain" and domain == value:
+                found = True
+            elif kind == "email" and email == value:
+                found = True
+            elif kind == "pattern" and value.fullmatch(email):
+                found = True
+        return found
+
+    return decide
+
+
+def run(iterations: int = 5000, repeat: int = 5) -> Dict[int, Dict[str, float]]:
+    from iapauth.policy import Policy
+
+    results = {}
+    for n in SIZES:
+        policy = rules(n)
+        compiled = Policy(policy)
+        deciders: List[Tuple[str, Callable[[str], Any]]] = [
+            ("Policy", compiled._decide),
+            ("cached", compiled.decide),
+            ("loop", naive(policy)),
+        ]
+        row = {}
+        for name, decide in deciders:
+            cases = (("miss", MISS, False), ("hit", hit(n), True))
+            for label, email, expected in cases:
+                assert bool(decide(email)) is expected, (name, n, email)
+                best = min(
+                    timeit.repeat(
+                        lambda: decide(email), number=iterations, repeat=repeat
+                    )
+                )
+                row["{} {}".format(name, label)] = best / iterations
+        results[n] = row
+    return results
+
+
+def main():
+    configure()
+    results = run()
+    columns = list(results[SIZES[0]])
+    print("role policy, ns per decision")
+    print("{:>6} ".format("rules") + " ".join("{:>12}".format(c) for c in columns))
+    for n, row in results.items():
+        print(
+            "{:>6} ".format(n)
+            + " ".join("{:>12.0f}".format(row[c] * 1e9) for c in columns)
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
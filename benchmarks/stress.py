@@ -0,0 +1,211 @@
+"""
+concurrent requests through IAPJWTAuthMiddleware against a slow, rotating
+key server, as a gthread worker sees them after a deploy.
+
+the stand-in server from the test suite plays both the gstatic key
+endpoint and the metadata server, answering after `--delay` seconds.
+Each round starts cold (no key set, audience or cached tokens) and runs
+three waves of `--threads` requests, all released at once:
+
+* cold: every thread has its own user's token, signed with the first key
+* rotated: the server now publishes a second key, and every thread's
+  token is signed with it
+* warm: the same tokens again
+
+for each wave it reports the upstream fetches it caused (there should
+be one key fetch for "cold" and "rotated", one audience fetch for
+"cold", and none otherwise), any requests that failed to authenticate,
+and the latency of `process_request` across all rounds.
+
+run it with the test suite's settings:
+
+    $ python runtests.py stress [--threads 64] [--rounds 20] [--delay 0.05]
+
+users are made in memory, so nothing here touches the database.
+"""
+import argparse
+import contextlib
+import os
+import threading
+import time
+from typing import Dict, List
+from unittest import mock
+
+from django.contrib.auth.backends import RemoteUserBackend
+
+
+WAVES = ("cold", "rotated", "warm")
+# what a new worker starts without
+STATE = ("KEY_STORE", "AUDIENCE", "TOKEN_CACHE", "NEGATIVE_CACHE")
+PROJECT = "stress"
+AUDIENCE = "/projects/1234/apps/{}".format(PROJECT)
+
+
+class InMemoryBackend(RemoteUserBackend):
+    """a user for every assertion, without the database"""
+
+    def authenticate(self, request, remote_user):
+        from django.contrib.auth import get_user_model
+
+        return get_user_model()(username=remote_user)
+
+
+class Wave(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.samples: List[int] = []  # nanoseconds
+        self.key_fetches = 0
+        self.audience_fetches = 0
+        self.errors = 0
+
+    def percentile(self, p: float) -> float:
+        from .common import Result
+
+        return Result(self.name, self.samples).percentile(p)
+
+
+def fire(middleware, requests) -> List[int]:
+    """run `middleware.process_request` on every request at once, one
+    thread each, and return how long each took"""
+    barrier = threading.Barrier(len(requests))
+    timings = [0] * len(requests)
+
+    def run(i, request):
+        barrier.wait()
+        start = time.perf_counter_ns()
+        try:
+            middleware.process_request(request)
+        finally:
+            timings[i] = time.perf_counter_ns() - start
+
+    threads = [
+        threading.Thread(target=run, args=(i, request))
+        for i, request in enumerate(requests)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return timings
+
+
+def run(
+    threads: int = 32,
+    rounds: int = 10,
+    delay: float = 0.05,
+    refetch_interval: float = 0,
+) -> Dict[str, Wave]:
+    from django.test import RequestFactory, override_settings
+
+    from iapauth import middleware
+    from iapauth.middleware import IAPJWTAuthMiddleware
+    from tests.server import StubServer
+    from tests.utils import make_key, make_token
+
+    factory = RequestFactory()
+    waves = {name: Wave(name) for name in WAVES}
+    first, second = make_key(), make_key()
+
+    def tokens(private_pem, kid, round_number):
+        return [
+            make_token(
+                private_pem,
+                kid,
+                email="user{}-{}@example.com".format(round_number, i),
+                audience=AUDIENCE,
+            )
+            for i in range(threads)
+        ]
+
+    with contextlib.ExitStack() as stack:
+        server = stack.enter_context(StubServer({"k1": first[1]}, delay=delay))
+        stack.enter_context(
+            override_settings(
+                IAPAUTH_PUBLIC_KEY_URL=server.key_url,
+                IAPAUTH_METADATA_URL=server.url,
+                IAPAUTH_KEY_REFETCH_INTERVAL=refetch_interval,
+                IAPAUTH_STATELESS=True,
+                AUTHENTICATION_BACKENDS=["benchmarks.stress.InMemoryBackend"],
+            )
+        )
+        stack.enter_context(
+            mock.patch.dict(os.environ, {"GOOGLE_CLOUD_PROJECT": PROJECT})
+        )
+        for name in STATE:
+            stack.enter_context(mock.patch.object(middleware, name, None))
+
+        for round_number in range(rounds):
+            # a fresh worker
+            server.keys = {"k1": first[1]}
+            for name in STATE:
+                setattr(middleware, name, None)
+            m = IAPJWTAuthMiddleware(lambda request: None)
+            cold = tokens(first[0], "k1", round_number)
+            rotated = tokens(second[0], "k2", round_number)
+            for name, batch in zip(WAVES, (cold, rotated, rotated)):
+                wave = waves[name]
+                if name == "rotated":
+                    server.keys = {"k1": first[1], "k2": second[1]}
+                requests = [
+                    factory.get("/", HTTP_X_GOOG_IAP_JWT_ASSERTION=token)
+                    for token in batch
+                ]
+                keys, audience = server.key_hits(), server.metadata_hits()
+                wave.samples.extend(fire(m, requests))
+                wave.key_fetches += server.key_hits() - keys
+                wave.audience_fetches += server.metadata_hits() - audience
+                wave.errors += sum(not r.jwt_authenticated for r in requests)
+    return waves
+
+
+COLUMNS = "{:<8} {:>11} {:>16} {:>7} {:>8} {:>8} {:>8} {:>8}"
+ROW = "{:<8} {:>11.2f} {:>16.2f} {:>7} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}"
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="stress")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument(
+        "--delay", type=float, default=0.05, help="seconds the upstream takes"
+    )
+    parser.add_argument(
+        "--refetch-interval",
+        type=float,
+        default=0,
+        help="IAPAUTH_KEY_REFETCH_INTERVAL. Above 0, the rotation comes too"
+        " soon after the cold start to be picked up.",
+    )
+    args = parser.parse_args(argv)
+    waves = run(args.threads, args.rounds, args.delay, args.refetch_interval)
+    print(
+        "{} threads x {} rounds, upstream delay {}s (fetches are per round)".format(
+            args.threads, args.rounds, args.delay
+        )
+    )
+    header = COLUMNS.format(
+        "wave",
+        "key fetches",
+        "audience fetches",
+        "errors",
+        "p50 ms",
+        "p99 ms",
+        "p999 ms",
+        "max ms",
+    )
+    print(header)
+    print("-" * len(header))
+    for wave in waves.values():
+        print(
+            ROW.format(
+                wave.name,
+                wave.key_fetches / args.rounds,
+                wave.audience_fetches / args.rounds,
+                wave.errors,
+                wave.percentile(50) / 1e6,
+                wave.percentile(99) / 1e6,
+                wave.percentile(99.9) / 1e6,
+                max(wave.samples) / 1e6,
+            )
+        )
+    return 1 if any(wave.errors for wave in waves.values()) else 0
@@ -0,0 +1,118 @@
+"""
+cost of tracing one request, against a stand-in for beeline that only
+counts what it is sent.
+
+"per-call" is how the middleware used to trace: every function wrapped
+in a span and every field sent as it is added. The other rows go
+through iapauth.tracing at different IAPAUTH_TRACE_SAMPLE_RATEs.
+
+the stand-in costs next to nothing, so the time column is only our own
+overhead. The spans and calls columns are what a real beeline would do
+work for (building and sending events) on an average request.
+"""
+import functools
+import sys
+import timeit
+from typing import Callable, Dict
+from unittest import mock
+
+from .authenticators import configure
+
+
+FIELDS = tuple("field{}".format(i) for i in range(6))
+RATES = (("off", 0), ("1 in 100", 100), ("1 in 10", 10), ("every", 1))
+
+
+class CountingBeeline(object):
+    def __init__(self):
+        self.spans = 0
+        self.calls = 0
+
+    def traced(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                self.spans += 1
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def add_context(self, data):
+        self.calls += 1
+
+    def add_context_field(self, name, value):
+        self.calls += 1
+
+
+def per_call(beeline: CountingBeeline) -> Callable[[], None]:
+    @beeline.traced("verify")
+    def verify():
+        for name in FIELDS:
+            beeline.add_context_field(name, True)
+
+    def request():
+        verify()
+
+    return request
+
+
+def sampled(beeline: CountingBeeline, rate: int) -> Callable[[], None]:
+    from iapauth import tracing
+
+    with mock.patch.object(tracing, "beeline", beeline):
+        tracing.RATE = rate
+
+        @tracing.traced("verify")
+        def verify():
+            for name in FIELDS:
+                tracing.add_field(name, True)
+
+    def request():
+        with tracing.request():
+            verify()
+
+    return request
+
+
+def run(iterations: int = 20000, repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    from iapauth import tracing
+
+    results = {}
+    beeline = CountingBeeline()
+    cases = [("per-call", per_call(beeline), None)]
+    cases += [(label, sampled(beeline, rate), rate) for label, rate in RATES]
+    try:
+        for label, request, rate in cases:
+            tracing.RATE = rate
+            beeline.spans = beeline.calls = 0
+            with mock.patch.object(tracing, "beeline", beeline):
+                best = min(timeit.repeat(request, number=iterations, repeat=repeat))
+            runs = iterations * repeat
+            results[label] = {
+                "time": best / iterations,
+                "spans": beeline.spans / runs,
+                "calls": beeline.calls / runs,
+            }
+    finally:
+        tracing.reset_rate()
+    return results
+
+
+def main():
+    configure()
+    results = run()
+    print("tracing, per request")
+    print("{:>9} {:>8} {:>8} {:>8}".format("", "ns", "spans", "calls"))
+    for label, row in results.items():
+        print(
+            "{:>9} {:>8.0f} {:>8.2f} {:>8.2f}".format(
+                label, row["time"] * 1e9, row["spans"], row["calls"]
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -42,6 +42,13 @@ SETTINGS_DICT = {
         "iapauth.backends.IAPJWTUserBackend",
     ],
     "SITE_ID": 1,
+    # tests reject plenty of assertions on purpose
+    "LOGGING": {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "handlers": {"null": {"class": "logging.NullHandler"}},
+        "loggers": {"iapauth": {"handlers": ["null"], "propagate": False}},
+    },
     "TEMPLATES": [
         {
             "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -62,7 +69,7 @@ SETTINGS_DICT = {
 }
 
 
-def run_tests():
+def setup():
     # Making Django run this way is a two-step process. First, call
     # settings.configure() to give Django settings to work with:
     from django.conf import settings
@@ -75,7 +82,12 @@ def run_tests():
 
     django.setup()
 
+
+def run_tests():
+    setup()
+
     # Now we instantiate a test runner...
+    from django.conf import settings
     from django.test.utils import get_runner
 
     TestRunner = get_runner(settings)
@@ -86,5 +98,51 @@ def run_tests():
     sys.exit(bool(failures))
 
 
+def run_benchmarks(argv):
+    """
+    `python runtests.py bench [args]` runs the benchmarks in benchmarks/
+    against the same settings as the tests. Any args are passed on to
+    benchmarks.middleware, e.g. `--authenticator es256`.
+    """
+    setup()
+    from django.core.management import call_command
+
+    # the benchmarks need tables in the in-memory database
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+    from benchmarks import (
+        authenticators,
+        gate,
+        middleware,
+        paths,
+        policy,
+        tracing,
+    )
+
+    status = middleware.main(argv)
+    status = status or authenticators.main()
+    status = status or paths.main()
+    status = status or policy.main()
+    status = status or tracing.main()
+    status = status or gate.main()
+    sys.exit(status)
+
+
+def run_stress(argv):
+    """
+    `python runtests.py stress [args]` runs benchmarks.stress, the
+    concurrent cold start and key rotation harness.
+    """
+    setup()
+    from benchmarks import stress
+
+    sys.exit(stress.main(argv))
+
+
 if __name__ == "__main__":
-    run_tests()
+    if sys.argv[1:2] == ["bench"]:
+        run_benchmarks(sys.argv[2:])
+    elif sys.argv[1:2] == ["stress"]:
+        run_stress(sys.argv[2:])
+    else:
+        run_tests()
@@ -0,0 +1,36 @@
+from django.apps import AppConfig
+
+
+class IAPAuthConfig(AppConfig):
+    name = "iapauth"
+    verbose_name = "IAP authentication"
+
+    def ready(self):
+        from . import conf, log
+        from .middleware import (
+            PATH_SETTINGS,
+            key_store,
+            path_matcher,
+            serves_requests,
+            start_warm_up,
+        )
+        from .policy import policy
+
+        # compile the path patterns and role policy now, so a bad one
+        # fails at startup
+        for setting in PATH_SETTINGS:
+            path_matcher(setting)
+        policy()
+
+        if conf.get("IAPAUTH_KEY_SNAPSHOT"):
+            # reads the snapshot file, so workers forked from here start
+            # with the keys already in memory
+            key_store()
+
+        # IAPAUTH_LOG_QUEUE
+        log.configure()
+
+        if conf.get("IAPAUTH_WARM_UP") and serves_requests():
+            # don't hold up startup; the first requests wait on the same
+            # single-flight fetches if they get there before this finishes
+            start_warm_up()
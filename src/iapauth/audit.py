@@ -0,0 +1,198 @@
+"""
+re-verifying IAP assertions after the fact, e.g. from access logs.
+
+`audit()` reads lines, picks out anything shaped like a JWT, skips
+tokens it has seen in the last `window` distinct ones, and verifies the
+rest against a pinned key set (a `{kid: pem}` file as Google publishes
+it, or a key snapshot), so nothing touches the network. Tokens are
+verified `chunk_size` at a time across a pool of processes, with only a
+couple of chunks per process in flight, so memory stays bounded however
+long the input is. Results come back in input order.
+
+a logged assertion has usually long expired, so by default each one is
+judged as of its own `iat`: the signature, issuer, audience and claims
+are checked, but not whether it has expired since. Pass
+`check_expiry=True` to judge them as of now.
+"""
+import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+
+from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicKey
+from jose.exceptions import JOSEError, JWTClaimsError  # type: ignore
+
+from .cache import TTLCache, token_digest
+from .keys import parse_public_keys
+from .verify import (
+    decode_claims,
+    inspect_token,
+    split_token,
+    validate_claims,
+    verify_signature,
+)
+
+
+# a compact JWS whose header starts with `{"`
+TOKEN = re.compile(r"eyJ[\w-]*\.[\w-]*\.[\w-]*")
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_WINDOW = 100000  # distinct tokens remembered for deduplication
+TOTALS = ("lines", "tokens", "repeated", "valid", "invalid")
+
+
+def load_key_file(path: str) -> Dict[str, str]:
+    """the `{kid: pem}` mapping from a key set or key snapshot file.
+    Raises KeyFetchError if the keys don't parse."""
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    if isinstance(raw, dict) and "fetched_at" in raw and "keys" in raw:
+        raw = raw["keys"]
+    parse_public_keys(raw)
+    return raw
+
+
+class Verifier(object):
+    """verifies one token at a time against a fixed key set"""
+
+    def __init__(self, keys: Dict[str, str], audience: str, check_expiry=False):
+        self.keys = parse_public_keys(keys)
+        self.audience = audience
+        self.check_expiry = check_expiry
+
+    def __call__(self, line: int, jwt_token: str) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"line": line, "status": "invalid"}
+        reason, kid = inspect_token(jwt_token)
+        result["kid"] = kid
+        key = None if kid is None else self.keys.get(kid)
+        if reason is not None or key is None:
+            result["reason"] = reason or "unknown_kid"
+            return result
+        try:
+            claims = self.decode(jwt_token, key)
+        except JOSEError as e:
+            result["reason"] = "invalid"
+            result["detail"] = str(e)
+            return result
+        result["status"] = "valid"
+        result["email"] = claims["email"]
+        result["hd"] = claims.get("hd")
+        result["iat"] = claims["iat"]
+        result["exp"] = claims["exp"]
+        return result
+
+    def decode(self, jwt_token: str, key: EllipticCurvePublicKey) -> dict:
+        _, header_segment, payload_segment, signature = split_token(jwt_token)
+        verify_signature(key, header_segment, payload_segment, signature)
+        claims = decode_claims(payload_segment)
+        now = None
+        if not self.check_expiry and isinstance(claims.get("iat"), int):
+            now = claims["iat"]
+        validate_claims(claims, self.audience, now)
+        if not isinstance(claims.get("email"), str):
+            raise JWTClaimsError("missing email claim")
+        return claims
+
+
+# each worker process's Verifier
+_verifier: Union[Verifier, None] = None
+
+
+# a worker only has the pinned keys. Nothing it inherits from the parent
+# fetches anything: IAPAUTH_WARM_UP runs in neither management commands
+# nor forked processes.
+def _start_worker(keys: Dict[str, str], audience: str, check_expiry: bool):
+    global _verifier
+
+    _verifier = Verifier(keys, audience, check_expiry)
+
+
+def _verify_chunk(chunk: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    if _verifier is None:
+        raise RuntimeError("audit worker not initialised")
+    return [_verifier(line, jwt_token) for line, jwt_token in chunk]
+
+
+def _tokens(
+    lines: Iterable[str], window: int, totals: Dict[str, int]
+) -> Iterator[Tuple[int, str]]:
+    """`(line number, token)` for every token not seen recently"""
+    seen = TTLCache(window)
+    forever = float("inf")
+    for number, line in enumerate(lines, 1):
+        totals["lines"] += 1
+        for match in TOKEN.finditer(line):
+            jwt_token = match.group()
+            totals["tokens"] += 1
+            digest = token_digest(jwt_token, None)
+            if seen.get(digest) is not None:
+                totals["repeated"] += 1
+                continue
+            seen.set(digest, True, forever)
+            yield (number, jwt_token)
+
+
+def _chunks(
+    tokens: Iterator[Tuple[int, str]], size: int
+) -> Iterator[List[Tuple[int, str]]]:
+    chunk = []
+    for item in tokens:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def audit(
+    lines: Iterable[str],
+    keys: Dict[str, str],
+    audience: str,
+    processes: Union[int, None] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    window: int = DEFAULT_WINDOW,
+    check_expiry: bool = False,
+    totals: Union[Dict[str, int], None] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    One result per distinct token in `lines`: its `line`, `status`
+    ("valid" or "invalid") and `kid`, then `email`, `hd`, `iat` and `exp`
+    if it is valid, or `reason` (and for a failed verification `detail`)
+    if not.
+
+    `processes` defaults to one per CPU; 1 verifies in this process.
+    If given, `totals` is kept up to date with the counts in TOTALS.
+    """
+    if totals is None:
+        totals = {}
+    for name in TOTALS:
+        totals.setdefault(name, 0)
+    chunks = _chunks(_tokens(lines, window, totals), chunk_size)
+    processes = processes or os.cpu_count() or 1
+    for result in _verify_all(chunks, keys, audience, processes, check_expiry):
+        totals[result["status"]] += 1
+        yield result
+
+
+def _verify_all(chunks, keys, audience, processes, check_expiry):
+    if processes == 1:
+        verifier = Verifier(keys, audience, check_expiry)
+        for chunk in chunks:
+            for line, jwt_token in chunk:
+                yield verifier(line, jwt_token)
+        return
+    with ProcessPoolExecutor(
+        processes,
+        initializer=_start_worker,
+        initargs=(keys, audience, check_expiry),
+    ) as pool:
+        # enough in flight to keep every process busy, and no more
+        pending: deque = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_verify_chunk, chunk))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
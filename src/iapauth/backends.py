@@ -1,29 +1,369 @@
-from django.conf import settings
+import copy
+import os
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Union
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import RemoteUserBackend
-from django.contrib.auth.models import User
+from django.contrib.auth.models import Group, User
+from django.db import IntegrityError, router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpResponse
+from django.utils.inspect import func_supports_parameter
+
+from . import conf, tracing
+from .cache import TTLCache
+from .middleware import IAPJWTAuthMiddleware, JWTRequest
+from .policy import Role, policy
+
+
+UserModel = get_user_model()
+
+# Users recently looked up by the backend, keyed on ("username", name) and
+# ("pk", id), so that a burst of logins (and `auth.get_user()` on every
+# request of a session) doesn't go to the database each time. Set
+# IAPAUTH_USER_CACHE_SIZE to enable.
+USER_CACHE: Union[TTLCache, None] = None
+
+
+def user_cache() -> Union[TTLCache, None]:
+    global USER_CACHE
+
+    if USER_CACHE is None:
+        size = conf.get("IAPAUTH_USER_CACHE_SIZE")
+        if size <= 0:
+            return None
+        USER_CACHE = TTLCache(size)
+
+    return USER_CACHE
+
+
+def _cached_user(key) -> Union[User, None]:
+    cache = user_cache()
+    if cache is None:
+        return None
+    user = cache.get(key)
+    tracing.add_field("iapauth.user_cache_hit", user is not None)
+    # every request gets its own instance; login() writes to it
+    return None if user is None else copy.copy(user)
+
+
+def _cache_user(user: User):
+    cache = user_cache()
+    if cache is not None:
+        expires_at = cache.clock() + conf.get("IAPAUTH_USER_CACHE_TTL")
+        # not the instance the caller goes on to use
+        user = copy.copy(user)
+        cache.set(("username", user.get_username()), user, expires_at)
+        cache.set(("pk", user.pk), user, expires_at)
+
+
+def invalidate_user(user: User):
+    """drop `user` from the user cache"""
+    cache = USER_CACHE
+    if cache is None:
+        return
+    cached = cache.pop(("pk", user.pk))
+    if cached is not None:
+        # the username may be what just changed
+        cache.pop(("username", cached.get_username()))
+    cache.pop(("username", user.get_username()))
+
+
+def _user_saved(sender, instance, update_fields=None, **kwargs):
+    # login() saves last_login every time, which would make the cache
+    # useless. Nothing we hand out depends on it.
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return
+    invalidate_user(instance)
 
-from .middleware import JWTRequest
 
+def _user_deleted(sender, instance, **kwargs):
+    invalidate_user(instance)
 
-try:
-    import beeline  # type: ignore
-except ImportError:
-    import iapauth.instrumentation as beeline  # type: ignore
+
+post_save.connect(_user_saved, sender=UserModel, dispatch_uid="iapauth.user_saved")
+post_delete.connect(
+    _user_deleted, sender=UserModel, dispatch_uid="iapauth.user_deleted"
+)
+
+
+def _reset_user_cache():
+    global USER_CACHE
+    USER_CACHE = None
+
+
+conf.on_change(("IAPAUTH_USER_CACHE_SIZE",), _reset_user_cache)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_user_cache)
+
+
+def _sync_groups(user: User, role: Union[Role, None], created: bool = False):
+    """add `user` to the policy's groups that `role` grants, and remove
+    them from the rest"""
+    managed = policy().managed_groups
+    if not managed or not hasattr(user, "groups"):
+        return
+    wanted: FrozenSet[str] = frozenset()
+    if role is not None and role.groups is not None:
+        wanted = role.groups
+    current: FrozenSet[str] = frozenset()
+    if not created:
+        names = user.groups.filter(name__in=managed).values_list("name", flat=True)
+        current = frozenset(names)
+    if current - wanted:
+        user.groups.remove(*Group.objects.filter(name__in=current - wanted))
+    if wanted - current:
+        groups = [Group.objects.get_or_create(name=n)[0] for n in wanted - current]
+        user.groups.add(*groups)
 
 
 # this expects to be used with IAPJWTAuthMiddleware
 class IAPJWTUserBackend(RemoteUserBackend):
-    @beeline.traced(name="iapauth.backend.IAPJWTUserBackend.configure_user")
-    def configure_user(self, request: JWTRequest, user: User):
+    @tracing.traced("iapauth.backend.IAPJWTUserBackend.authenticate")
+    def authenticate(self, request, remote_user):
         """
-        Configure a user after creation and return the updated user.
+        Like `RemoteUserBackend.authenticate()`, but a new user is created
+        fully configured in a single INSERT, and users are served from the
+        user cache when it is enabled.
+
+        a subclass's own `configure_user()` is still called, as
+        `RemoteUserBackend` would, once the user has been saved (but not
+        for users served from the user cache).
+        """
+        if not remote_user:
+            return None
+        username = self.clean_username(remote_user)
+        user = _cached_user(("username", username))
+        if user is None:
+            try:
+                user = UserModel._default_manager.get_by_natural_key(username)
+            except UserModel.DoesNotExist:
+                if not self.create_unknown_user:
+                    return None
+                user, created = self._create_user(request, username)
+            else:
+                created = False
+                self.apply_policy(request, user)
+            if type(self).configure_user is not IAPJWTUserBackend.configure_user:
+                user = self._configure_user(request, user, created)
+            _cache_user(user)
+        return user if self.user_can_authenticate(user) else None
+
+    async def aauthenticate(self, request, remote_user):
+        if remote_user:
+            user = _cached_user(("username", self.clean_username(remote_user)))
+            if user is not None:
+                return user if self.user_can_authenticate(user) else None
+        return await sync_to_async(self.authenticate)(request, remote_user)
+
+    def get_user(self, user_id):
+        user = _cached_user(("pk", user_id))
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                _cache_user(user)
+            return user
+        return user if self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        user = _cached_user(("pk", user_id))
+        if user is not None:
+            return user if self.user_can_authenticate(user) else None
+        return await sync_to_async(self.get_user)(user_id)
+
+    def _create_user(self, request, username):
+        user = UserModel(**{UserModel.USERNAME_FIELD: username})
+        self.prepare_user(request, user)
+        try:
+            with transaction.atomic(using=router.db_for_write(UserModel)):
+                user.save(force_insert=True)
+        except IntegrityError:
+            # another request created them first
+            user = UserModel._default_manager.get_by_natural_key(username)
+            self.apply_policy(request, user)
+            return (user, False)
+        _sync_groups(user, self.role(request), created=True)
+        return (user, True)
+
+    def _configure_user(self, request, user, created):
+        # overrides written before Django 4.1 don't take `created`, and
+        # are only called for new users
+        if func_supports_parameter(self.configure_user, "created"):
+            return self.configure_user(request, user, created=created)
+        if created:
+            return self.configure_user(request, user)
+        return user
+
+    def role(self, request: JWTRequest) -> Union[Role, None]:
+        """
+        What IAPAUTH_ROLE_POLICY (and IAP_JWT_ADMIN_DOMAIN) grant the user
+        in the assertion, or None if nothing does.
+        """
+        rules = policy()
+        email = getattr(request, "jwt_user_email", None)
+        if not rules or email is None:
+            return None
+        return rules.decide(email, getattr(request, "jwt_domain", None))
+
+    def apply_policy(self, request: JWTRequest, user: User):
+        """
+        Bring an existing user's flags and groups in line with the policy,
+        writing only what changed.
+        """
+        role = self.role(request)
+        changed = role.apply(user) if role is not None else []
+        if changed:
+            UserModel._default_manager.filter(pk=user.pk).update(
+                **{name: getattr(user, name) for name in changed}
+            )
+        _sync_groups(user, role)
+
+    def prepare_user(self, request: JWTRequest, user: User):
+        """
+        Set up a new, not yet saved, user from the assertion.
         """
         user.email = request.jwt_user_email
         user.set_unusable_password()
-        domain = request.jwt_domain
-        if hasattr(settings, "IAP_JWT_ADMIN_DOMAIN"):
-            if domain == settings.IAP_JWT_ADMIN_DOMAIN:
-                user.is_superuser = True
-                user.is_staff = True
-        user.save()
+        role = self.role(request)
+        if role is not None:
+            role.apply(user)
+
+    @tracing.traced("iapauth.backend.IAPJWTUserBackend.configure_user")
+    def configure_user(self, request: JWTRequest, user: User, created=True):
+        """
+        Configure a user after creation and return the updated user.
+
+        `authenticate()` does this with `prepare_user()` and
+        `apply_policy()` instead, but calls an overriding
+        `configure_user()` after them.
+        """
+        if created:
+            self.prepare_user(request, user)
+            user.save()
         return user
+
+
+# what provisioning may change on a user that already exists
+PROVISION_UPDATE_FIELDS = ("email", "is_staff", "is_superuser")
+
+
+def _batches(lines: Iterable[str], size: int) -> Iterator[List[str]]:
+    batch: List[str] = []
+    for line in lines:
+        email = line.strip()
+        if email and not email.startswith("#"):
+            batch.append(email)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def provision_users(
+    lines: Iterable[str],
+    batch_size: int = 1000,
+    backend: Union[IAPJWTUserBackend, None] = None,
+    middleware: Union[IAPJWTAuthMiddleware, None] = None,
+    domain_from_email: bool = False,
+) -> Iterator[Dict[str, int]]:
+    """
+    Create users ahead of their first login, one email address per line
+    of `lines` (blank lines and `#` comments are skipped).
+
+    usernames come from `middleware.clean_username()`, and new users are
+    set up by `backend.prepare_user()`, as if they had logged in through
+    IAP. There is no `hd` to go on, so the role policy's domain rules
+    (and IAP_JWT_ADMIN_DOMAIN) only apply with `domain_from_email`, which
+    takes the email's domain as `hd`: only for lists of Workspace
+    accounts, since a personal account can have any address. Users that
+    already exist get their email and the role policy's staff and
+    superuser flags updated. Groups are left to their first login.
+
+    `lines` is read `batch_size` at a time, and each batch costs one
+    SELECT, one `bulk_create()` and one `bulk_update()`. Running totals
+    are yielded after every batch.
+
+    bulk writes don't send `post_save`, so servers with the user cache
+    enabled may serve the old user for up to IAPAUTH_USER_CACHE_TTL.
+    """
+    if backend is None:
+        backend = IAPJWTUserBackend()
+    if middleware is None:
+        middleware = IAPJWTAuthMiddleware(lambda request: HttpResponse())
+    # one request, rewritten for each email, to hand to the hooks
+    request = JWTRequest()
+    totals = {"read": 0, "created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    for batch in _batches(lines, batch_size):
+        totals["read"] += len(batch)
+        try:
+            counts = _provision_batch(
+                batch, backend, middleware, request, domain_from_email
+            )
+        except IntegrityError:
+            # some of them logged in while we were looking. They exist now.
+            counts = _provision_batch(
+                batch, backend, middleware, request, domain_from_email
+            )
+        for name, n in counts.items():
+            totals[name] += n
+        yield dict(totals)
+
+
+def _for_email(request: JWTRequest, email: str, domain_from_email: bool):
+    request.jwt_user_email = email
+    request.jwt_domain = None
+    if domain_from_email:
+        request.jwt_domain = email.rpartition("@")[2].lower()
+
+
+def _provision_batch(emails, backend, middleware, request, domain_from_email):
+    counts = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+    by_username: Dict[str, str] = {}
+    for email in emails:
+        if "@" not in email:
+            counts["skipped"] += 1
+            continue
+        _for_email(request, email, domain_from_email)
+        username = backend.clean_username(middleware.clean_username(email, request))
+        if username in by_username:
+            counts["skipped"] += 1
+        by_username[username] = email
+
+    manager = UserModel._default_manager
+    lookup = {"{}__in".format(UserModel.USERNAME_FIELD): list(by_username)}
+    existing = {user.get_username(): user for user in manager.filter(**lookup)}
+    created = []
+    updated = []
+    for username, email in by_username.items():
+        _for_email(request, email, domain_from_email)
+        user = existing.get(username)
+        if user is None:
+            user = UserModel(**{UserModel.USERNAME_FIELD: username})
+            backend.prepare_user(request, user)
+            created.append(user)
+        elif _update_user(request, user, backend.role(request)):
+            updated.append(user)
+        else:
+            counts["unchanged"] += 1
+
+    with transaction.atomic(using=router.db_for_write(UserModel)):
+        manager.bulk_create(created, batch_size=len(emails))
+        manager.bulk_update(updated, PROVISION_UPDATE_FIELDS, batch_size=len(emails))
+    counts["created"] = len(created)
+    counts["updated"] = len(updated)
+    return counts
+
+
+def _update_user(request, user, role):
+    """bring an existing user in line with the assertion and the policy.
+    True if it changed."""
+    changed = False
+    if user.email != request.jwt_user_email:
+        user.email = request.jwt_user_email
+        changed = True
+    if role is not None and role.apply(user):
+        changed = True
+    return changed
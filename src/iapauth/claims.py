@@ -0,0 +1,45 @@
+"""
+the verified claims of an IAP assertion, as `request.iap_claims`.
+
+the middleware sets `request.iap_claims` from the same verification that
+logs the user in (or None if there was no valid assertion), so code
+further down never needs to decode `X-Goog-IAP-JWT-Assertion` again.
+One `IAPClaims` is shared by every request carrying the same assertion
+while it sits in the token cache, so treat it as read-only.
+"""
+from typing import Any, Dict, Union
+
+
+class IAPClaims(object):
+    """the claims IAP always sets as attributes, and the rest (e.g.
+    `google`) through `claims["name"]` or `claims.get("name")`"""
+
+    __slots__ = ("email", "hd", "sub", "aud", "iss", "iat", "exp", "claims")
+
+    def __init__(self, claims: Dict[str, Any]):
+        self.claims = claims
+        self.email: str = claims["email"]
+        # only set for Google Workspace accounts
+        self.hd: Union[str, None] = claims.get("hd")
+        self.sub: Union[str, None] = claims.get("sub")
+        self.aud: Union[str, None] = claims.get("aud")
+        self.iss: Union[str, None] = claims.get("iss")
+        self.iat: Union[int, None] = claims.get("iat")
+        self.exp: Union[int, None] = claims.get("exp")
+
+    def __getitem__(self, name: str) -> Any:
+        return self.claims[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.claims
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self.claims.get(name, default)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IAPClaims) and self.claims == other.claims
+
+    def __repr__(self) -> str:
+        return "IAPClaims(email={!r}, sub={!r}, exp={!r})".format(
+            self.email, self.sub, self.exp
+        )
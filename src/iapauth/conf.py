@@ -0,0 +1,124 @@
+"""
+iapauth's settings and their defaults.
+
+`get()` looks each setting up once and then serves it from a dict, so the
+request path doesn't go through `django.conf.settings` every time. The
+dict is cleared whenever Django's `setting_changed` signal fires (e.g.
+under `override_settings` in tests), and anything registered with
+`on_change()` for that setting is called.
+"""
+from typing import Any, Callable, Dict, Iterable, List
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .fetch import DEFAULT_TIMEOUT
+from .keys import (
+    DEFAULT_KEY_MAX_BACKOFF,
+    DEFAULT_KEY_REFETCH_INTERVAL,
+    DEFAULT_KEY_TTL,
+    PUBLIC_KEY_URL,
+)
+from .shared import DEFAULT_LOCK_TIMEOUT
+from .tracing import DEFAULT_SAMPLE_RATE
+
+
+DEFAULTS: Dict[str, Any] = {
+    # the expected `aud` of the assertion. None means work it out from
+    # the GCE metadata server.
+    "JWT_AUDIENCE": None,
+    # None means `JWTAuthenticator()`
+    "IAPAUTH_JWT_AUTHENTICATOR": None,
+    # how many verified assertions to remember, 0 to disable
+    "IAPAUTH_TOKEN_CACHE_SIZE": 1024,
+    # seconds before a token's `exp` that we stop trusting the cached result
+    "IAPAUTH_TOKEN_CACHE_MARGIN": 30,
+    # IAP assertions are well under 2KB. Anything much bigger is junk.
+    "IAPAUTH_MAX_TOKEN_LENGTH": 8192,
+    # recently rejected assertions, so replaying a bad token doesn't cost a
+    # signature verification every time
+    "IAPAUTH_NEGATIVE_CACHE_SIZE": 1024,
+    "IAPAUTH_NEGATIVE_CACHE_TTL": 60,
+    "IAPAUTH_PUBLIC_KEY_URL": PUBLIC_KEY_URL,
+    "IAPAUTH_KEY_TTL": DEFAULT_KEY_TTL,
+    "IAPAUTH_KEY_REFETCH_INTERVAL": DEFAULT_KEY_REFETCH_INTERVAL,
+    # the most seconds to wait between retries once fetches keep failing
+    "IAPAUTH_KEY_MAX_BACKOFF": DEFAULT_KEY_MAX_BACKOFF,
+    # a file to keep the last good key set in, so new workers start with
+    # it instead of fetching. None to not keep one.
+    "IAPAUTH_KEY_SNAPSHOT": None,
+    "IAPAUTH_METADATA_URL": "http://metadata.google.internal",
+    # (connect, read) timeouts in seconds for the key and metadata fetches
+    "IAPAUTH_FETCH_TIMEOUT": DEFAULT_TIMEOUT,
+    # fetch the audience and key set when the app starts, rather than in
+    # the first request
+    "IAPAUTH_WARM_UP": False,
+    # alias of a Django cache to share the key set and audience between
+    # worker processes through. None to not share them.
+    "IAPAUTH_SHARED_CACHE": None,
+    # how long one worker may hold the shared fetch lock, in seconds
+    "IAPAUTH_SHARED_CACHE_LOCK_TIMEOUT": DEFAULT_LOCK_TIMEOUT,
+    # users from this `hd` are made staff and superuser
+    "IAP_JWT_ADMIN_DOMAIN": None,
+    # rules granting staff, superuser and groups by domain, email or
+    # email pattern. See iapauth.policy.
+    "IAPAUTH_ROLE_POLICY": (),
+    # how many users `IAPJWTUserBackend` keeps in memory, 0 to disable,
+    # and for how many seconds
+    "IAPAUTH_USER_CACHE_SIZE": 0,
+    "IAPAUTH_USER_CACHE_TTL": 60,
+    # authenticate every request from its assertion alone, without a
+    # session: everywhere, or on these paths
+    "IAPAUTH_STATELESS": False,
+    "IAPAUTH_STATELESS_PATHS": (),
+    # paths the middleware ignores: anything not matching the include
+    # patterns (if there are any), and anything matching the exclude ones.
+    # See iapauth.paths for the pattern syntax.
+    "IAPAUTH_INCLUDE_PATHS": (),
+    "IAPAUTH_EXCLUDE_PATHS": (),
+    # verify the assertion the first time request.user (or one of the
+    # request.jwt_* attributes) is read, rather than on every request
+    "IAPAUTH_LAZY": False,
+    # trust an assertion a session was already verified with until it
+    # expires, without checking its signature again
+    "IAPAUTH_SESSION_BINDING": False,
+    # rejected assertions are logged to `iapauth.rejections`: per reason,
+    # this many at once and then this many a second, with a summary of
+    # the rest every this many seconds. See iapauth.log.
+    "IAPAUTH_REJECTION_LOG_BURST": 10,
+    "IAPAUTH_REJECTION_LOG_RATE": 1.0,
+    "IAPAUTH_REJECTION_LOG_INTERVAL": 60,
+    # format and write those records in a background thread
+    "IAPAUTH_LOG_QUEUE": False,
+    # count outcomes and time each phase in iapauth.metrics
+    "IAPAUTH_METRICS": False,
+    # trace one request in this many through beeline, 0 for none. Read
+    # at import time; see iapauth.tracing.
+    "IAPAUTH_TRACE_SAMPLE_RATE": DEFAULT_SAMPLE_RATE,
+}
+
+_resolved: Dict[str, Any] = {}
+_callbacks: Dict[str, List[Callable[[], None]]] = {}
+
+
+def get(name: str) -> Any:
+    try:
+        return _resolved[name]
+    except KeyError:
+        value = _resolved[name] = getattr(settings, name, DEFAULTS[name])
+        return value
+
+
+def on_change(names: Iterable[str], callback: Callable[[], None]):
+    """call `callback` whenever one of the settings in `names` changes"""
+    for name in names:
+        _callbacks.setdefault(name, []).append(callback)
+
+
+@receiver(setting_changed)
+def _setting_changed(setting, **kwargs):
+    if setting in DEFAULTS:
+        _resolved.pop(setting, None)
+        for callback in _callbacks.get(setting, []):
+            callback()
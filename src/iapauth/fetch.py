@@ -0,0 +1,65 @@
+"""
+HTTP fetching for the key set and the metadata server.
+
+all fetches share one pooled `requests.Session`, so after the first
+request the TCP (and TLS) connections are reused, and every request has
+a strict timeout. A forked child gets a fresh session, since sharing
+sockets with the parent would garble both.
+"""
+import os
+import threading
+from typing import Any, Dict, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+SESSION: Union[requests.Session, None] = None
+_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    """an upstream request failed or returned something unusable"""
+
+
+def session() -> requests.Session:
+    global SESSION
+
+    if SESSION is None:
+        with _lock:
+            if SESSION is None:
+                s = requests.Session()
+                # fetches are rare and single-flight, so a small pool will do
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                SESSION = s
+    return SESSION
+
+
+# (connect, read) in seconds
+DEFAULT_TIMEOUT = (2, 5)
+
+
+def get_json(
+    url: str,
+    headers: Union[Dict[str, str], None] = None,
+    timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+) -> Any:
+    try:
+        resp = session().get(url, headers=headers, timeout=timeout)
+        resp.raise_for_status()
+        return resp.json()
+    except (requests.RequestException, ValueError) as e:
+        raise FetchError("{}: {}".format(url, e)) from e
+
+
+def _reset_after_fork():
+    global SESSION, _lock
+
+    SESSION = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
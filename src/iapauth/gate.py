@@ -0,0 +1,147 @@
+"""
+turning away requests without a valid IAP assertion before Django sees
+them.
+
+for an app where every route is behind IAP, wrap the WSGI or ASGI
+application Django gives you:
+
+    application = WSGIGate(get_wsgi_application())
+    application = ASGIGate(get_asgi_application())
+
+a request with no assertion gets a 401, and one whose assertion doesn't
+verify a 403, straight from the environ or scope: no request object, no
+session, no middleware. Verification goes through the same authenticator
+(and so the same key store, token cache and negative cache) as
+`IAPJWTAuthMiddleware`. The claims of an accepted assertion are left in
+the environ or scope under `middleware.GATE_CLAIMS`, and the middleware
+uses them instead of verifying the assertion again.
+
+paths that `IAPAUTH_INCLUDE_PATHS` and `IAPAUTH_EXCLUDE_PATHS` leave out
+of the middleware (health checks, say) are passed through untouched, as
+is anything that isn't an ASGI "http" scope (websockets, lifespan).
+
+this module can be imported before Django is set up, as wsgi.py and
+asgi.py do; the middleware is only imported when a gate is made.
+"""
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+
+from django.core.handlers.wsgi import get_path_info
+
+from . import metrics, tracing
+from .claims import IAPClaims
+
+
+HEADER = "HTTP_X_GOOG_IAP_JWT_ASSERTION"
+ASGI_HEADER = b"x-goog-iap-jwt-assertion"
+
+NO_TOKEN = (401, "401 Unauthorized", b"IAP assertion required\n")
+REJECTED = (403, "403 Forbidden", b"IAP assertion rejected\n")
+CONTENT_TYPE = "text/plain; charset=utf-8"
+
+
+def _no_token():
+    tracing.add_field("iapauth.no_token", True)
+    metrics.incr("no_token")
+    return NO_TOKEN
+
+
+def _verdict(claims: Union[IAPClaims, None]):
+    tracing.add_field("iapauth.authenticated", claims is not None)
+    if claims is None:
+        metrics.incr("rejected")
+        tracing.fail()
+        return REJECTED
+    return None
+
+
+class WSGIGate(object):
+    def __init__(self, application: Callable[..., Iterable[bytes]]):
+        from . import middleware
+
+        self.application = application
+        self.middleware = middleware
+
+    def __call__(self, environ: Dict[str, Any], start_response):
+        middleware = self.middleware
+        if middleware.is_excluded_path(get_path_info(environ)):
+            return self.application(environ, start_response)
+        with tracing.request():
+            tracing.add_field("iapauth.gate", True)
+            jwt_token = environ.get(HEADER)
+            if not jwt_token:
+                refusal = _no_token()
+            else:
+                audience = middleware.jwt_audience()
+                with metrics.timer("verify"):
+                    claims = middleware.verify(
+                        middleware.get_authenticator(), jwt_token, audience
+                    )
+                refusal = _verdict(claims)
+        if refusal is None:
+            environ[middleware.GATE_CLAIMS] = claims
+            return self.application(environ, start_response)
+        status, reason, body = refusal
+        start_response(
+            reason,
+            [("Content-Type", CONTENT_TYPE), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+
+class ASGIGate(object):
+    def __init__(self, application: Callable[..., Any]):
+        from . import middleware
+
+        self.application = application
+        self.middleware = middleware
+
+    async def __call__(self, scope: Dict[str, Any], receive, send):
+        middleware = self.middleware
+        if scope["type"] != "http" or middleware.is_excluded_path(_path_info(scope)):
+            return await self.application(scope, receive, send)
+        with tracing.request():
+            tracing.add_field("iapauth.gate", True)
+            jwt_token = _header(scope["headers"])
+            if not jwt_token:
+                refusal = _no_token()
+            else:
+                audience = await middleware.ajwt_audience()
+                with metrics.timer("verify"):
+                    claims = await middleware.averify(
+                        middleware.get_authenticator(), jwt_token, audience
+                    )
+                refusal = _verdict(claims)
+        if refusal is None:
+            # a copy: the server may reuse its scope
+            scope = dict(scope)
+            scope[middleware.GATE_CLAIMS] = claims
+            return await self.application(scope, receive, send)
+        status, reason, body = refusal
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", CONTENT_TYPE.encode("ascii")),
+                    (b"content-length", str(len(body)).encode("ascii")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def _path_info(scope: Dict[str, Any]) -> str:
+    """the path as ASGIRequest.path_info would have it"""
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path) :]
+    return path or "/"
+
+
+def _header(headers: List[Tuple[bytes, bytes]]) -> Union[str, None]:
+    for name, value in headers:
+        if name == ASGI_HEADER:
+            # as Django decodes it
+            return value.decode("latin1")
+    return None
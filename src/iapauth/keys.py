@@ -0,0 +1,278 @@
+"""
+the public keys that IAP signs assertions with.
+
+Google publishes them as a JSON object mapping `kid` to a PEM encoded
+ES256 public key, and rotates them from time to time. `KeyStore` parses
+each PEM once, indexes the result by `kid` and keeps the set fresh:
+
+* once the set is older than `ttl` it keeps serving the stale keys and
+  refreshes them in a background thread (stale-while-revalidate).
+* a `kid` we have never seen triggers one synchronous refetch, in case
+  the keys were just rotated. Concurrent callers wait for that one fetch
+  instead of starting their own, and at most one such refetch happens
+  per `refetch_interval` so a flood of made up `kid`s can't turn into a
+  flood of requests to Google.
+* after a failed fetch, the wait before the next one doubles with each
+  failure in a row, up to `max_backoff`.
+* with a `KeySnapshot`, every good key set is also written to a local
+  file, and a new `KeyStore` starts from that file instead of waiting on
+  the network. A snapshot older than `ttl` is revalidated in the
+  background, like any other stale set.
+
+a fetched set only replaces the current one once every key in it
+parses.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple, Union
+
+from asgiref.sync import sync_to_async
+from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicKey
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+from . import metrics, tracing
+from .fetch import DEFAULT_TIMEOUT, FetchError, get_json
+
+
+PUBLIC_KEY_URL = "https://www.gstatic.com/iap/verify/public_key"
+
+DEFAULT_KEY_TTL = 3600  # seconds before the key set is revalidated
+DEFAULT_KEY_REFETCH_INTERVAL = 30  # minimum seconds between unknown kid fetches
+DEFAULT_KEY_MAX_BACKOFF = 600  # most seconds between retries of a failing fetch
+
+
+class KeyFetchError(FetchError):
+    """the key set could not be fetched or parsed"""
+
+
+def fetch_public_keys(
+    url: str = PUBLIC_KEY_URL, timeout=DEFAULT_TIMEOUT
+) -> Dict[str, str]:
+    try:
+        return get_json(url, timeout=timeout)
+    except FetchError as e:
+        raise KeyFetchError(str(e)) from e
+
+
+def parse_public_keys(raw: Any) -> Dict[str, EllipticCurvePublicKey]:
+    """turn a `{kid: pem}` mapping into `{kid: public key}`"""
+    if not isinstance(raw, dict) or not raw:
+        raise KeyFetchError("expected a non-empty mapping of kid to PEM")
+    parsed = {}
+    for kid, pem in raw.items():
+        try:
+            key = load_pem_public_key(pem.encode("ascii"))
+        except (AttributeError, ValueError, UnicodeEncodeError) as e:
+            raise KeyFetchError("bad key for kid {}: {}".format(kid, e)) from e
+        if not isinstance(key, EllipticCurvePublicKey):
+            raise KeyFetchError("kid {} is not an EC public key".format(kid))
+        parsed[kid] = key
+    return parsed
+
+
+class KeySnapshot(object):
+    """the last good key set, in a local file.
+
+    the file holds `{"fetched_at": <unix time>, "keys": {kid: pem}}`. It is
+    written to a temporary file next to it and renamed into place, so a
+    reader sees either the old set or the new one, never part of one.
+    """
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+
+    def load(self) -> Union[Tuple[Dict[str, str], float], None]:
+        """`(keys, age in seconds)`, or None if there is no readable
+        snapshot. The keys aren't parsed here."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            raw = data["keys"]
+            fetched_at = float(data["fetched_at"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            tracing.add_field("iapauth.key_snapshot_error", str(e))
+            return None
+        return (raw, max(self.clock() - fetched_at, 0.0))
+
+    def save(self, raw: Dict[str, str]):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".iapauth-keys-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"fetched_at": self.clock(), "keys": raw}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+
+def _spawn_daemon(target: Callable[[], None]):
+    thread = threading.Thread(target=target, name="iapauth-key-refresh")
+    thread.daemon = True
+    thread.start()
+
+
+class KeyStore(object):
+    def __init__(
+        self,
+        fetch: Callable[[], Dict[str, str]] = fetch_public_keys,
+        ttl: float = DEFAULT_KEY_TTL,
+        refetch_interval: float = DEFAULT_KEY_REFETCH_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+        spawn: Callable[[Callable[[], None]], None] = _spawn_daemon,
+        snapshot: Union[KeySnapshot, None] = None,
+        max_backoff: float = DEFAULT_KEY_MAX_BACKOFF,
+    ):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.refetch_interval = refetch_interval
+        self.clock = clock
+        self.spawn = spawn
+        self.snapshot = snapshot
+        self.max_backoff = max_backoff
+        self.raw: Union[Dict[str, str], None] = None
+        self._keys: Dict[str, EllipticCurvePublicKey] = {}
+        self._fetched_at: Union[float, None] = None
+        self._attempted_at: Union[float, None] = None
+        self._fetching = False
+        self._cond = threading.Condition()
+        self.fetches = 0
+        self.fetch_errors = 0
+        # fetches that have failed in a row
+        self.failures = 0
+        if snapshot is not None:
+            self._load_snapshot(snapshot)
+
+    def get(self, kid: Union[str, None]) -> Union[EllipticCurvePublicKey, None]:
+        """the public key for `kid`, or None if there is no such key"""
+        if self._fetched_at is None:
+            self._refetch()
+        elif self.clock() - self._fetched_at >= self.ttl:
+            self._refresh_in_background()
+        if kid is None:
+            return None
+        key = self._keys.get(kid)
+        if key is None:
+            # maybe the keys were rotated since we last looked
+            self._refetch()
+            key = self._keys.get(kid)
+        return key
+
+    async def aget(self, kid: Union[str, None]) -> Union[EllipticCurvePublicKey, None]:
+        """like `get`, but any fetch it needs happens off the event loop"""
+        if self._fetched_at is not None and kid in self._keys:
+            # never blocks: a stale set is refreshed in the background
+            return self.get(kid)
+        return await sync_to_async(self.get, thread_sensitive=False)(kid)
+
+    def set(self, raw: Dict[str, str]):
+        """install a key set without fetching it"""
+        parsed = parse_public_keys(raw)
+        with self._cond:
+            self._install(raw, parsed)
+
+    def refresh(self):
+        """fetch the key set, or wait for a fetch that is already running"""
+        self._refetch(force=True)
+
+    def _refetch(self, force: bool = False):
+        with self._cond:
+            if self._fetching:
+                while self._fetching:
+                    self._cond.wait()
+                return
+            if not force and not self._may_refetch():
+                return
+            self._fetching = True
+        self._do_fetch()
+
+    def reset_after_fork(self):
+        """a forked child doesn't inherit the thread doing a fetch, so it
+        must not wait for it either"""
+        self._cond = threading.Condition()
+        self._fetching = False
+
+    def _may_refetch(self) -> bool:
+        attempted_at = self._attempted_at
+        if attempted_at is None:
+            return True
+        return self.clock() - attempted_at >= self.retry_delay()
+
+    def retry_delay(self) -> float:
+        """seconds to leave after the last fetch before the next one:
+        `refetch_interval`, doubled for each failure in a row after the
+        first, up to `max_backoff`"""
+        if self.failures <= 1:
+            return self.refetch_interval
+        delay = self.refetch_interval * 2 ** min(self.failures - 1, 32)
+        return min(delay, max(self.max_backoff, self.refetch_interval))
+
+    def _refresh_in_background(self):
+        with self._cond:
+            if self._fetching or not self._may_refetch():
+                return
+            self._fetching = True
+        self.spawn(self._do_fetch)
+
+    @tracing.traced("iapauth.keys.KeyStore.fetch")
+    def _do_fetch(self):
+        # the caller has set self._fetching, so we are the only fetcher
+        raw = parsed = None
+        metrics.incr("key_fetch")
+        try:
+            with metrics.timer("key_fetch"):
+                raw = self.fetch()
+                parsed = parse_public_keys(raw)
+        except KeyFetchError as e:
+            tracing.add_field("iapauth.key_fetch_error", str(e))
+        finally:
+            with self._cond:
+                self.fetches += 1
+                self._attempted_at = self.clock()
+                if parsed is None:
+                    self.fetch_errors += 1
+                    self.failures += 1
+                else:
+                    self.failures = 0
+                    self._install(raw, parsed)
+                self._fetching = False
+                self._cond.notify_all()
+        if parsed is not None and self.snapshot is not None:
+            self._save_snapshot(self.snapshot, raw)
+
+    def _load_snapshot(self, snapshot: KeySnapshot):
+        loaded = snapshot.load()
+        if loaded is None:
+            return
+        raw, age = loaded
+        try:
+            parsed = parse_public_keys(raw)
+        except KeyFetchError as e:
+            tracing.add_field("iapauth.key_snapshot_error", str(e))
+            return
+        self.raw = raw
+        self._keys = parsed
+        # as old as it really is, so it gets revalidated once past the ttl
+        self._fetched_at = self.clock() - age
+
+    def _save_snapshot(self, snapshot: KeySnapshot, raw: Dict[str, str]):
+        try:
+            snapshot.save(raw)
+        except (OSError, TypeError, ValueError) as e:
+            # we have the keys in memory; the next worker will fetch its own
+            tracing.add_field("iapauth.key_snapshot_error", str(e))
+
+    def _install(self, raw, parsed):
+        # swap in a whole new dict so readers never see a partial set
+        self.raw = raw
+        self._keys = parsed
+        self._fetched_at = self._attempted_at = self.clock()
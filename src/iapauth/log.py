@@ -0,0 +1,230 @@
+"""
+logging rejected assertions without letting a flood of bad tokens
+flood the logs.
+
+rejections go to the `iapauth.rejections` logger at WARNING. Each reason
+(e.g. "invalid: Signature has expired.") has a token bucket: `burst`
+records straight away, then `rate` a second. What the buckets hold back
+is counted, and the counts go out as one summary record per `interval`
+seconds, on the next rejection after it is up (or on `flush()`, and at
+exit). The summary carries the counts as `record.iapauth_suppressed`.
+
+with `IAPAUTH_LOG_QUEUE`, records from `iapauth.rejections` are put on a
+queue and handed to the `iapauth` logger's handlers (and so up to the
+root logger's) by a listener thread, so formatting and I/O happen off
+the request thread.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Union
+
+from . import conf
+
+
+logger = logging.getLogger("iapauth.rejections")
+
+DEFAULT_RATE = 1.0  # records a second, per reason, once the burst is used
+DEFAULT_BURST = 10
+DEFAULT_INTERVAL = 60  # seconds between summaries
+# distinct reasons tracked at once. The rest are counted as "other".
+MAX_REASONS = 256
+
+
+class RejectionLog(object):
+    def __init__(
+        self,
+        log: logging.Logger = logger,
+        rate: float = DEFAULT_RATE,
+        burst: int = DEFAULT_BURST,
+        interval: float = DEFAULT_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.log = log
+        self.rate = rate
+        self.burst = burst
+        self.interval = interval
+        self.clock = clock
+        # reason -> [tokens, when they were last topped up]
+        self._buckets: Dict[str, List[float]] = {}
+        self._suppressed: Dict[str, int] = {}
+        self._since = clock()
+        self._lock = threading.Lock()
+
+    def record(self, reason: str, detail: Union[str, None] = None):
+        if not self.log.isEnabledFor(logging.WARNING):
+            return
+        if detail is not None:
+            reason = "{}: {}".format(reason, detail)
+        now = self.clock()
+        with self._lock:
+            allowed = self._take(reason, now)
+            if not allowed:
+                key = reason
+                full = len(self._suppressed) >= MAX_REASONS
+                if full and key not in self._suppressed:
+                    key = "other"
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            summary = self._summary(now)
+        if allowed:
+            self.log.warning("rejected IAP assertion: %s", reason)
+        if summary is not None:
+            self._emit(*summary)
+
+    def flush(self):
+        """log the summary now, if anything was held back"""
+        with self._lock:
+            summary = self._summary(self.clock(), force=True)
+        if summary is not None:
+            self._emit(*summary)
+
+    def _take(self, reason: str, now: float) -> bool:
+        bucket = self._buckets.get(reason)
+        if bucket is None:
+            if len(self._buckets) >= MAX_REASONS:
+                # start over rather than grow without bound
+                self._buckets.clear()
+            bucket = self._buckets[reason] = [float(self.burst), now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+    def _summary(self, now: float, force: bool = False):
+        elapsed = now - self._since
+        if not force and elapsed < self.interval:
+            return None
+        self._since = now
+        if not self._suppressed:
+            return None
+        suppressed, self._suppressed = self._suppressed, {}
+        return (suppressed, elapsed)
+
+    def _emit(self, suppressed: Dict[str, int], elapsed: float):
+        self.log.warning(
+            "%d rejected IAP assertions not logged in the last %.0fs: %s",
+            sum(suppressed.values()),
+            elapsed,
+            "; ".join(
+                "{} (x{})".format(reason, n)
+                for reason, n in sorted(suppressed.items(), key=lambda i: -i[1])
+            ),
+            extra={"iapauth_suppressed": suppressed},
+        )
+
+
+# None until the settings have been read
+REJECTION_LOG: Union[RejectionLog, None] = None
+
+
+def rejection_log() -> RejectionLog:
+    global REJECTION_LOG
+
+    if REJECTION_LOG is None:
+        REJECTION_LOG = RejectionLog(
+            rate=conf.get("IAPAUTH_REJECTION_LOG_RATE"),
+            burst=conf.get("IAPAUTH_REJECTION_LOG_BURST"),
+            interval=conf.get("IAPAUTH_REJECTION_LOG_INTERVAL"),
+        )
+    return REJECTION_LOG
+
+
+def _reset_rejection_log():
+    global REJECTION_LOG
+
+    if REJECTION_LOG is not None:
+        REJECTION_LOG.flush()
+    REJECTION_LOG = None
+
+
+class _Forward(logging.Handler):
+    """passes records from the queue on to the `iapauth` logger"""
+
+    def emit(self, record: logging.LogRecord):
+        parent = logging.getLogger("iapauth")
+        if parent.isEnabledFor(record.levelno):
+            parent.handle(record)
+
+
+# the listener thread, while IAPAUTH_LOG_QUEUE is on
+LISTENER: Union[logging.handlers.QueueListener, None] = None
+_queue_handler: Union[logging.handlers.QueueHandler, None] = None
+# `logger.propagate` from before the queue was started
+_propagate = True
+
+
+def start_queue():
+    """send `iapauth.rejections` records through a queue and a listener
+    thread. A no-op if they already are."""
+    global LISTENER, _queue_handler, _propagate
+
+    if LISTENER is not None:
+        return
+    _propagate = logger.propagate
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _queue_handler = logging.handlers.QueueHandler(records)
+    LISTENER = logging.handlers.QueueListener(records, _Forward())
+    LISTENER.start()
+    logger.addHandler(_queue_handler)
+    logger.propagate = False
+
+
+def stop_queue():
+    """log straight from the request thread again, once everything
+    queued has been handled"""
+    global LISTENER, _queue_handler
+
+    if LISTENER is None:
+        return
+    logger.removeHandler(_queue_handler)
+    logger.propagate = _propagate
+    LISTENER.stop()
+    LISTENER = _queue_handler = None
+
+
+def configure():
+    """start or stop the queue to match IAPAUTH_LOG_QUEUE"""
+    if conf.get("IAPAUTH_LOG_QUEUE"):
+        start_queue()
+    else:
+        stop_queue()
+
+
+def _after_fork():
+    global LISTENER, _queue_handler
+
+    # the listener thread didn't come with us
+    if LISTENER is not None:
+        logger.removeHandler(_queue_handler)
+        logger.propagate = _propagate
+        LISTENER = _queue_handler = None
+        start_queue()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+@atexit.register
+def _at_exit():
+    if REJECTION_LOG is not None:
+        REJECTION_LOG.flush()
+    stop_queue()
+
+
+conf.on_change(
+    (
+        "IAPAUTH_REJECTION_LOG_RATE",
+        "IAPAUTH_REJECTION_LOG_BURST",
+        "IAPAUTH_REJECTION_LOG_INTERVAL",
+    ),
+    _reset_rejection_log,
+)
+conf.on_change(("IAPAUTH_LOG_QUEUE",), configure)
@@ -0,0 +1,114 @@
+import argparse
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from iapauth import conf
+from iapauth.audit import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_WINDOW,
+    audit,
+    load_key_file,
+)
+from iapauth.keys import KeyFetchError
+
+
+class Command(BaseCommand):
+    help = (
+        "Verify the IAP assertions in a file (e.g. an access log) against a"
+        " saved key set, without the network, and write one JSON line per"
+        " distinct assertion."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file",
+            nargs="?",
+            type=argparse.FileType("r"),
+            default="-",
+            help="lines containing assertions, - (the default) for stdin",
+        )
+        parser.add_argument(
+            "--keys",
+            required=True,
+            help="the key set to verify against: a saved copy of Google's"
+            " {kid: pem} file, or an IAPAUTH_KEY_SNAPSHOT file",
+        )
+        parser.add_argument(
+            "--audience", help="the expected aud (default JWT_AUDIENCE)"
+        )
+        parser.add_argument(
+            "--output",
+            type=argparse.FileType("w"),
+            help="a file to write the results to, instead of stdout",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=None,
+            help="worker processes (default one per CPU)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help="assertions per task (default {})".format(DEFAULT_CHUNK_SIZE),
+        )
+        parser.add_argument(
+            "--window",
+            type=int,
+            default=DEFAULT_WINDOW,
+            help="distinct assertions remembered to skip repeats (default"
+            " {})".format(DEFAULT_WINDOW),
+        )
+        parser.add_argument(
+            "--check-expiry",
+            action="store_true",
+            help="reject assertions that have expired by now, rather than"
+            " judging each as of when it was issued",
+        )
+
+    def handle(self, *args, **options):
+        for name in ("processes", "chunk_size", "window"):
+            if options[name] is not None and options[name] < 1:
+                raise CommandError(
+                    "--{} must be at least 1".format(name.replace("_", "-"))
+                )
+        audience = options["audience"] or conf.get("JWT_AUDIENCE")
+        if not audience:
+            raise CommandError("--audience is required when JWT_AUDIENCE isn't set")
+        try:
+            keys = load_key_file(options["keys"])
+        except (OSError, ValueError, KeyFetchError) as e:
+            raise CommandError("can't load {}: {}".format(options["keys"], e))
+
+        lines, output = options["file"], options["output"]
+        write = self.stdout.write if output is None else output.write
+        totals = {}
+        start = time.monotonic()
+        try:
+            for result in audit(
+                lines,
+                keys,
+                audience,
+                processes=options["processes"],
+                chunk_size=options["chunk_size"],
+                window=options["window"],
+                check_expiry=options["check_expiry"],
+                totals=totals,
+            ):
+                write(json.dumps(result) + "\n")
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+            if output is not None:
+                output.close()
+        if options["verbosity"] > 0:
+            # stdout may be the results
+            self.stderr.write(
+                "{lines} lines, {tokens} assertions ({repeated} repeats skipped):"
+                " {valid} valid, {invalid} invalid".format(**totals)
+                + " ({:.1f}s)".format(time.monotonic() - start)
+            )
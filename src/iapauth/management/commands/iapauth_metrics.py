@@ -0,0 +1,72 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from iapauth import metrics
+from iapauth.fetch import FetchError, get_json
+
+
+class Command(BaseCommand):
+    help = (
+        "Print iapauth's metrics. The registry is per process, so to see a"
+        " running server's use --url with the address of"
+        " iapauth.views.metrics."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format", choices=("text", "json", "prometheus"), default="text"
+        )
+        parser.add_argument(
+            "--url", help="read the metrics from this iapauth.views.metrics URL"
+        )
+
+    def handle(self, *args, **options):
+        data = metrics.snapshot()
+        if options["url"]:
+            try:
+                data = get_json(options["url"] + "?format=json")
+            except FetchError as e:
+                raise CommandError(str(e))
+        if options["format"] == "json":
+            self.stdout.write(json.dumps(data, indent=2, sort_keys=True))
+        elif options["format"] == "prometheus":
+            self.stdout.write(metrics.prometheus(data), ending="")
+        else:
+            self.write_text(data)
+
+    def write_text(self, data):
+        if not metrics.enabled() and not self._has_data(data):
+            self.stdout.write("metrics are off (IAPAUTH_METRICS)")
+        for name, value in data["counters"].items():
+            self.stdout.write("{:<24} {:>10}".format(name, value))
+        self.stdout.write("")
+        self.stdout.write(
+            "{:<24} {:>10} {:>10} {:>10} {:>10}".format(
+                "phase", "count", "mean ms", "p50 ms", "p99 ms"
+            )
+        )
+        for name, h in data["histograms"].items():
+            count = sum(h["counts"])
+            mean = h["sum"] / count if count else 0.0
+            self.stdout.write(
+                "{:<24} {:>10} {:>10.3f} {:>10} {:>10}".format(
+                    name,
+                    count,
+                    mean * 1e3,
+                    self._ms(metrics.quantile(h, 0.5)),
+                    self._ms(metrics.quantile(h, 0.99)),
+                )
+            )
+
+    def _has_data(self, data) -> bool:
+        return any(data["counters"].values()) or any(
+            sum(h["counts"]) for h in data["histograms"].values()
+        )
+
+    def _ms(self, seconds) -> str:
+        if seconds is None:
+            return "-"
+        if seconds == float("inf"):
+            return "inf"
+        return "<={:g}".format(seconds * 1e3)
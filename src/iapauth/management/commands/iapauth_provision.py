@@ -0,0 +1,61 @@
+import argparse
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from iapauth.backends import provision_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Create users for a list of email addresses, one per line, before"
+        " they first log in through IAP. Existing users are updated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "file",
+            nargs="?",
+            type=argparse.FileType("r"),
+            default="-",
+            help="file of email addresses, - (the default) for stdin",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="addresses to read and write at a time (default 1000)",
+        )
+        parser.add_argument(
+            "--domain-from-email",
+            action="store_true",
+            help="apply the role policy's domain rules (and"
+            " IAP_JWT_ADMIN_DOMAIN) by each email's domain. Only for"
+            " Workspace accounts: a personal account can have any address.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        lines = options["file"]
+        start = time.monotonic()
+        try:
+            for totals in provision_users(
+                lines,
+                options["batch_size"],
+                domain_from_email=options["domain_from_email"],
+            ):
+                if options["verbosity"] > 0:
+                    self.stdout.write(self._summary(totals, start))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+
+    def _summary(self, totals, start) -> str:
+        elapsed = time.monotonic() - start
+        return (
+            "{read} read, {created} created, {updated} updated,"
+            " {unchanged} unchanged, {skipped} skipped".format(**totals)
+            + " ({:.1f}s)".format(elapsed)
+        )
@@ -0,0 +1,226 @@
+"""
+in-process counters and latency histograms for the middleware.
+
+turn them on with `IAPAUTH_METRICS = True`. Each process keeps its own
+registry; read it with `snapshot()`, render it for Prometheus with
+`prometheus()` (or mount `iapauth.views.metrics`), or dump it with
+`manage.py iapauth_metrics`.
+
+when metrics are off, `incr()` and `timer()` return after checking a
+module global, and `timer()` hands back a shared do-nothing context
+manager.
+"""
+import bisect
+import os
+import threading
+import time
+from typing import Any, Dict, List, Sequence, Union
+
+from .cache import Counters
+
+
+# outcomes counted by the middleware
+EVENTS = (
+    "no_token",
+    "authenticated",
+    "rejected",
+    "already_authenticated",
+    "session_bound",
+    "user_switch",
+    "key_fetch",
+    "audience_fetch",
+)
+# phases timed by the middleware
+PHASES = ("verify", "key_fetch", "resolve_user", "login")
+
+# upper bounds, in seconds. Verification is tens to hundreds of
+# microseconds; fetches and logins are milliseconds.
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram(object):
+    """counts of observations in fixed buckets, plus their sum"""
+
+    def __init__(self, buckets: Sequence[float] = BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for observations above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        return {"buckets": list(self.buckets), "counts": counts, "sum": total}
+
+    def clear(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.sum = 0.0
+
+
+class _Timer(object):
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+COUNTERS = Counters()
+HISTOGRAMS: Dict[str, Histogram] = {name: Histogram() for name in PHASES}
+# None until IAPAUTH_METRICS has been looked up
+ENABLED: Union[bool, None] = None
+
+
+def enabled() -> bool:
+    global ENABLED
+
+    if ENABLED is None:
+        # imported here because conf imports modules that record metrics
+        from . import conf
+
+        ENABLED = bool(conf.get("IAPAUTH_METRICS"))
+    return ENABLED
+
+
+def reset_enabled():
+    global ENABLED
+    ENABLED = None
+
+
+def _after_fork():
+    global COUNTERS, HISTOGRAMS
+
+    # a worker reports its own numbers, and mustn't inherit a held lock
+    COUNTERS = Counters()
+    HISTOGRAMS = {name: Histogram() for name in PHASES}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def incr(event: str, n: int = 1):
+    if ENABLED or (ENABLED is None and enabled()):
+        COUNTERS.incr(event, n)
+
+
+def timer(phase: str):
+    """`with timer("verify"): ...` records how long the block took"""
+    if ENABLED or (ENABLED is None and enabled()):
+        return _Timer(HISTOGRAMS[phase])
+    return NULL_TIMER
+
+
+def snapshot() -> Dict[str, Any]:
+    counts = COUNTERS.snapshot()
+    return {
+        "counters": {name: counts.get(name, 0) for name in EVENTS},
+        "histograms": {name: h.snapshot() for name, h in HISTOGRAMS.items()},
+    }
+
+
+def clear():
+    COUNTERS.clear()
+    for histogram in HISTOGRAMS.values():
+        histogram.clear()
+
+
+def quantile(histogram: Dict[str, Any], q: float) -> Union[float, None]:
+    """the upper bound of the bucket holding the `q` quantile of a
+    histogram snapshot, or None if it is empty"""
+    counts = histogram["counts"]
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bound, count in zip(list(histogram["buckets"]) + [float("inf")], counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+def _format(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def prometheus(data: Union[Dict[str, Any], None] = None) -> str:
+    """`snapshot()` (or `data`) in the Prometheus text exposition format"""
+    if data is None:
+        data = snapshot()
+    lines: List[str] = [
+        "# HELP iapauth_events_total Requests and fetches by outcome.",
+        "# TYPE iapauth_events_total counter",
+    ]
+    for name, value in sorted(data["counters"].items()):
+        lines.append('iapauth_events_total{{event="{}"}} {}'.format(name, value))
+    lines += [
+        "# HELP iapauth_phase_seconds Time spent in each phase.",
+        "# TYPE iapauth_phase_seconds histogram",
+    ]
+    for name, h in sorted(data["histograms"].items()):
+        cumulative = 0
+        bounds = list(h["buckets"]) + [float("inf")]
+        for bound, count in zip(bounds, h["counts"]):
+            cumulative += count
+            lines.append(
+                'iapauth_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                    name, _format(bound), cumulative
+                )
+            )
+        lines.append(
+            'iapauth_phase_seconds_sum{{phase="{}"}} {}'.format(name, repr(h["sum"]))
+        )
+        lines.append(
+            'iapauth_phase_seconds_count{{phase="{}"}} {}'.format(name, cumulative)
+        )
+    return "\n".join(lines) + "\n"
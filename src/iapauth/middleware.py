@@ -1,22 +1,43 @@
+import hashlib
+import hmac
+import logging
 import os
-from typing import Tuple, Union
+import sys
+import threading
+import time
+from functools import partial
+from typing import Any, Dict, List, Tuple, Union
 
-import jose  # type: ignore
-import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth import load_backend
 from django.contrib.auth.backends import RemoteUserBackend
+from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpRequest
 from django.utils.deprecation import MiddlewareMixin
-from jose import jwt  # type: ignore
-
-
-try:
-    import beeline  # type: ignore
-except ImportError:
-    import iapauth.instrumentation as beeline  # type: ignore
+from django.utils.functional import SimpleLazyObject
+from jose import jwk, jwt  # type: ignore
+from jose.exceptions import JOSEError, JWTClaimsError, JWTError  # type: ignore
+
+from . import conf, log, metrics, tracing
+from .cache import Counters, TTLCache, token_digest
+from .claims import IAPClaims
+from .fetch import FetchError, get_json
+from .keys import KeySnapshot, KeyStore, fetch_public_keys, parse_public_keys
+from .paths import PathMatcher
+from .shared import SharedFetcher, cache_key
+from .verify import (
+    ALGORITHM,
+    ISSUER,
+    REQUIRED_CLAIM_OPTIONS,
+    decode_claims,
+    inspect_token,
+    split_token,
+    validate_claims,
+    verify_signature,
+)
 
 
 class JWTRequest(HttpRequest):
@@ -25,167 +46,936 @@ class JWTRequest(HttpRequest):
     jwt_user_email: Union[str, None]
     jwt_domain: Union[str, None]
     jwt_authenticated: bool
+    iap_claims: Union[IAPClaims, None]
+
 
+logger = logging.getLogger(__name__)
 
-KEYS: Union[dict, None] = None  # Cached public keys for verification
+KEY_STORE: Union[KeyStore, None] = None  # Public keys for verification
 AUDIENCE: Union[
     str, None
 ] = None  # Cached value requiring information from metadata server
+_audience_lock = threading.Lock()
+# the project number never changes, so other workers can reuse it for long
+AUDIENCE_SHARED_TTL = 24 * 60 * 60
+# IAP re-sends the same assertion on every request from a browser for
+# several minutes, so even a small cache of verified assertions takes
+# signature verification off almost every request.
+TOKEN_CACHE: Union[TTLCache, None] = None
+# Recently rejected assertions, so replaying a bad token doesn't cost a
+# signature verification every time.
+NEGATIVE_CACHE: Union[TTLCache, None] = None
+# why assertions were rejected, e.g. REJECTIONS.get("malformed")
+REJECTIONS = Counters()
+# Compiled path patterns, keyed on the setting they come from.
+PATH_MATCHERS: Dict[str, PathMatcher] = {}
+PATH_SETTINGS = (
+    "IAPAUTH_INCLUDE_PATHS",
+    "IAPAUTH_EXCLUDE_PATHS",
+    "IAPAUTH_STATELESS_PATHS",
+)
+# where iapauth.gate leaves the claims it verified, in the WSGI environ
+# (so request.META) or the ASGI scope (request.scope)
+GATE_CLAIMS = "iapauth.claims"
+# where IAPAUTH_SESSION_BINDING keeps the assertion a session was last
+# verified with
+SESSION_BINDING_KEY = "_iapauth_binding"
+
+
+def _shared(name, source, fetch, ttl, validate=None):
+    """share `fetch` through IAPAUTH_SHARED_CACHE, if there is one"""
+    alias = conf.get("IAPAUTH_SHARED_CACHE")
+    if alias is None:
+        return fetch
+    return SharedFetcher(
+        alias,
+        cache_key(name, source),
+        fetch,
+        ttl,
+        validate=validate,
+        lock_timeout=conf.get("IAPAUTH_SHARED_CACHE_LOCK_TIMEOUT"),
+    )
+
+
+# Google publishes the public keys needed to verify a JWT. Keep them in
+# KEY_STORE, which refreshes them when they get old or rotate.
+def key_store() -> KeyStore:
+    global KEY_STORE
+
+    if KEY_STORE is None:
+        url = conf.get("IAPAUTH_PUBLIC_KEY_URL")
+        timeout = conf.get("IAPAUTH_FETCH_TIMEOUT")
+        ttl = conf.get("IAPAUTH_KEY_TTL")
+        snapshot_path = conf.get("IAPAUTH_KEY_SNAPSHOT")
+        KEY_STORE = KeyStore(
+            fetch=_shared(
+                "keys",
+                url,
+                lambda: fetch_public_keys(url, timeout),
+                ttl,
+                validate=parse_public_keys,
+            ),
+            ttl=ttl,
+            refetch_interval=conf.get("IAPAUTH_KEY_REFETCH_INTERVAL"),
+            snapshot=KeySnapshot(snapshot_path) if snapshot_path else None,
+            max_backoff=conf.get("IAPAUTH_KEY_MAX_BACKOFF"),
+        )
+
+    return KEY_STORE
 
 
-# Google publishes the public keys needed to verify a JWT. Save them in KEYS.
-@beeline.traced(name="iapauth.middleware.keys")
+# the raw `{kid: pem}` mapping as published by Google
+@tracing.traced("iapauth.middleware.keys")
 def keys() -> Union[dict, None]:
-    global KEYS
+    store = key_store()
+    if store.raw is None:
+        store.refresh()
+    return store.raw
 
-    if KEYS is None:
-        resp = requests.get("https://www.gstatic.com/iap/verify/public_key")
-        KEYS = resp.json()
 
-    return KEYS
+async def akeys() -> Union[dict, None]:
+    """async version of `keys`. Only a fetch leaves the event loop."""
+    store = key_store()
+    if store.raw is None:
+        await sync_to_async(store.refresh, thread_sensitive=False)()
+    return store.raw
 
 
 # Returns the JWT "audience" that should be in the assertion
-@beeline.traced(name="iapauth.middleware.gcp_jwt_audience")
+@tracing.traced("iapauth.middleware.gcp_jwt_audience")
 def gcp_jwt_audience() -> Union[str, None]:
     global AUDIENCE
 
     if AUDIENCE is None:
-        project_id = os.getenv("GOOGLE_CLOUD_PROJECT", None)
+        # concurrent first callers wait for one fetch
+        with _audience_lock:
+            if AUDIENCE is None:
+                project_id = os.getenv("GOOGLE_CLOUD_PROJECT", None)
+                endpoint = conf.get("IAPAUTH_METADATA_URL")
+                fetch = _shared(
+                    "audience",
+                    "{} {}".format(endpoint, project_id),
+                    lambda: _fetch_audience(endpoint, project_id),
+                    AUDIENCE_SHARED_TTL,
+                )
+                AUDIENCE = fetch()
 
-        endpoint = "http://metadata.google.internal"
-        path = "/computeMetadata/v1/project/numeric-project-id"
-        response = requests.get(
-            "{}/{}".format(endpoint, path), headers={"Metadata-Flavor": "Google"}
-        )
-        project_number = response.json()
+    return AUDIENCE
 
-        AUDIENCE = "/projects/{}/apps/{}".format(project_number, project_id)
 
-    return AUDIENCE
+def _fetch_audience(endpoint: str, project_id: Union[str, None]) -> str:
+    path = "/computeMetadata/v1/project/numeric-project-id"
+    metrics.incr("audience_fetch")
+    project_number = get_json(
+        "{}/{}".format(endpoint, path),
+        headers={"Metadata-Flavor": "Google"},
+        timeout=conf.get("IAPAUTH_FETCH_TIMEOUT"),
+    )
+
+    return "/projects/{}/apps/{}".format(project_number, project_id)
+
+
+async def agcp_jwt_audience() -> Union[str, None]:
+    """async version of `gcp_jwt_audience`. Only a fetch leaves the event loop."""
+    if AUDIENCE is not None:
+        return AUDIENCE
+    return await sync_to_async(gcp_jwt_audience, thread_sensitive=False)()
+
+
+# Verified assertions, keyed on a digest of the raw token. Set
+# IAPAUTH_TOKEN_CACHE_SIZE to 0 to disable.
+def token_cache() -> Union[TTLCache, None]:
+    global TOKEN_CACHE
+
+    if TOKEN_CACHE is None:
+        size = conf.get("IAPAUTH_TOKEN_CACHE_SIZE")
+        if size <= 0:
+            return None
+        TOKEN_CACHE = TTLCache(size)
+
+    return TOKEN_CACHE
+
+
+# Assertions that recently failed verification. Set
+# IAPAUTH_NEGATIVE_CACHE_SIZE to 0 to disable.
+def negative_cache() -> Union[TTLCache, None]:
+    global NEGATIVE_CACHE
+
+    if NEGATIVE_CACHE is None:
+        size = conf.get("IAPAUTH_NEGATIVE_CACHE_SIZE")
+        if size <= 0:
+            return None
+        NEGATIVE_CACHE = TTLCache(size)
+
+    return NEGATIVE_CACHE
+
+
+def _reject(reason: str, detail: Union[str, None] = None) -> Union[IAPClaims, None]:
+    REJECTIONS.incr(reason)
+    tracing.add_field("iapauth.rejected", reason)
+    tracing.fail()
+    log.rejection_log().record(reason, detail)
+    return None
+
+
+def _result(
+    claims: Union[IAPClaims, None]
+) -> Tuple[bool, Union[str, None], Union[str, None]]:
+    if claims is None:
+        return (False, None, None)
+    return (True, claims.email, claims.hd)
 
 
 class JWTAuthenticator(object):
-    @beeline.traced(name="iapauth.middleware.JWTAuthenticator.authenticate")
+    """
+    `verify()` returns the claims of a valid assertion, or None. The
+    middleware uses it when an authenticator has it, and otherwise falls
+    back to `authenticate()`'s `(valid, email, hd)`.
+    """
+
     def authenticate(
         self, jwt_token, audience: str
     ) -> Tuple[bool, Union[str, None], Union[str, None]]:
+        return _result(self.verify(jwt_token, audience))
+
+    async def aauthenticate(
+        self, jwt_token, audience: str
+    ) -> Tuple[bool, Union[str, None], Union[str, None]]:
+        return _result(await self.averify(jwt_token, audience))
+
+    @tracing.traced("iapauth.middleware.JWTAuthenticator.verify")
+    def verify(self, jwt_token, audience: str) -> Union[IAPClaims, None]:
+        digest, claims = self._cached(jwt_token, audience)
+        if digest is None or claims is not None:
+            return claims
+        reason, kid = inspect_token(jwt_token)
+        if reason is not None:
+            return _reject(reason)
+        if key_store().get(kid) is None:
+            return _reject("unknown_kid")
+        return self._verify(jwt_token, audience, digest)
+
+    async def averify(self, jwt_token, audience: str) -> Union[IAPClaims, None]:
+        digest, claims = self._cached(jwt_token, audience)
+        if digest is None or claims is not None:
+            return claims
+        reason, kid = inspect_token(jwt_token)
+        if reason is not None:
+            return _reject(reason)
+        # any key fetch this token needs happens off the event loop, so
+        # verifying it below never blocks
+        if await key_store().aget(kid) is None:
+            return _reject("unknown_kid")
+        return self._verify(jwt_token, audience, digest)
+
+    def _cached(self, jwt_token, audience: str):
+        """returns `(digest, claims)`. The digest is None if the token can be
+        rejected without verifying it, and the claims are set if it was
+        verified before."""
+        if len(jwt_token) > conf.get("IAPAUTH_MAX_TOKEN_LENGTH"):
+            return (None, _reject("too_long"))
+        digest = token_digest(jwt_token, audience)
+        cache = token_cache()
+        if cache is not None:
+            cached = cache.get(digest)
+            if cached is not None:
+                tracing.add_field("iapauth.token_cache_hit", True)
+                return (digest, cached)
+        negative = negative_cache()
+        if negative is not None and negative.get(digest) is not None:
+            return (None, _reject("recently_rejected"))
+        return (digest, None)
+
+    def _verify(self, jwt_token, audience: str, digest) -> Union[IAPClaims, None]:
         try:
-            info = jwt.decode(
-                jwt_token,
-                keys(),
-                algorithms=["ES256"],
-                audience=audience,
-            )
-            return (True, info["email"], info.get("hd"))
-        except jose.exceptions.JOSEError as e:
-            # log it
-            print("bad JWT: {}".format(e))
-        return (False, None, None)
+            info = self.decode(jwt_token, audience)
+            if not isinstance(info.get("email"), str):
+                raise JWTClaimsError("missing email claim")
+        except JOSEError as e:
+            negative = negative_cache()
+            if negative is not None:
+                ttl = conf.get("IAPAUTH_NEGATIVE_CACHE_TTL")
+                negative.set(digest, True, negative.clock() + ttl)
+            return _reject("invalid", str(e))
+        claims = IAPClaims(info)
+        cache = token_cache()
+        if cache is not None:
+            margin = conf.get("IAPAUTH_TOKEN_CACHE_MARGIN")
+            expires_at = int(info["exp"]) - margin
+            cache.set(digest, claims, expires_at)
+        return claims
+
+    def decode(self, jwt_token, audience: str) -> dict:
+        """verify the assertion and return its claims, or raise JOSEError"""
+        kid = jwt.get_unverified_header(jwt_token).get("kid")
+        key = key_store().get(kid)
+        if key is None:
+            raise JWTError("unknown kid: {}".format(kid))
+        return jwt.decode(
+            jwt_token,
+            jwk.construct(key, ALGORITHM),
+            algorithms=[ALGORITHM],
+            audience=audience,
+            issuer=ISSUER,
+            options=REQUIRED_CLAIM_OPTIONS,
+        )
+
+
+class ES256Authenticator(JWTAuthenticator):
+    """verifies the signature directly with `cryptography`
+
+    accepts exactly the tokens that `JWTAuthenticator` accepts, but skips
+    python-jose's generic JWS/JWT processing.
+    """
+
+    def decode(self, jwt_token, audience: str) -> dict:
+        header, header_segment, payload_segment, signature = split_token(jwt_token)
+        key = key_store().get(header.get("kid"))
+        if key is None:
+            raise JWTError("unknown kid: {}".format(header.get("kid")))
+        verify_signature(key, header_segment, payload_segment, signature)
+        claims = decode_claims(payload_segment)
+        validate_claims(claims, audience)
+        return claims
 
 
 class StubAuthenticator(object):
-    """stub for testing"""
+    """stub for testing. `claims` are added to the `email` and `hd` ones."""
 
     def __init__(
         self,
         status: bool = True,
         email: Union[str, None] = "foo@example.com",
         domain: Union[str, None] = "example.com",
+        claims: Union[Dict[str, Any], None] = None,
     ):
         self.response = (status, email, domain)
+        self.claims = claims or {}
 
     def authenticate(
         self, jwt_token, audience: str
     ) -> Tuple[bool, Union[str, None], Union[str, None]]:
         return self.response
 
+    async def aauthenticate(
+        self, jwt_token, audience: str
+    ) -> Tuple[bool, Union[str, None], Union[str, None]]:
+        return self.response
 
-class IAPJWTAuthMiddleware(MiddlewareMixin):
-    @beeline.traced(name="iapauth.middleware.IAPJWTAuthMiddleware.process_request")
-    def process_request(self, request: JWTRequest):
-        # AuthenticationMiddleware is required so that request.user exists.
-        if not hasattr(request, "user"):
-            beeline.add_context_field("iapauth.invalid_configuration", True)
-            raise ImproperlyConfigured(
-                "The Django remote user auth middleware requires the"
-                " authentication middleware to be installed.  Edit your"
-                " MIDDLEWARE setting to insert"
-                " 'django.contrib.auth.middleware.AuthenticationMiddleware'"
-                " before the RemoteUserMiddleware class."
-            )
-        request.jwt_user_email = None
-        request.jwt_domain = None
-        request.jwt_authenticated = False
+    def verify(self, jwt_token, audience: str) -> Union[IAPClaims, None]:
+        return _claims(self.authenticate(jwt_token, audience), self.claims)
 
-        jwt_token = request.META.get("HTTP_X_GOOG_IAP_JWT_ASSERTION", None)
+    async def averify(self, jwt_token, audience: str) -> Union[IAPClaims, None]:
+        return _claims(await self.aauthenticate(jwt_token, audience), self.claims)
 
-        if not jwt_token:
-            # no token. We have no responsibility here
-            beeline.add_context_field("iapauth.no_token", True)
+
+def verify(authenticator, jwt_token, audience) -> Union[IAPClaims, None]:
+    """the claims of a valid assertion from any authenticator, or None"""
+    if hasattr(authenticator, "verify"):
+        return authenticator.verify(jwt_token, audience)
+    return _claims(authenticator.authenticate(jwt_token, audience))
+
+
+async def averify(authenticator, jwt_token, audience) -> Union[IAPClaims, None]:
+    if hasattr(authenticator, "averify"):
+        return await authenticator.averify(jwt_token, audience)
+    if hasattr(authenticator, "aauthenticate"):
+        return _claims(await authenticator.aauthenticate(jwt_token, audience))
+    return await sync_to_async(verify)(authenticator, jwt_token, audience)
+
+
+def _claims(result, extra: Union[Dict[str, Any], None] = None):
+    """claims for an authenticator that only gives us `(valid, email, hd)`"""
+    authenticated, email, domain = result
+    if not authenticated:
+        return None
+    claims: Dict[str, Any] = {"email": email}
+    if domain is not None:
+        claims["hd"] = domain
+    if extra:
+        claims.update(extra)
+    return IAPClaims(claims)
+
+
+def jwt_audience() -> Union[str, None]:
+    return conf.get("JWT_AUDIENCE") or gcp_jwt_audience()
+
+
+async def ajwt_audience() -> Union[str, None]:
+    return conf.get("JWT_AUDIENCE") or await agcp_jwt_audience()
+
+
+_default_authenticator = JWTAuthenticator()
+
+
+def get_authenticator():
+    # we can override the authenticator for testing
+    return conf.get("IAPAUTH_JWT_AUTHENTICATOR") or _default_authenticator
+
+
+def warm_up():
+    """resolve the audience and fetch the key set now, instead of in the
+    first request that needs them.
+
+    with IAPAUTH_WARM_UP this runs in the background when the app starts
+    in a process that serves requests. Forked workers inherit whatever it
+    had fetched by then. It can also be called from e.g. gunicorn's
+    `post_fork` hook.
+    """
+    try:
+        jwt_audience()
+        key_store().get(None)
+    except FetchError as e:
+        # the first request will try again
+        logger.warning("iapauth warm up failed: %s", e)
+
+
+# management commands that serve requests, and so are worth warming up
+SERVER_COMMANDS = ("runserver", "runserver_plus")
+
+
+def serves_requests(argv: Union[List[str], None] = None) -> bool:
+    """False if this process is running a management command other than
+    SERVER_COMMANDS, e.g. `migrate` or `iapauth_audit`"""
+    if argv is None:
+        argv = sys.argv
+    program = os.path.normpath(argv[0]) if argv else ""
+    if not program.endswith(
+        ("manage.py", "django-admin", os.path.join("django", "__main__.py"))
+    ):
+        return True
+    return len(argv) > 1 and argv[1] in SERVER_COMMANDS
+
+
+def start_warm_up() -> threading.Thread:
+    thread = threading.Thread(target=warm_up, name="iapauth-warm-up")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _after_fork():
+    global _audience_lock, TOKEN_CACHE, NEGATIVE_CACHE
+
+    # locks held by threads of the parent would never be released here
+    _audience_lock = threading.Lock()
+    TOKEN_CACHE = NEGATIVE_CACHE = None
+    if KEY_STORE is not None:
+        KEY_STORE.reset_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _reset_key_store():
+    global KEY_STORE
+    KEY_STORE = None
+
+
+def _reset_audience():
+    global AUDIENCE
+    AUDIENCE = None
+
+
+def _reset_token_cache():
+    global TOKEN_CACHE
+    TOKEN_CACHE = None
+
+
+def _reset_negative_cache():
+    global NEGATIVE_CACHE
+    NEGATIVE_CACHE = None
+
+
+def _reset_path_matchers():
+    PATH_MATCHERS.clear()
+
+
+conf.on_change(
+    (
+        "IAPAUTH_PUBLIC_KEY_URL",
+        "IAPAUTH_KEY_TTL",
+        "IAPAUTH_KEY_REFETCH_INTERVAL",
+        "IAPAUTH_KEY_MAX_BACKOFF",
+        "IAPAUTH_KEY_SNAPSHOT",
+        "IAPAUTH_FETCH_TIMEOUT",
+        "IAPAUTH_SHARED_CACHE",
+        "IAPAUTH_SHARED_CACHE_LOCK_TIMEOUT",
+    ),
+    _reset_key_store,
+)
+conf.on_change(("IAPAUTH_METADATA_URL", "IAPAUTH_SHARED_CACHE"), _reset_audience)
+conf.on_change(("IAPAUTH_TOKEN_CACHE_SIZE",), _reset_token_cache)
+conf.on_change(("IAPAUTH_NEGATIVE_CACHE_SIZE",), _reset_negative_cache)
+conf.on_change(PATH_SETTINGS, _reset_path_matchers)
+conf.on_change(("IAPAUTH_METRICS",), metrics.reset_enabled)
+conf.on_change(("IAPAUTH_TRACE_SAMPLE_RATE",), tracing.reset_rate)
+
+
+async def _aauthenticate_user(request, **credentials):
+    if hasattr(auth, "aauthenticate"):  # Django >= 5.0
+        return await auth.aauthenticate(request, **credentials)
+    return await sync_to_async(auth.authenticate)(request, **credentials)
+
+
+async def _alogin(request, user):
+    if hasattr(auth, "alogin"):  # Django >= 5.0
+        return await auth.alogin(request, user)
+    return await sync_to_async(auth.login)(request, user)
+
+
+async def _aget_user(request):
+    if hasattr(request, "auser"):  # Django >= 5.0
+        return await request.auser()
+    # resolve the lazy request.user in a thread so it doesn't hit the
+    # database from the event loop
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+
+def path_matcher(setting: str) -> PathMatcher:
+    try:
+        return PATH_MATCHERS[setting]
+    except KeyError:
+        matcher = PATH_MATCHERS[setting] = PathMatcher(conf.get(setting))
+        return matcher
+
+
+def is_excluded(request: HttpRequest) -> bool:
+    """whether the middleware should leave this request alone entirely"""
+    return is_excluded_path(request.path_info)
+
+
+def is_excluded_path(path: str) -> bool:
+    include = path_matcher("IAPAUTH_INCLUDE_PATHS")
+    if include and not include.match(path):
+        return True
+    return path_matcher("IAPAUTH_EXCLUDE_PATHS").match(path)
+
+
+def gated_claims(request: HttpRequest) -> Union[IAPClaims, None]:
+    """the claims iapauth.gate already verified for this request, if it
+    went through one"""
+    claims = request.META.get(GATE_CLAIMS)
+    if claims is None:
+        claims = getattr(request, "scope", {}).get(GATE_CLAIMS)
+    return claims if isinstance(claims, IAPClaims) else None
+
+
+def session_digest(jwt_token: str, audience: str) -> str:
+    """an HMAC of the assertion and audience keyed with SECRET_KEY, kept
+    in the session instead of the assertion itself"""
+    secret = settings.SECRET_KEY.encode("utf-8")
+    key = hashlib.sha256(b"iapauth.session-binding\0" + secret).digest()
+    message = token_digest(jwt_token, audience)
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+def bound_claims(
+    request: HttpRequest, jwt_token: str, audience: str
+) -> Union[IAPClaims, None]:
+    """the claims bound to the session by an earlier request with this
+    same assertion, unless it is about to expire"""
+    session = getattr(request, "session", None)
+    bound = None if session is None else session.get(SESSION_BINDING_KEY)
+    if not isinstance(bound, dict):
+        return None
+    digest = session_digest(jwt_token, audience)
+    if not hmac.compare_digest(str(bound.get("digest")), digest):
+        return None
+    exp = bound.get("exp")
+    margin = conf.get("IAPAUTH_TOKEN_CACHE_MARGIN")
+    if not isinstance(exp, int) or time.time() >= exp - margin:
+        return None
+    return IAPClaims(bound["claims"])
+
+
+def bind_to_session(
+    request: HttpRequest, jwt_token: str, audience: str, claims: IAPClaims
+):
+    """let later requests in this session with the same assertion skip
+    verifying it"""
+    if not isinstance(claims.exp, int):
+        return
+    digest = session_digest(jwt_token, audience)
+    bound = request.session.get(SESSION_BINDING_KEY)
+    if isinstance(bound, dict) and bound.get("digest") == digest:
+        return
+    request.session[SESSION_BINDING_KEY] = {
+        "digest": digest,
+        "exp": claims.exp,
+        "claims": claims.claims,
+    }
+
+
+def _unverified(request: JWTRequest):
+    if not hasattr(request, "user"):
+        # stateless, without AuthenticationMiddleware
+        request.user = AnonymousUser()
+    request.jwt_user_email = None
+    request.jwt_domain = None
+    request.jwt_authenticated = False
+    request.iap_claims = None
+
+
+def is_stateless(request: HttpRequest) -> bool:
+    """whether this request is authenticated from the assertion alone,
+    without logging the user in to a session"""
+    stateless = conf.get("IAPAUTH_STATELESS") or path_matcher(
+        "IAPAUTH_STATELESS_PATHS"
+    ).match(request.path_info)
+    tracing.add_field("iapauth.stateless", stateless)
+    return stateless
+
+
+# request class -> its _deferred_class()
+_DEFERRED_CLASSES: Dict[type, type] = {}
+
+
+def _deferred_class(cls: type) -> type:
+    """a subclass of the request class `cls` that runs the request's
+    Deferred the first time one of its `Deferred.ATTRIBUTES` is missing"""
+    deferred_class = _DEFERRED_CLASSES.get(cls)
+    if deferred_class is not None:
+        return deferred_class
+    fallback = getattr(cls, "__getattr__", None)
+
+    def __getattr__(self, name):
+        deferred = self.__dict__.get("_iapauth_deferred")
+        if name in Deferred.ATTRIBUTES and deferred is not None and not deferred.done:
+            deferred()
+            return getattr(self, name)
+        if fallback is not None:
+            return fallback(self, name)
+        raise AttributeError(
+            "{!r} object has no attribute {!r}".format(cls.__name__, name)
+        )
+
+    deferred_class = type(cls.__name__, (cls,), {"__getattr__": __getattr__})
+    _DEFERRED_CLASSES[cls] = deferred_class
+    return deferred_class
+
+
+class Deferred(object):
+    """the middleware's work for one request, put off until the first time
+    `request.user` or one of the `request.jwt_*` attributes is read.
+
+    `install()` makes `request.user` a lazy object, like
+    AuthenticationMiddleware does, and takes the other attributes off the
+    request, which it moves to a subclass of its class whose
+    `__getattr__` fills them in. So they are the real values, and
+    `request.iap_claims is None` means what it says. Reading any of them
+    verifies the assertion and logs the user in or out exactly as
+    `process_request` would have.
+    """
+
+    # can be None or False, so never lazy objects
+    ATTRIBUTES = (
+        "jwt_user_email",
+        "jwt_domain",
+        "jwt_authenticated",
+        "iap_claims",
+    )
+
+    def __init__(self, middleware, request, jwt_token: str, stateless: bool):
+        self.middleware = middleware
+        self.request = request
+        self.jwt_token = jwt_token
+        self.stateless = stateless
+        # AuthenticationMiddleware's (lazy) user, from the session
+        self.user = getattr(request, "user", None)
+        self.done = False
+
+    def install(self):
+        request = self.request
+        request._iapauth_deferred = self
+        request.user = SimpleLazyObject(partial(self.resolve, "user"))
+        for name in self.ATTRIBUTES:
+            request.__dict__.pop(name, None)
+        request.__class__ = _deferred_class(type(request))
+        request.auser = self.auser
+
+    def __call__(self):
+        if self.done:
             return
-        if hasattr(settings, "JWT_AUDIENCE"):
-            audience = settings.JWT_AUDIENCE
-        else:
-            audience = gcp_jwt_audience()
-        beeline.add_context_field("iapauth.jwt_audience", audience)
-
-        # we can override the authenticator for testing
-        authenticator = JWTAuthenticator()
-        if hasattr(settings, "IAPAUTH_JWT_AUTHENTICATOR"):
-            authenticator = settings.IAPAUTH_JWT_AUTHENTICATOR
-
-        authenticated, email, domain = authenticator.authenticate(jwt_token, audience)
-        beeline.add_context_field("iapauth.authenticated", authenticated)
-        beeline.add_context_field("iapauth.email", email)
-        beeline.add_context_field("iapauth.domain", domain)
-        if authenticated:
-            request.jwt_user_email = email
-            request.jwt_domain = domain
-            request.jwt_authenticated = True
-        else:
+        self.done = True
+        request = self.request
+        if self.user is not None:
+            request.user = self.user
+        _unverified(request)
+        with tracing.request():
+            self.middleware._authenticate(request, self.jwt_token, self.stateless)
+
+    def resolve(self, name: str):
+        self()
+        return getattr(self.request, name)
+
+    async def auser(self):
+        if not self.done:
+            await sync_to_async(self)()
+        return self.request.user
+
+    def session_accessed(self) -> bool:
+        session = getattr(self.request, "session", None)
+        return not self.done and session is not None and session.accessed
+
+
+class IAPJWTAuthMiddleware(MiddlewareMixin):
+    sync_capable = True
+    async_capable = True
+
+    def process_request(self, request: JWTRequest):
+        if is_excluded(request):
+            _unverified(request)
+            return
+        with tracing.request():
+            stateless = is_stateless(request)
+            jwt_token = self._get_token(request, stateless)
+            if not jwt_token:
+                return
+            if conf.get("IAPAUTH_LAZY"):
+                Deferred(self, request, jwt_token, stateless).install()
+                return
+            self._authenticate(request, jwt_token, stateless)
+
+    def process_response(self, request: JWTRequest, response):
+        deferred = getattr(request, "_iapauth_deferred", None)
+        if deferred is not None and deferred.session_accessed():
+            # the view used the session without looking at the user. Don't
+            # let a bad assertion leave that session logged in.
+            deferred()
+        return response
+
+    def _verify(self, request: JWTRequest, jwt_token: str, stateless: bool):
+        """`(claims, audience, bound)`: the claims from the gate, the
+        session or the authenticator, the audience they were checked
+        against, and whether they came from the session"""
+        claims = gated_claims(request)
+        if claims is not None:
+            return (claims, None, False)
+        binds = conf.get("IAPAUTH_SESSION_BINDING") and not stateless
+        audience = jwt_audience()
+        tracing.add_field("iapauth.jwt_audience", audience)
+        if binds and audience is not None:
+            claims = self._session_claims(request, request.user, jwt_token, audience)
+            if claims is not None:
+                return (claims, audience, True)
+        with metrics.timer("verify"):
+            claims = verify(get_authenticator(), jwt_token, audience)
+        return (claims, audience, False)
+
+    async def _averify(self, request: JWTRequest, jwt_token: str, stateless: bool):
+        claims = gated_claims(request)
+        if claims is not None:
+            return (claims, None, False)
+        binds = conf.get("IAPAUTH_SESSION_BINDING") and not stateless
+        audience = await ajwt_audience()
+        tracing.add_field("iapauth.jwt_audience", audience)
+        if binds and audience is not None:
+            user = await _aget_user(request)
+            claims = self._session_claims(request, user, jwt_token, audience)
+            if claims is not None:
+                return (claims, audience, True)
+        with metrics.timer("verify"):
+            claims = await averify(get_authenticator(), jwt_token, audience)
+        return (claims, audience, False)
+
+    @tracing.traced("iapauth.middleware.IAPJWTAuthMiddleware._authenticate")
+    def _authenticate(self, request: JWTRequest, jwt_token: str, stateless: bool):
+        claims, audience, bound = self._verify(request, jwt_token, stateless)
+        username = self._accept(request, claims)
+        if stateless:
+            user = None
+            if username is not None:
+                with metrics.timer("resolve_user"):
+                    user = auth.authenticate(request, remote_user=username)
+            request.user = user or AnonymousUser()
+            return
+        if username is None:
             # they tried to use a bad JWT. Make sure they
             # are logged out.
             self._ensure_logged_out(request)
             return
 
-        username = self.clean_username(request.jwt_user_email, request)
         # If the user is already authenticated and that user is the user we are
         # getting passed in the headers, then the correct user is already
         # persisted in the session and we don't need to continue.
-        beeline.add_context_field("iapauth.username", username)
         if request.user.is_authenticated:
-            beeline.add_context_field("iapauth.already_authenticated", True)
+            tracing.add_field("iapauth.already_authenticated", True)
             if request.user.get_username() == username:
+                metrics.incr("already_authenticated")
+                if not bound:
+                    self._bind(request, jwt_token, audience, claims)
                 return
             else:
                 # An authenticated user is associated with the request, but
                 # it does not match the authorized user in the header.
+                metrics.incr("user_switch")
                 self._remove_invalid_user(request)
 
-        beeline.add_context_field("iapauth.already_authenticated", False)
+        tracing.add_field("iapauth.already_authenticated", False)
         # We are seeing this user for the first time in this session, attempt
         # to authenticate the user.
-        user = auth.authenticate(request, remote_user=username)
+        with metrics.timer("resolve_user"):
+            user = auth.authenticate(request, remote_user=username)
         if user:
             # User is valid.  Set request.user and persist user in the session
             # by logging the user in.
             request.user = user
-            auth.login(request, user)
+            with metrics.timer("login"):
+                auth.login(request, user)
+            self._bind(request, jwt_token, audience, claims)
+
+    async def __acall__(self, request):
+        # MiddlewareMixin would run process_request in a thread on every
+        # request. aprocess_request only leaves the event loop when it has
+        # to fetch something or touch the database.
+        response = await self.aprocess_request(request)
+        if response is not None:
+            return response
+        response = await self.get_response(request)  # type: ignore
+        deferred = getattr(request, "_iapauth_deferred", None)
+        if deferred is not None and deferred.session_accessed():
+            await sync_to_async(deferred)()
+        return response
+
+    async def aprocess_request(self, request: JWTRequest):
+        """async version of process_request"""
+        if is_excluded(request):
+            _unverified(request)
+            return
+        with tracing.request():
+            stateless = is_stateless(request)
+            jwt_token = self._get_token(request, stateless)
+            if not jwt_token:
+                return
+            if conf.get("IAPAUTH_LAZY"):
+                Deferred(self, request, jwt_token, stateless).install()
+                return
+            await self._aauthenticate(request, jwt_token, stateless)
+
+    async def _aauthenticate(
+        self, request: JWTRequest, jwt_token: str, stateless: bool
+    ):
+        claims, audience, bound = await self._averify(request, jwt_token, stateless)
+        username = self._accept(request, claims)
+        if stateless:
+            user = None
+            if username is not None:
+                with metrics.timer("resolve_user"):
+                    user = await _aauthenticate_user(request, remote_user=username)
+            request.user = user or AnonymousUser()
+            return
+        if username is None:
+            await sync_to_async(self._ensure_logged_out)(request)
+            return
+
+        user = await _aget_user(request)
+        if user.is_authenticated:
+            tracing.add_field("iapauth.already_authenticated", True)
+            if user.get_username() == username:
+                metrics.incr("already_authenticated")
+                if not bound:
+                    self._bind(request, jwt_token, audience, claims)
+                return
+            metrics.incr("user_switch")
+            await sync_to_async(self._remove_invalid_user)(request)
+
+        tracing.add_field("iapauth.already_authenticated", False)
+        with metrics.timer("resolve_user"):
+            user = await _aauthenticate_user(request, remote_user=username)
+        if user:
+            request.user = user
+            with metrics.timer("login"):
+                await _alogin(request, user)
+            self._bind(request, jwt_token, audience, claims)
+
+    def _get_token(
+        self, request: JWTRequest, stateless: bool = False
+    ) -> Union[str, None]:
+        # AuthenticationMiddleware is required so that request.user exists,
+        # unless we are going to set it ourselves.
+        if not stateless and not hasattr(request, "user"):
+            tracing.add_field("iapauth.invalid_configuration", True)
+            raise ImproperlyConfigured(
+                "The Django remote user auth middleware requires the"
+                " authentication middleware to be installed.  Edit your"
+                " MIDDLEWARE setting to insert"
+                " 'django.contrib.auth.middleware.AuthenticationMiddleware'"
+                " before the RemoteUserMiddleware class."
+            )
+        _unverified(request)
+
+        jwt_token = request.META.get("HTTP_X_GOOG_IAP_JWT_ASSERTION", None)
+
+        if not jwt_token:
+            # no token. We have no responsibility here
+            tracing.add_field("iapauth.no_token", True)
+            metrics.incr("no_token")
+        return jwt_token
+
+    def _accept(
+        self, request: JWTRequest, claims: Union[IAPClaims, None]
+    ) -> Union[str, None]:
+        """record the authenticator's verdict on the request and return the
+        username, or None if the token was rejected"""
+        tracing.add_field("iapauth.authenticated", claims is not None)
+        if claims is None:
+            tracing.add_field("iapauth.email", None)
+            tracing.add_field("iapauth.domain", None)
+            metrics.incr("rejected")
+            tracing.fail()
+            return None
+        tracing.add_field("iapauth.email", claims.email)
+        tracing.add_field("iapauth.domain", claims.hd)
+        metrics.incr("authenticated")
+        request.jwt_user_email = claims.email
+        request.jwt_domain = claims.hd
+        request.jwt_authenticated = True
+        request.iap_claims = claims
+        username = self.clean_username(claims.email, request)
+        tracing.add_field("iapauth.username", username)
+        return username
+
+    def _session_claims(
+        self, request: JWTRequest, user, jwt_token: str, audience: str
+    ) -> Union[IAPClaims, None]:
+        """the session's bound claims, if they are for the user already
+        logged in to it"""
+        if not user.is_authenticated:
+            return None
+        claims = bound_claims(request, jwt_token, audience)
+        if claims is None:
+            return None
+        if user.get_username() != self.clean_username(claims.email, request):
+            return None
+        tracing.add_field("iapauth.session_bound", True)
+        metrics.incr("session_bound")
+        return claims
+
+    def _bind(
+        self,
+        request: JWTRequest,
+        jwt_token: str,
+        audience: Union[str, None],
+        claims: Union[IAPClaims, None],
+    ):
+        if claims is None or audience is None:
+            return
+        if conf.get("IAPAUTH_SESSION_BINDING"):
+            bind_to_session(request, jwt_token, audience, claims)
 
-    @beeline.traced(name="iapauth.middleware.IAPJWTAuthMiddleware._ensure_logged_out")
+    @tracing.traced("iapauth.middleware.IAPJWTAuthMiddleware._ensure_logged_out")
     def _ensure_logged_out(self, request: JWTRequest):
-        request.jwt_authenticated = False
-        request.jwt_domain = None
-        request.jwt_user_email = None
+        _unverified(request)
         if request.user.is_authenticated:
             self._remove_invalid_user(request)
 
-    @beeline.traced(name="iapauth.middleware.IAPJWTAuthMiddleware.clean_username")
     def clean_username(self, username: str, request: JWTRequest) -> str:
         return username.split("@")[0]
 
-    @beeline.traced(name="iapauth.middleware.IAPJWTAuthMiddleware._remove_invalid_user")
+    @tracing.traced("iapauth.middleware.IAPJWTAuthMiddleware._remove_invalid_user")
     def _remove_invalid_user(self, request: JWTRequest):
         """
         Remove the current authenticated user in the request which is invalid
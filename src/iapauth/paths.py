@@ -0,0 +1,107 @@
+"""
+matching request paths against many patterns at once.
+
+a pattern is either a plain string, which matches any path that starts
+with it, or a regex: a compiled pattern, or a string starting with `^`.
+Regexes are matched from the start of the path, as with `re.match`.
+
+`PathMatcher` puts all the prefixes in one character trie. Each regex
+hangs off the trie node for its leading literal text (`/api/v` for
+`^/api/v\\d+/`), and all the regexes on one node are joined into one
+alternation. A lookup walks the trie once along the path, running only
+the regexes whose literal text the path starts with, so its cost depends
+on the path rather than on how many patterns there are.
+"""
+import re
+from typing import Any, Dict, Iterable, List, Pattern, Union
+
+from django.core.exceptions import ImproperlyConfigured
+
+
+# keys for the end of a prefix and for a node's regexes in the trie.
+# Neither is a str, so they can't clash with a path character.
+_END = None
+_REGEX = 0
+
+_INLINE_FLAGS = (("i", re.IGNORECASE), ("m", re.MULTILINE), ("s", re.DOTALL))
+_META = frozenset(".^$*+?{}[]\\|()")
+_QUANTIFIERS = frozenset("*+?{")
+
+
+def _source(pattern: Union[str, Pattern]) -> str:
+    """the regex source, with a compiled pattern's flags made inline so it
+    can be joined with others"""
+    if isinstance(pattern, str):
+        return pattern
+    flags = "".join(f for f, bit in _INLINE_FLAGS if pattern.flags & bit)
+    if flags:
+        return "(?{}:{})".format(flags, pattern.pattern)
+    return pattern.pattern
+
+
+def _literal_prefix(source: str) -> str:
+    """the text every match of `source` has to start with. Errs on the
+    short side: anything unusual gets no prefix at all."""
+    if source.startswith("^"):
+        source = source[1:]
+    if "|" in source:
+        return ""
+    end = 0
+    while end < len(source) and source[end] not in _META:
+        end += 1
+    if end < len(source) and source[end] in _QUANTIFIERS:
+        # the last character is optional or repeated
+        end -= 1
+    return source[: max(end, 0)]
+
+
+class PathMatcher(object):
+    def __init__(self, patterns: Iterable[Union[str, Pattern]] = ()):
+        self.trie: Dict[Any, Any] = {}
+        regexes: Dict[int, List[str]] = {}
+        nodes: Dict[int, Dict[Any, Any]] = {}
+        for pattern in patterns:
+            if isinstance(pattern, str) and not pattern.startswith("^"):
+                self._node(pattern)[_END] = True
+            else:
+                source = _source(pattern)
+                node = self._node(_literal_prefix(source))
+                nodes[id(node)] = node
+                regexes.setdefault(id(node), []).append(source)
+        for key, sources in regexes.items():
+            combined = "|".join("(?:{})".format(s) for s in sources)
+            try:
+                nodes[key][_REGEX] = re.compile(combined)
+            except re.error as e:
+                raise ImproperlyConfigured(
+                    "bad path pattern in {!r}: {}".format(sources, e)
+                )
+
+    def _node(self, prefix: str) -> Dict[Any, Any]:
+        node = self.trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        return node
+
+    def __bool__(self) -> bool:
+        return bool(self.trie)
+
+    def match(self, path: str) -> bool:
+        node: Any = self.trie
+        if not node:
+            return False
+        if _END in node:
+            return True
+        regex = node.get(_REGEX)
+        if regex is not None and regex.match(path):
+            return True
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+            regex = node.get(_REGEX)
+            if regex is not None and regex.match(path):
+                return True
+        return False
@@ -0,0 +1,299 @@
+"""
+mapping users to roles: staff and superuser flags and group memberships.
+
+`IAPAUTH_ROLE_POLICY` is a list of rules, each naming what it matches
+with one of
+
+* `"domain"`: the assertion's `hd`. Never the email's domain: anyone
+  can sign up a personal Google account with any address, and those
+  assertions have no `hd`
+* `"email"`: one email address
+* `"pattern"`: a regex (string or compiled) the whole email, lowercased,
+  must match
+
+and what it grants with any of `"is_staff"`, `"is_superuser"` (True or
+False; left out means leave alone) and `"groups"` (a list of group
+names). For a given user the matching domain rule is applied first, then
+the first matching pattern rule, then the email rule, each overriding
+what the one before set. Rules for the same domain or email are merged
+in order.
+
+groups named anywhere in the policy are managed by it: a user is added
+to the ones their rules grant and removed from the others. Groups the
+policy doesn't name are never touched. `IAP_JWT_ADMIN_DOMAIN` is the
+same as a first rule of
+`{"domain": ..., "is_staff": True, "is_superuser": True}`.
+
+`Policy` compiles the domain and email rules into dicts. Patterns go in
+two character tries, by the literal text they start with or, failing
+that, end with (`svc-` for `svc-.*@example\\.com`, `@eng.example.com`
+for `.*@eng\\.example\\.com`), with the patterns on each node joined
+into one regex, as in iapauth.paths. A decision is two dict lookups and
+a walk along the email, running only the patterns whose literal text it
+starts or ends with, so its cost doesn't grow with the number of rules.
+The last `DECISION_CACHE_SIZE` decisions are remembered.
+"""
+import functools
+import re
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Pattern,
+    Set,
+    Tuple,
+    Union,
+)
+
+from django.core.exceptions import ImproperlyConfigured
+
+from . import conf
+from .paths import _META, _REGEX, _literal_prefix, _source
+
+
+FLAGS = ("is_staff", "is_superuser")
+MATCHERS = ("domain", "email", "pattern")
+DECISION_CACHE_SIZE = 4096
+
+
+class Role(object):
+    """what a policy grants one user. None means leave it alone."""
+
+    __slots__ = FLAGS + ("groups",)
+
+    def __init__(
+        self,
+        is_staff: Union[bool, None] = None,
+        is_superuser: Union[bool, None] = None,
+        groups: Union[Iterable[str], None] = None,
+    ):
+        self.is_staff = is_staff
+        self.is_superuser = is_superuser
+        self.groups = None if groups is None else frozenset(groups)
+
+    def __eq__(self, other):
+        return isinstance(other, Role) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return "Role({})".format(
+            ", ".join("{}={!r}".format(n, getattr(self, n)) for n in self.__slots__)
+        )
+
+    def merged(self, other: Union["Role", None]) -> "Role":
+        """this role with whatever `other` sets overriding it"""
+        if other is None:
+            return self
+        role = Role()
+        for name in self.__slots__:
+            value = getattr(other, name)
+            setattr(role, name, getattr(self, name) if value is None else value)
+        return role
+
+    def apply(self, user) -> List[str]:
+        """set the flags on `user`, returning the fields that changed"""
+        changed = []
+        for name in FLAGS:
+            value = getattr(self, name)
+            if value is not None and getattr(user, name) != value:
+                setattr(user, name, value)
+                changed.append(name)
+        return changed
+
+
+NO_ROLE = Role()
+
+
+def _role(rule: Mapping[str, Any]) -> Tuple[str, Any, Role]:
+    unknown = set(rule) - set(MATCHERS) - set(FLAGS) - {"groups"}
+    matchers = [name for name in MATCHERS if name in rule]
+    if unknown or len(matchers) != 1:
+        raise ImproperlyConfigured(
+            "bad IAPAUTH_ROLE_POLICY rule {!r}: it needs one of domain, email"
+            " or pattern, and may only set is_staff, is_superuser and"
+            " groups".format(rule)
+        )
+    groups = rule.get("groups")
+    if isinstance(groups, str):
+        raise ImproperlyConfigured(
+            "groups in IAPAUTH_ROLE_POLICY rule {!r} must be a list".format(rule)
+        )
+    role = Role(rule.get("is_staff"), rule.get("is_superuser"), groups)
+    return matchers[0], rule[matchers[0]], role
+
+
+def _literal_suffix(source: str) -> str:
+    """the text every full match of `source` has to end with. Like
+    `paths._literal_prefix()`, errs on the short side."""
+    if source.endswith("$") and not source.endswith("\\$"):
+        source = source[:-1]
+    if "|" in source:
+        return ""
+    chars = []
+    end = len(source)
+    while end > 0:
+        char = source[end - 1]
+        escapes = 0
+        while end - 2 - escapes >= 0 and source[end - 2 - escapes] == "\\":
+            escapes += 1
+        if escapes % 2:
+            if char.isalnum():
+                # \d, \w and friends
+                break
+            chars.append(char)
+            end -= 2
+        elif char in _META:
+            break
+        else:
+            chars.append(char)
+            end -= 1
+    return "".join(reversed(chars))
+
+
+class _Index(object):
+    """regexes in a character trie by a literal affix, joined into one
+    alternation per node"""
+
+    def __init__(self):
+        self.trie: Dict[Any, Any] = {}
+        self.sources: Dict[int, List[str]] = {}
+        self.nodes: Dict[int, Dict[Any, Any]] = {}
+
+    def add(self, affix: str, source: str):
+        node = self.trie
+        for char in affix:
+            node = node.setdefault(char, {})
+        self.nodes[id(node)] = node
+        self.sources.setdefault(id(node), []).append(source)
+
+    def compile(self):
+        for key, sources in self.sources.items():
+            try:
+                self.nodes[key][_REGEX] = re.compile("|".join(sources))
+            except re.error as e:
+                raise ImproperlyConfigured(
+                    "bad pattern in IAPAUTH_ROLE_POLICY: {}".format(e)
+                )
+        self.sources.clear()
+        self.nodes.clear()
+
+    def regexes(self, chars: Iterable[str]) -> Iterator[Pattern]:
+        """the regexes whose affix `chars` starts with"""
+        node: Any = self.trie
+        regex = node.get(_REGEX)
+        if regex is not None:
+            yield regex
+        for char in chars:
+            node = node.get(char)
+            if node is None:
+                return
+            regex = node.get(_REGEX)
+            if regex is not None:
+                yield regex
+
+
+class Policy(object):
+    def __init__(self, rules: Iterable[Mapping[str, Any]] = ()):
+        self.domains: Dict[str, Role] = {}
+        self.emails: Dict[str, Role] = {}
+        # (position, role) by the name of their group in the regexes
+        self.patterns: Dict[Any, Tuple[int, Role]] = {}
+        # patterns by their leading and trailing literal text, so a
+        # lookup only runs the ones that could match
+        self.prefixes = _Index()
+        self.suffixes = _Index()
+        managed: Set[str] = set()
+        for rule in rules:
+            kind, value, role = _role(rule)
+            if role.groups is not None:
+                managed |= role.groups
+            if kind == "pattern":
+                self._add_pattern(_source(value), role)
+            else:
+                table = self.domains if kind == "domain" else self.emails
+                key = value.lower()
+                table[key] = table.get(key, NO_ROLE).merged(role)
+        self.prefixes.compile()
+        self.suffixes.compile()
+        self.managed_groups: FrozenSet[str] = frozenset(managed)
+        self.decide = functools.lru_cache(maxsize=DECISION_CACHE_SIZE)(self._decide)
+
+    def _add_pattern(self, source: str, role: Role):
+        # named, so the match says which rule it was
+        name = "_iapauth_{}".format(len(self.patterns))
+        self.patterns[name] = (len(self.patterns), role)
+        named = "(?P<{}>{})".format(name, source)
+        try:
+            re.compile(source)
+        except re.error as e:
+            raise ImproperlyConfigured(
+                "bad pattern {!r} in IAPAUTH_ROLE_POLICY: {}".format(source, e)
+            )
+        # by the prefix when there is one: suffixes tend to be a domain
+        # that lots of patterns share
+        prefix = _literal_prefix(source)
+        if prefix:
+            self.prefixes.add(prefix, named)
+        else:
+            self.suffixes.add(_literal_suffix(source)[::-1], named)
+
+    def __bool__(self) -> bool:
+        return bool(self.domains or self.emails or self.patterns)
+
+    def _pattern(self, email: str) -> Union[Role, None]:
+        """the role of the first pattern rule `email` matches"""
+        found = []
+        for index, chars in ((self.prefixes, email), (self.suffixes, email[::-1])):
+            for regex in index.regexes(chars):
+                match = regex.fullmatch(email)
+                if match is not None:
+                    found.append(self.patterns[match.lastgroup])
+        return min(found, key=lambda pattern: pattern[0])[1] if found else None
+
+    def _decide(
+        self, email: Union[str, None], domain: Union[str, None] = None
+    ) -> Union[Role, None]:
+        """the role for a user with this email and `hd`, or None if no
+        rule matches"""
+        address = (email or "").lower()
+        role = self.domains.get(domain.lower()) if domain else None
+        if self.patterns:
+            pattern = self._pattern(address)
+            if pattern is not None:
+                role = (role or NO_ROLE).merged(pattern)
+        exact = self.emails.get(address)
+        if exact is not None:
+            role = (role or NO_ROLE).merged(exact)
+        return role
+
+
+# None until the settings have been compiled
+POLICY: Union[Policy, None] = None
+
+
+def policy() -> Policy:
+    global POLICY
+
+    if POLICY is None:
+        rules: List[Mapping[str, Any]] = []
+        admin_domain = conf.get("IAP_JWT_ADMIN_DOMAIN")
+        if admin_domain is not None:
+            rules.append(
+                {"domain": admin_domain, "is_staff": True, "is_superuser": True}
+            )
+        rules.extend(conf.get("IAPAUTH_ROLE_POLICY"))
+        POLICY = Policy(rules)
+    return POLICY
+
+
+def _reset_policy():
+    global POLICY
+    POLICY = None
+
+
+conf.on_change(("IAPAUTH_ROLE_POLICY", "IAP_JWT_ADMIN_DOMAIN"), _reset_policy)
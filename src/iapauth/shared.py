@@ -0,0 +1,113 @@
+"""
+share fetched upstream data between worker processes through a Django
+cache (memcached, redis, ...).
+
+every worker keeps its own local copy as before, but fills it from the
+shared cache when it can. Only when its copy is at least as new as the
+shared one does a worker go upstream, and a lock in the cache makes sure
+that only one worker in the fleet does so at a time. The others wait
+for its result.
+
+the lock is only as good as the backend's `add()`: it is atomic for
+memcached, redis and locmem, but not for the file-based cache, where two
+workers racing for it may both fetch.
+"""
+import hashlib
+import logging
+import time
+from typing import Any, Callable, Union
+
+from django.core.cache import caches
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCK_TIMEOUT = 10  # seconds a fetch may hold the lock
+PREFIX = "iapauth:"
+
+
+def cache_key(*parts: str) -> str:
+    """a short, backend-safe cache key"""
+    digest = hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+    return "{}{}:{}".format(PREFIX, parts[0], digest)
+
+
+class SharedFetcher(object):
+    """wraps `fetch` so that its result is shared through the cache `alias`.
+
+    returns the shared value if it was fetched after the last value this
+    instance returned; otherwise fetches upstream (or waits for another
+    worker to). `validate` is called on a freshly fetched value before
+    it is shared, so a bad response never reaches the other workers.
+    """
+
+    def __init__(
+        self,
+        alias: str,
+        key: str,
+        fetch: Callable[[], Any],
+        ttl: float,
+        validate: Union[Callable[[Any], Any], None] = None,
+        lock_timeout: float = DEFAULT_LOCK_TIMEOUT,
+        poll_interval: float = 0.05,
+    ):
+        self.alias = alias
+        self.key = key
+        self.lock_key = key + ":lock"
+        self.fetch = fetch
+        self.ttl = ttl
+        self.validate = validate
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        # when the value we last returned was fetched upstream
+        self.seen = 0.0
+        self.upstream_fetches = 0
+        self.shared_hits = 0
+
+    def __call__(self) -> Any:
+        entry = self._newer()
+        if entry is not None:
+            return entry[1]
+        if self._cache("add", self.lock_key, 1, self.lock_timeout, default=True):
+            try:
+                # the previous lock holder may have just finished
+                entry = self._newer()
+                if entry is not None:
+                    return entry[1]
+                return self._fetch_and_share()
+            finally:
+                self._cache("delete", self.lock_key)
+        # somebody else is fetching it. Wait for them, but not forever.
+        deadline = time.monotonic() + self.lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            entry = self._newer()
+            if entry is not None:
+                return entry[1]
+        return self.fetch()
+
+    def _cache(self, method: str, *args, default=None):
+        # an unreachable cache shouldn't stop us from fetching upstream
+        try:
+            return getattr(caches[self.alias], method)(*args)
+        except Exception as e:
+            logger.warning("iapauth shared cache %r: %s", self.alias, e)
+            return default
+
+    def _newer(self):
+        entry = self._cache("get", self.key)
+        if entry is not None and entry[0] > self.seen:
+            self.seen = entry[0]
+            self.shared_hits += 1
+            return entry
+        return None
+
+    def _fetch_and_share(self) -> Any:
+        value = self.fetch()
+        self.upstream_fetches += 1
+        if self.validate is not None:
+            self.validate(value)
+        now = time.time()
+        self._cache("set", self.key, (now, value), self.ttl)
+        self.seen = now
+        return value
@@ -0,0 +1,152 @@
+"""
+tracing through beeline (Honeycomb), when it is installed.
+
+`IAPAUTH_TRACE_SAMPLE_RATE` picks how much gets traced: 0 is nothing, 1
+is every request, and N traces one request in N, picked when the request
+starts. A request that fails (a rejected assertion or an exception) has
+its fields sent even when it wasn't picked.
+
+context fields added with `add_field()` during a request are collected
+in a per-request buffer and sent to beeline in one call at the end of
+it. Spans for `@traced` functions are only made for picked requests.
+
+the rate is read when the modules are imported. If it is 0 then, the
+`@traced` decorator returns the function untouched, so turning tracing
+off costs nothing at all per call. Changing the setting later changes
+the sampling, but only adds or removes spans after a restart.
+"""
+import functools
+import random
+from contextvars import ContextVar
+from typing import Any, Dict, Union
+
+
+try:
+    import beeline  # type: ignore
+
+    DEFAULT_SAMPLE_RATE = 1
+except ImportError:
+    import iapauth.instrumentation as beeline  # type: ignore
+
+    DEFAULT_SAMPLE_RATE = 0
+
+
+# None until IAPAUTH_TRACE_SAMPLE_RATE has been looked up
+RATE: Union[int, None] = None
+
+
+def rate() -> int:
+    global RATE
+
+    if RATE is None:
+        # read straight from settings: conf imports modules that use
+        # @traced, so it may not be ready yet
+        from django.conf import settings
+
+        RATE = DEFAULT_SAMPLE_RATE
+        if settings.configured:
+            RATE = getattr(settings, "IAPAUTH_TRACE_SAMPLE_RATE", RATE)
+    return RATE
+
+
+def reset_rate():
+    global RATE
+    RATE = None
+
+
+class Trace(object):
+    """what we know about one request's trace so far"""
+
+    __slots__ = ("sampled", "failed", "fields")
+
+    def __init__(self, sampled: bool):
+        self.sampled = sampled
+        self.failed = False
+        self.fields: Dict[str, Any] = {}
+
+
+_current: ContextVar[Union[Trace, None]] = ContextVar("iapauth_trace", default=None)
+
+
+class _Request(object):
+    __slots__ = ("token",)
+
+    def __enter__(self):
+        n = rate()
+        # sampling for timings, nothing secret depends on it
+        sampled = n == 1 or random.random() * n < 1  # nosec B311
+        self.token = _current.set(Trace(sampled))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = _current.get()
+        _current.reset(self.token)
+        if trace is None:
+            return
+        if exc_type is not None:
+            trace.failed = True
+            trace.fields["iapauth.error"] = repr(exc)
+        if trace.fields and (trace.sampled or trace.failed):
+            beeline.add_context(trace.fields)
+
+
+class _NullRequest(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_REQUEST = _NullRequest()
+
+
+def request():
+    """`with request(): ...` traces the block as one request"""
+    if RATE or (RATE is None and rate()):
+        return _Request()
+    return NULL_REQUEST
+
+
+def add_field(name: str, value: Any):
+    if not (RATE or (RATE is None and rate())):
+        return
+    trace = _current.get()
+    if trace is not None:
+        trace.fields[name] = value
+    else:
+        # not part of a request, e.g. a background key fetch
+        beeline.add_context_field(name, value)
+
+
+def fail():
+    """mark the current request as failed, so it is sent either way"""
+    trace = _current.get()
+    if trace is not None:
+        trace.failed = True
+
+
+def traced(name: str):
+    """a beeline span around the function, for sampled requests.
+
+    calls from outside a traced request (e.g. a background key fetch)
+    always get a span.
+    """
+
+    def decorator(func):
+        if not rate():
+            return func
+        with_span = beeline.traced(name=name)(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current.get()
+            if trace is None or trace.sampled:
+                return with_span(*args, **kwargs)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,148 @@
+"""
+a direct ES256 verification path for IAP assertions.
+
+this does the minimum `jose.jwt.decode` would do for an IAP token: one
+split of the compact serialization, a look at the header's `alg` and
+`kid`, a raw signature check with `cryptography`, and a single pass over
+the claims. Failures raise the same jose exceptions that `jwt.decode`
+raises, so callers can treat both paths the same way.
+"""
+import base64
+import binascii
+import json
+import time
+from typing import Tuple, Union
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import (
+    encode_dss_signature,
+)
+from cryptography.hazmat.primitives.hashes import SHA256
+from jose.exceptions import (  # type: ignore
+    ExpiredSignatureError,
+    JWSSignatureError,
+    JWTClaimsError,
+    JWTError,
+)
+
+
+# IAP signs every assertion with ES256, and always sets these claims
+ALGORITHM = "ES256"
+ISSUER = "https://cloud.google.com/iap"
+REQUIRED_CLAIMS = ("aud", "exp", "iat", "iss")
+# the equivalent `options` for `jose.jwt.decode`
+REQUIRED_CLAIM_OPTIONS = {"require_" + claim: True for claim in REQUIRED_CLAIMS}
+
+_ECDSA_SHA256 = ec.ECDSA(SHA256())
+
+
+def _b64decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def split_token(jwt_token: str) -> Tuple[dict, str, str, bytes]:
+    """returns (header, header segment, payload segment, signature)"""
+    try:
+        header_segment, payload_segment, signature_segment = jwt_token.split(".")
+        header = json.loads(_b64decode(header_segment))
+        signature = _b64decode(signature_segment)
+    except (ValueError, TypeError, AttributeError, binascii.Error) as e:
+        raise JWTError("malformed token: {}".format(e))
+    if not isinstance(header, dict) or header.get("alg") != ALGORITHM:
+        raise JWTError("The specified alg value is not allowed")
+    return header, header_segment, payload_segment, signature
+
+
+def inspect_token(jwt_token: str) -> Tuple[Union[str, None], Union[str, None]]:
+    """cheap structural checks, done before any signature verification.
+
+    returns `(reason, kid)`. `reason` is None if the token is shaped like
+    something IAP could have sent, otherwise it says what's wrong.
+    """
+    if jwt_token.count(".") != 2:
+        return ("malformed", None)
+    try:
+        header = json.loads(_b64decode(jwt_token[: jwt_token.index(".")]))
+    except (ValueError, TypeError, binascii.Error):
+        return ("malformed", None)
+    if not isinstance(header, dict):
+        return ("malformed", None)
+    if header.get("alg") != ALGORITHM:
+        return ("bad_alg", None)
+    kid = header.get("kid")
+    if not isinstance(kid, str):
+        return ("no_kid", None)
+    return (None, kid)
+
+
+def verify_signature(
+    key: ec.EllipticCurvePublicKey,
+    header_segment: str,
+    payload_segment: str,
+    signature: bytes,
+):
+    # JWS carries the raw 32 byte r and s; cryptography wants DER
+    if len(signature) != 64:
+        raise JWSSignatureError("Signature verification failed.")
+    der = encode_dss_signature(
+        int.from_bytes(signature[:32], "big"), int.from_bytes(signature[32:], "big")
+    )
+    try:
+        signing_input = "{}.{}".format(header_segment, payload_segment)
+        key.verify(der, signing_input.encode("ascii"), _ECDSA_SHA256)
+    except (InvalidSignature, UnicodeEncodeError):
+        raise JWSSignatureError("Signature verification failed.")
+
+
+def decode_claims(payload_segment: str) -> dict:
+    try:
+        claims = json.loads(_b64decode(payload_segment))
+    except (ValueError, binascii.Error) as e:
+        raise JWTError("Invalid payload string: {}".format(e))
+    if not isinstance(claims, dict):
+        raise JWTError("Invalid payload string: must be a json object")
+    return claims
+
+
+def _validate_times(claims: dict, now: Union[float, None] = None):
+    now = int(time.time() if now is None else now)
+    try:
+        int(claims["iat"])
+        if "nbf" in claims and int(claims["nbf"]) > now:
+            raise JWTClaimsError("The token is not yet valid (nbf)")
+        exp = int(claims["exp"])
+    except (TypeError, ValueError):
+        raise JWTClaimsError("iat, nbf and exp must be integers")
+    if exp < now:
+        raise ExpiredSignatureError("Signature has expired.")
+
+
+def _validate_audience(claims: dict, audience: str):
+    aud = claims["aud"]
+    if isinstance(aud, str):
+        aud = [aud]
+    if not isinstance(aud, list) or not all(isinstance(a, str) for a in aud):
+        raise JWTClaimsError("Invalid claim format in token")
+    if audience not in aud:
+        raise JWTClaimsError("Invalid audience")
+
+
+def validate_claims(claims: dict, audience: str, now: Union[float, None] = None):
+    """the same checks `jose.jwt.decode` does with REQUIRED_CLAIM_OPTIONS,
+    as of `now` (a unix time, default the current one)"""
+    for claim in REQUIRED_CLAIMS:
+        if claim not in claims:
+            raise JWTError('missing required key "{}" among claims'.format(claim))
+    _validate_times(claims, now)
+    _validate_audience(claims, audience)
+    if claims["iss"] != ISSUER:
+        raise JWTClaimsError("Invalid issuer")
+    if not isinstance(claims.get("sub", ""), str):
+        raise JWTClaimsError("Subject must be a string.")
+    if not isinstance(claims.get("jti", ""), str):
+        raise JWTClaimsError("JWT ID must be a string.")
+    if "at_hash" in claims:
+        # jose rejects these when it isn't given an access token to check
+        # them against, and we never have one
+        raise JWTClaimsError("No access_token provided to compare against at_hash")
@@ -0,0 +1,19 @@
+from django.http import HttpResponse, JsonResponse
+
+from . import metrics as registry
+
+
+# the content type Prometheus expects for the text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics(request):
+    """this process's iapauth metrics, for Prometheus to scrape.
+
+    `?format=json` returns `iapauth.metrics.snapshot()` instead. Mount it
+    somewhere only your scraper can reach, e.g. behind IAP, and probably
+    in IAPAUTH_EXCLUDE_PATHS.
+    """
+    if request.GET.get("format") == "json":
+        return JsonResponse(registry.snapshot())
+    return HttpResponse(registry.prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
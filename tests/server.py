@@ -0,0 +1,77 @@
+"""
+a local stand-in for Google's public key endpoint and the GCE metadata
+server, so tests can exercise the real fetch code without the network.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+
+KEY_PATH = "/iap/verify/public_key"
+PROJECT_NUMBER_PATH = "/computeMetadata/v1/project/numeric-project-id"
+
+
+class StubServer(object):
+    """serves `keys` as the key set and `project_number` from metadata.
+
+    counts how often each endpoint was hit. `delay` seconds are slept
+    before every response. Use it as a context manager.
+    """
+
+    def __init__(self, keys: Dict[str, str], project_number: int = 1234, delay=0):
+        self.keys = keys
+        self.project_number = project_number
+        self.delay = delay
+        self.hits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.hits[self.path] = stub.hits.get(self.path, 0) + 1
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if self.path == KEY_PATH:
+                    body = stub.keys
+                elif self.path.lstrip("/") == PROJECT_NUMBER_PATH.lstrip("/"):
+                    if self.headers.get("Metadata-Flavor") != "Google":
+                        self.send_error(403)
+                        return
+                    body = stub.project_number
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+        self.key_url = self.url + KEY_PATH
+
+    def key_hits(self) -> int:
+        return self.hits.get(KEY_PATH, 0)
+
+    def metadata_hits(self) -> int:
+        return sum(v for k, v in self.hits.items() if k.endswith(PROJECT_NUMBER_PATH))
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
@@ -0,0 +1,123 @@
+import asyncio
+import os
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from iapauth import middleware
+from iapauth.middleware import (
+    ES256Authenticator,
+    IAPJWTAuthMiddleware,
+    StubAuthenticator,
+    agcp_jwt_audience,
+    akeys,
+)
+
+from .server import StubServer
+from .utils import make_key, make_token
+
+
+AUDIENCE = "/projects/1234/apps/test-project"
+# the async test client passes extra kwargs through as raw ASGI headers
+HEADER = "x-goog-iap-jwt-assertion"
+
+
+class AsyncMiddlewareTest(TestCase):
+    """drive the middleware through the ASGI handler, with the key and
+    metadata endpoints served locally"""
+
+    def setUp(self):
+        self.private_pem, public_pem = make_key()
+        self.server = StubServer({"k1": public_pem}, project_number=1234)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        for name in ("KEY_STORE", "AUDIENCE", "TOKEN_CACHE"):
+            patcher = mock.patch.object(middleware, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(os.environ, {"GOOGLE_CLOUD_PROJECT": "test-project"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings = override_settings(
+            IAPAUTH_PUBLIC_KEY_URL=self.server.key_url,
+            IAPAUTH_METADATA_URL=self.server.url,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def headers(self, email="testuser@example.com"):
+        token = make_token(self.private_pem, "k1", email=email, audience=AUDIENCE)
+        return {HEADER: token}
+
+    async def test_middleware_is_async_capable(self):
+        async def get_response(request):
+            return HttpResponse("ok")
+
+        m = IAPJWTAuthMiddleware(get_response)
+        self.assertTrue(m.async_capable)
+        self.assertTrue(asyncio.iscoroutinefunction(m.__acall__))
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        # never MiddlewareMixin's sync_to_async(process_request)
+        with mock.patch.object(
+            m, "process_request", side_effect=AssertionError("process_request")
+        ):
+            response = await m(request)
+        self.assertEqual(response.content, b"ok")
+
+    async def test_fetchers(self):
+        self.assertEqual(await agcp_jwt_audience(), AUDIENCE)
+        self.assertEqual(list(await akeys()), ["k1"])
+        # both are cached after the first call
+        await agcp_jwt_audience()
+        await akeys()
+        self.assertEqual(self.server.metadata_hits(), 1)
+        self.assertEqual(self.server.key_hits(), 1)
+
+    async def test_no_header(self):
+        r = await self.async_client.get(reverse("testview"))
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("is_authenticated: False", str(r.content))
+        self.assertEqual(self.server.key_hits(), 0)
+
+    async def test_login(self):
+        r = await self.async_client.get(reverse("protected"), **self.headers())
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("current user: testuser", str(r.content))
+        # and again, now from the session
+        r = await self.async_client.get(reverse("protected"), **self.headers())
+        self.assertIn("current user: testuser", str(r.content))
+        self.assertEqual(self.server.key_hits(), 1)
+        self.assertEqual(self.server.metadata_hits(), 1)
+
+    @override_settings(IAPAUTH_JWT_AUTHENTICATOR=ES256Authenticator())
+    async def test_login_es256(self):
+        r = await self.async_client.get(reverse("protected"), **self.headers())
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("current user: testuser", str(r.content))
+
+    async def test_user_switch(self):
+        await self.async_client.get(reverse("testview"), **self.headers())
+        r = await self.async_client.get(
+            reverse("testview"), **self.headers("second@example.com")
+        )
+        self.assertIn("current user: second", str(r.content))
+
+    async def test_bad_token_logs_out(self):
+        await self.async_client.get(reverse("testview"), **self.headers())
+        r = await self.async_client.get(reverse("protected"), **{HEADER: "not a JWT"})
+        self.assertEqual(r.status_code, 302)
+
+    @override_settings(
+        JWT_AUDIENCE="/projects/foo",
+        IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(
+            True, "testuser@example.com", "example.com"
+        ),
+    )
+    async def test_stub_authenticator(self):
+        r = await self.async_client.get(reverse("testview"), **{HEADER: "x"})
+        self.assertIn("current user: testuser", str(r.content))
+        self.assertEqual(self.server.metadata_hits(), 0)
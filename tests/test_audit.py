@@ -0,0 +1,168 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase
+
+from iapauth.audit import Verifier, audit, load_key_file
+from iapauth.keys import KeyFetchError, KeySnapshot
+
+from .utils import AUDIENCE, make_key, make_token
+
+
+class AuditTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_pem, public_pem = make_key()
+        cls.keys = {"k1": public_pem}
+        cls.good = make_token(cls.private_pem, "k1")
+        cls.other = make_token(cls.private_pem, "k1", email="other@example.com")
+        # issued long ago and long expired, as in an old log
+        cls.old = make_token(
+            cls.private_pem, "k1", iat=1600000000, exp=1600000600, lifetime=0
+        )
+        cls.forged = make_token(make_key()[0], "k1")
+        cls.unknown = make_token(cls.private_pem, "k9")
+        cls.elsewhere = make_token(cls.private_pem, "k1", audience="/projects/9")
+
+    def setUp(self):
+        self.verifier = Verifier(self.keys, AUDIENCE)
+
+    def test_valid(self):
+        result = self.verifier(7, self.good)
+        self.assertEqual(result["line"], 7)
+        self.assertEqual(result["status"], "valid")
+        self.assertEqual(result["email"], "testuser@example.com")
+        self.assertEqual(result["hd"], "example.com")
+        self.assertEqual(result["kid"], "k1")
+
+    def test_invalid(self):
+        for token, reason, detail in (
+            ("eyJnope.x.y", "malformed", None),
+            (self.forged, "invalid", "Signature verification failed."),
+            (self.unknown, "unknown_kid", None),
+            (self.elsewhere, "invalid", "Invalid audience"),
+        ):
+            result = self.verifier(1, token)
+            self.assertEqual(result["status"], "invalid")
+            self.assertEqual(result["reason"], reason)
+            self.assertEqual(result.get("detail"), detail)
+            self.assertNotIn("email", result)
+
+    def test_expiry(self):
+        self.assertEqual(self.verifier(1, self.old)["status"], "valid")
+        result = Verifier(self.keys, AUDIENCE, check_expiry=True)(1, self.old)
+        self.assertEqual(result["detail"], "Signature has expired.")
+
+    def test_log_lines_and_repeats(self):
+        lines = [
+            '10.0.0.1 - "GET /" 200 "{}"\n'.format(self.good),
+            "no assertion here\n",
+            '10.0.0.1 - "GET /next" 200 "{}"\n'.format(self.good),
+            "{}\n".format(self.forged),
+            "{}\n".format(self.other),
+        ]
+        totals = {}
+        results = list(audit(lines, self.keys, AUDIENCE, processes=1, totals=totals))
+        self.assertEqual([r["line"] for r in results], [1, 4, 5])
+        self.assertEqual(
+            totals,
+            {"lines": 5, "tokens": 4, "repeated": 1, "valid": 2, "invalid": 1},
+        )
+
+    def test_repeats_outside_the_window(self):
+        lines = [self.good, self.other, self.good]
+        results = list(audit(lines, self.keys, AUDIENCE, processes=1, window=1))
+        self.assertEqual(len(results), 3)
+
+    def test_process_pool(self):
+        tokens = [self.good, self.forged, self.other, self.unknown, self.old]
+        lines = [t + "\n" for t in tokens] * 3
+        serial = list(audit(lines, self.keys, AUDIENCE, processes=1, window=2))
+        pooled = list(
+            audit(lines, self.keys, AUDIENCE, processes=2, chunk_size=2, window=2)
+        )
+        self.assertEqual(pooled, serial)
+        self.assertEqual(len(pooled), 15)
+
+
+class KeyFileTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "keys.json")
+        self.keys = {"k1": make_key()[1]}
+
+    def test_formats(self):
+        with open(self.path, "w") as f:
+            json.dump(self.keys, f)
+        self.assertEqual(load_key_file(self.path), self.keys)
+        KeySnapshot(self.path).save(self.keys)
+        self.assertEqual(load_key_file(self.path), self.keys)
+
+    def test_bad_keys(self):
+        with open(self.path, "w") as f:
+            json.dump({"k1": "not a pem"}, f)
+        with self.assertRaises(KeyFetchError):
+            load_key_file(self.path)
+
+
+class AuditCommandTest(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        private_pem, public_pem = make_key()
+        self.keys = os.path.join(self.dir, "keys.json")
+        with open(self.keys, "w") as f:
+            json.dump({"k1": public_pem}, f)
+        self.log = os.path.join(self.dir, "access.log")
+        with open(self.log, "w") as f:
+            issued = int(time.time()) - 3600
+            f.write(make_token(private_pem, "k1", iat=issued, exp=issued + 600))
+            f.write("\n")
+            f.write("eyJbad.token.here\n")
+
+    def audit(self, *args, **options):
+        out, err = io.StringIO(), io.StringIO()
+        call_command(
+            "iapauth_audit",
+            self.log,
+            *args,
+            keys=self.keys,
+            processes=1,
+            stdout=out,
+            stderr=err,
+            **options
+        )
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        return results, err.getvalue()
+
+    def test_jsonl(self):
+        results, summary = self.audit(audience=AUDIENCE)
+        self.assertEqual([r["status"] for r in results], ["valid", "invalid"])
+        self.assertEqual(results[0]["email"], "testuser@example.com")
+        self.assertEqual(results[1]["reason"], "malformed")
+        self.assertIn("2 assertions (0 repeats skipped): 1 valid, 1 invalid", summary)
+
+    def test_check_expiry(self):
+        results, _ = self.audit("--check-expiry", audience=AUDIENCE)
+        self.assertEqual(results[0]["detail"], "Signature has expired.")
+
+    def test_output_file(self):
+        path = os.path.join(self.dir, "out.jsonl")
+        results, _ = self.audit("--output", path, audience=AUDIENCE)
+        self.assertEqual(results, [])
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_needs_audience_and_keys(self):
+        with self.assertRaises(CommandError):
+            self.audit()
+        self.keys = os.path.join(self.dir, "missing.json")
+        with self.assertRaises(CommandError):
+            self.audit(audience=AUDIENCE)
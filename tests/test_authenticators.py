@@ -0,0 +1,143 @@
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from iapauth import middleware
+from iapauth.keys import KeyStore
+from iapauth.middleware import ES256Authenticator, JWTAuthenticator
+
+from .utils import AUDIENCE, make_key, make_token, sign
+
+
+@override_settings(IAPAUTH_TOKEN_CACHE_SIZE=0, IAPAUTH_NEGATIVE_CACHE_SIZE=0)
+class EquivalenceTest(SimpleTestCase):
+    """ES256Authenticator must accept and reject exactly what the jose
+    based JWTAuthenticator does"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_pem, public_pem = make_key()
+        cls.other_private_pem, other_public_pem = make_key()
+        cls.store = KeyStore(
+            fetch=lambda: {"k1": public_pem, "k2": other_public_pem},
+            refetch_interval=3600,
+        )
+
+    def setUp(self):
+        for name, value in [
+            ("KEY_STORE", self.store),
+            ("TOKEN_CACHE", None),
+            ("NEGATIVE_CACHE", None),
+        ]:
+            patcher = mock.patch.object(middleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assertEquivalent(self, token, audience=AUDIENCE, accepted=None):
+        expected = JWTAuthenticator().authenticate(token, audience)
+        actual = ES256Authenticator().authenticate(token, audience)
+        self.assertEqual(actual, expected)
+        if accepted is not None:
+            self.assertEqual(actual[0], accepted)
+
+    def token(self, **kwargs):
+        return make_token(self.private_pem, "k1", **kwargs)
+
+    def payload(self, **claims):
+        now = int(time.time())
+        payload = {
+            "aud": AUDIENCE,
+            "email": "testuser@example.com",
+            "exp": now + 600,
+            "iat": now,
+            "iss": "https://cloud.google.com/iap",
+        }
+        payload.update(claims)
+        return {k: v for k, v in payload.items() if v is not None}
+
+    def test_valid(self):
+        self.assertEquivalent(self.token(), accepted=True)
+
+    def test_valid_without_hd(self):
+        self.assertEquivalent(self.token(hd=None), accepted=True)
+
+    def test_audience_list(self):
+        self.assertEquivalent(self.token(audience=["/other", AUDIENCE]), accepted=True)
+
+    def test_wrong_audience(self):
+        self.assertEquivalent(self.token(), audience="/projects/2", accepted=False)
+        self.assertEquivalent(self.token(audience=["/other"]), accepted=False)
+        self.assertEquivalent(self.token(audience=[1]), accepted=False)
+        self.assertEquivalent(self.token(audience={"a": 1}), accepted=False)
+
+    def test_expired(self):
+        self.assertEquivalent(self.token(lifetime=-10), accepted=False)
+
+    def test_not_yet_valid(self):
+        self.assertEquivalent(self.token(nbf=int(time.time()) + 60), accepted=False)
+        self.assertEquivalent(self.token(nbf=int(time.time()) - 60), accepted=True)
+
+    def test_wrong_issuer(self):
+        self.assertEquivalent(self.token(iss="https://evil.example"), accepted=False)
+
+    def test_missing_required_claims(self):
+        for claim in ("aud", "exp", "iat", "iss", "email"):
+            token = sign(self.private_pem, self.payload(**{claim: None}), {"kid": "k1"})
+            self.assertEquivalent(token, accepted=False)
+
+    def test_non_numeric_times(self):
+        for claim in ("iat", "exp", "nbf"):
+            token = sign(self.private_pem, self.payload(**{claim: "x"}), {"kid": "k1"})
+            self.assertEquivalent(token, accepted=False)
+
+    def test_bad_sub_and_jti(self):
+        self.assertEquivalent(self.token(sub=1), accepted=False)
+        self.assertEquivalent(self.token(jti=1), accepted=False)
+        self.assertEquivalent(self.token(jti="abc"), accepted=True)
+
+    def test_at_hash(self):
+        self.assertEquivalent(self.token(at_hash="abc"), accepted=False)
+
+    def test_wrong_key(self):
+        self.assertEquivalent(make_token(self.other_private_pem, "k1"), accepted=False)
+        self.assertEquivalent(make_token(self.other_private_pem, "k2"), accepted=True)
+
+    def test_unknown_or_missing_kid(self):
+        self.assertEquivalent(make_token(self.private_pem, "nope"), accepted=False)
+        self.assertEquivalent(sign(self.private_pem, self.payload()), accepted=False)
+
+    def test_other_algorithms(self):
+        token = sign("secret", self.payload(), {"kid": "k1"}, algorithm="HS256")
+        self.assertEquivalent(token, accepted=False)
+        header, payload, _ = self.token().split(".")
+        # "alg": "none"
+        self.assertEquivalent(
+            "eyJhbGciOiJub25lIiwia2lkIjoiazEifQ.{}.".format(payload), accepted=False
+        )
+
+    def test_tampered(self):
+        header, payload, signature = self.token().split(".")
+        other = self.token(email="admin@example.com").split(".")[1]
+        self.assertEquivalent(".".join([header, other, signature]), accepted=False)
+        self.assertEquivalent(
+            ".".join([header, payload, signature[:-4]]), accepted=False
+        )
+        self.assertEquivalent(".".join([header, payload, ""]), accepted=False)
+
+    def test_non_object_payload(self):
+        token = sign(self.private_pem, b"[1, 2, 3]", {"kid": "k1"})
+        self.assertEquivalent(token, accepted=False)
+
+    def test_garbage(self):
+        for token in [
+            "totally not a legit JWT",
+            "",
+            "a.b",
+            "a.b.c.d",
+            "!!!.!!!.!!!",
+            "e30.e30.e30",
+            "☃.☃.☃",
+        ]:
+            self.assertEquivalent(token, accepted=False)
@@ -0,0 +1,216 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from iapauth import backends
+from iapauth.backends import IAPJWTUserBackend
+from iapauth.middleware import StubAuthenticator
+
+
+def jwt_request(email="testuser@example.com", domain="example.com"):
+    request = RequestFactory().get("/")
+    request.jwt_user_email = email
+    request.jwt_domain = domain
+    request.jwt_authenticated = True
+    return request
+
+
+def writes(queries, table="auth_user"):
+    return [
+        q["sql"].split()[0]
+        for q in queries
+        if q["sql"].startswith(("INSERT", "UPDATE", "DELETE")) and table in q["sql"]
+    ]
+
+
+class CreateUserTest(TestCase):
+    def test_new_user_is_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            user = IAPJWTUserBackend().authenticate(jwt_request(), "testuser")
+        self.assertEqual(writes(queries), ["INSERT"])
+        user = User.objects.get(username="testuser")
+        self.assertEqual(user.email, "testuser@example.com")
+        self.assertFalse(user.has_usable_password())
+        self.assertFalse(user.is_staff)
+
+    @override_settings(IAP_JWT_ADMIN_DOMAIN="example.com")
+    def test_new_admin_is_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            IAPJWTUserBackend().authenticate(jwt_request(), "testuser")
+        self.assertEqual(writes(queries), ["INSERT"])
+        user = User.objects.get(username="testuser")
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.is_superuser)
+
+    def test_existing_user_is_not_written(self):
+        User.objects.create(username="testuser", email="old@example.com")
+        with CaptureQueriesContext(connection) as queries:
+            user = IAPJWTUserBackend().authenticate(jwt_request(), "testuser")
+        self.assertEqual(writes(queries), [])
+        self.assertEqual(user.email, "old@example.com")
+
+    def test_created_concurrently(self):
+        existing = User.objects.create(username="testuser")
+        manager = User._default_manager
+        with mock.patch.object(
+            manager,
+            "get_by_natural_key",
+            side_effect=[User.DoesNotExist, existing],
+        ):
+            user = IAPJWTUserBackend().authenticate(jwt_request(), "testuser")
+        self.assertEqual(user.pk, existing.pk)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_unknown_user_not_created(self):
+        backend = IAPJWTUserBackend()
+        backend.create_unknown_user = False
+        self.assertIsNone(backend.authenticate(jwt_request(), "testuser"))
+        self.assertFalse(User.objects.exists())
+
+    def test_configure_user_override(self):
+        calls = []
+
+        class Backend(IAPJWTUserBackend):
+            def configure_user(self, request, user):
+                calls.append(user.username)
+                user.first_name = "configured"
+                user.save()
+                return user
+
+        user = Backend().authenticate(jwt_request(), "testuser")
+        self.assertEqual(calls, ["testuser"])
+        self.assertEqual(user.first_name, "configured")
+        self.assertFalse(user.has_usable_password())
+        # without `created`, it's only for new users
+        Backend().authenticate(jwt_request(), "testuser")
+        self.assertEqual(calls, ["testuser"])
+
+    def test_configure_user_override_with_created(self):
+        calls = []
+
+        class Backend(IAPJWTUserBackend):
+            def configure_user(self, request, user, created=True):
+                calls.append(created)
+                return user
+
+        Backend().authenticate(jwt_request(), "testuser")
+        Backend().authenticate(jwt_request(), "testuser")
+        self.assertEqual(calls, [True, False])
+
+    @override_settings(
+        JWT_AUDIENCE="/projects/foo",
+        IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(
+            True, "testuser@example.com", "example.com"
+        ),
+    )
+    def test_first_login_through_middleware(self):
+        headers = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse("testview"), **headers)
+        self.assertTrue("current user: testuser" in str(r.content))
+        # the user, then last_login from auth.login()
+        self.assertEqual(writes(queries), ["INSERT", "UPDATE"])
+
+
+@override_settings(IAPAUTH_USER_CACHE_SIZE=16)
+class UserCacheTest(TestCase):
+    def setUp(self):
+        self.addCleanup(backends._reset_user_cache)
+        self.backend = IAPJWTUserBackend()
+        self.user = User.objects.create(username="testuser")
+
+    def test_disabled_by_default(self):
+        with override_settings(IAPAUTH_USER_CACHE_SIZE=0):
+            self.backend.authenticate(jwt_request(), "testuser")
+            with self.assertNumQueries(1):
+                self.backend.authenticate(jwt_request(), "testuser")
+
+    def test_authenticate_is_cached(self):
+        self.backend.authenticate(jwt_request(), "testuser")
+        with self.assertNumQueries(0):
+            user = self.backend.authenticate(jwt_request(), "testuser")
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_get_user_is_cached(self):
+        self.backend.authenticate(jwt_request(), "testuser")
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user.pk, self.user.pk)
+
+    async def test_aauthenticate_is_cached(self):
+        await self.backend.aauthenticate(jwt_request(), "testuser")
+        # served on the loop, without a thread for the database
+        with mock.patch.object(backends, "sync_to_async") as to_thread:
+            user = await self.backend.aauthenticate(jwt_request(), "testuser")
+            self.assertEqual(await self.backend.aget_user(self.user.pk), user)
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertFalse(to_thread.called)
+
+    def test_each_caller_gets_a_copy(self):
+        self.backend.authenticate(jwt_request(), "testuser")
+        first = self.backend.authenticate(jwt_request(), "testuser")
+        first.first_name = "changed"
+        second = self.backend.authenticate(jwt_request(), "testuser")
+        self.assertIsNot(first, second)
+        self.assertEqual(second.first_name, "")
+
+    def test_cache_miss_is_not_shared(self):
+        user = self.backend.authenticate(jwt_request(), "testuser")
+        user.is_superuser = True
+        self.assertFalse(self.backend.get_user(user.pk).is_superuser)
+        backends._reset_user_cache()
+        user = self.backend.get_user(user.pk)
+        user.is_superuser = True
+        self.assertFalse(self.backend.get_user(user.pk).is_superuser)
+
+    def test_entries_expire(self):
+        with override_settings(IAPAUTH_USER_CACHE_TTL=60):
+            self.backend.authenticate(jwt_request(), "testuser")
+        now = backends.USER_CACHE.clock()
+        with mock.patch.object(backends.USER_CACHE, "clock", return_value=now + 61):
+            with self.assertNumQueries(1):
+                self.backend.authenticate(jwt_request(), "testuser")
+
+    def test_save_invalidates(self):
+        self.backend.authenticate(jwt_request(), "testuser")
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.backend.authenticate(jwt_request(), "testuser"))
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_rename_invalidates_old_username(self):
+        self.backend.authenticate(jwt_request(), "testuser")
+        self.user.username = "renamed"
+        self.user.save()
+        user = self.backend.authenticate(jwt_request(), "testuser")
+        self.assertNotEqual(user.pk, self.user.pk)
+
+    def test_delete_invalidates(self):
+        self.backend.authenticate(jwt_request(), "testuser")
+        pk = self.user.pk
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(pk))
+
+    def test_last_login_does_not_invalidate(self):
+        self.backend.authenticate(jwt_request(), "testuser")
+        self.user.save(update_fields=["last_login"])
+        with self.assertNumQueries(0):
+            self.backend.authenticate(jwt_request(), "testuser")
+
+    @override_settings(
+        JWT_AUDIENCE="/projects/foo",
+        IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(
+            True, "testuser@example.com", "example.com"
+        ),
+    )
+    def test_session_requests_skip_user_query(self):
+        headers = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+        self.client.get(reverse("testview"), **headers)
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse("testview"), **headers)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertFalse(any("auth_user" in q["sql"] for q in queries))
@@ -0,0 +1,115 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from iapauth.middleware import SESSION_BINDING_KEY, session_digest
+
+from .utils import CountingAuthenticator
+
+
+AUDIENCE = "/projects/foo"
+TOKEN = "totally not a legit JWT"
+HEADER = "x-goog-iap-jwt-assertion"
+
+
+def headers(token=TOKEN):
+    return {"HTTP_X_GOOG_IAP_JWT_ASSERTION": token}
+
+
+@override_settings(JWT_AUDIENCE=AUDIENCE, IAPAUTH_SESSION_BINDING=True)
+class SessionBindingTest(TestCase):
+    def setUp(self):
+        self.authenticator = CountingAuthenticator(
+            True,
+            "testuser@example.com",
+            "example.com",
+            claims={"exp": int(time.time()) + 600, "sub": "accounts.google.com:1"},
+        )
+        settings = override_settings(IAPAUTH_JWT_AUTHENTICATOR=self.authenticator)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def get(self, name="testview", token=TOKEN):
+        return self.client.get(reverse(name), **headers(token))
+
+    def test_same_assertion_is_verified_once(self):
+        self.get()
+        r = self.get("claims")
+        self.assertEqual(self.authenticator.calls, 1)
+        # the claims still reach the request
+        self.assertIn("sub: accounts.google.com:1", str(r.content))
+        r = self.get()
+        self.assertIn("current user: testuser", str(r.content))
+        self.assertEqual(self.authenticator.calls, 1)
+
+    def test_session_holds_a_digest_not_the_assertion(self):
+        self.get()
+        bound = self.client.session[SESSION_BINDING_KEY]
+        self.assertEqual(bound["digest"], session_digest(TOKEN, AUDIENCE))
+        self.assertNotIn(TOKEN, str(bound))
+        with self.settings(SECRET_KEY="another secret"):
+            self.assertNotEqual(bound["digest"], session_digest(TOKEN, AUDIENCE))
+
+    def test_new_assertion_is_verified_and_rebound(self):
+        self.get()
+        self.get(token="the next one")
+        self.assertEqual(self.authenticator.calls, 2)
+        bound = self.client.session[SESSION_BINDING_KEY]
+        self.assertEqual(bound["digest"], session_digest("the next one", AUDIENCE))
+        self.get(token="the next one")
+        self.assertEqual(self.authenticator.calls, 2)
+
+    def test_bad_assertion_still_logs_out(self):
+        self.get()
+        self.authenticator.response = (False, None, None)
+        r = self.get("protected", token="forged")
+        self.assertEqual(r.status_code, 302)
+        r = self.get()
+        self.assertIn("is_authenticated: False", str(r.content))
+
+    def test_expiring_assertion_is_verified(self):
+        # within IAPAUTH_TOKEN_CACHE_MARGIN of its exp
+        self.authenticator.claims = {"exp": int(time.time()) + 10}
+        self.get()
+        self.get()
+        self.assertEqual(self.authenticator.calls, 2)
+
+    def test_other_audience_is_verified(self):
+        self.get()
+        with self.settings(JWT_AUDIENCE="/projects/bar"):
+            self.get()
+        self.assertEqual(self.authenticator.calls, 2)
+
+    def test_only_for_the_logged_in_user(self):
+        self.get()
+        other = get_user_model().objects.create_user("other")
+        bound = self.client.session[SESSION_BINDING_KEY]
+        self.client.force_login(other)
+        # logging in someone else flushed the session; put the binding back
+        session = self.client.session
+        session[SESSION_BINDING_KEY] = bound
+        session.save()
+        r = self.get()
+        self.assertEqual(self.authenticator.calls, 2)
+        self.assertIn("current user: testuser", str(r.content))
+
+    @override_settings(IAPAUTH_SESSION_BINDING=False)
+    def test_off(self):
+        self.get()
+        self.get()
+        self.assertEqual(self.authenticator.calls, 2)
+        self.assertNotIn(SESSION_BINDING_KEY, self.client.session)
+
+    @override_settings(IAPAUTH_STATELESS=True)
+    def test_not_stateless(self):
+        self.get()
+        self.get()
+        self.assertEqual(self.authenticator.calls, 2)
+
+    async def test_async(self):
+        await self.async_client.get(reverse("testview"), **{HEADER: TOKEN})
+        r = await self.async_client.get(reverse("testview"), **{HEADER: TOKEN})
+        self.assertIn("current user: testuser", str(r.content))
+        self.assertEqual(self.authenticator.calls, 1)
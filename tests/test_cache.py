@@ -0,0 +1,104 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from iapauth import middleware
+from iapauth.cache import TTLCache, token_digest
+from iapauth.keys import KeyStore
+from iapauth.middleware import JWTAuthenticator
+
+from .utils import AUDIENCE, make_key, make_token
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTest(SimpleTestCase):
+    def test_get_and_set(self):
+        cache = TTLCache(4, clock=FakeClock())
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1, 2000)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = TTLCache(4, clock=clock)
+        cache.set("a", 1, 1010)
+        clock.now = 1010
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_already_expired_is_not_stored(self):
+        cache = TTLCache(4, clock=FakeClock())
+        cache.set("a", 1, 999)
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(2, clock=FakeClock())
+        cache.set("a", 1, 2000)
+        cache.set("b", 2, 2000)
+        # touch "a" so that "b" is the least recently used
+        cache.get("a")
+        cache.set("c", 3, 2000)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_digest_depends_on_audience(self):
+        self.assertNotEqual(token_digest("t", "/a"), token_digest("t", "/b"))
+
+
+class TokenCacheTest(SimpleTestCase):
+    def setUp(self):
+        private_pem, public_pem = make_key()
+        self.private_pem = private_pem
+        store = KeyStore(fetch=lambda: {"k1": public_pem})
+        self._keys = mock.patch.object(middleware, "KEY_STORE", store)
+        self._keys.start()
+        self._cache = mock.patch.object(middleware, "TOKEN_CACHE", None)
+        self._cache.start()
+
+    def tearDown(self):
+        self._cache.stop()
+        self._keys.stop()
+
+    def test_second_verification_is_a_cache_hit(self):
+        token = make_token(self.private_pem, "k1")
+        authenticator = JWTAuthenticator()
+        expected = (True, "testuser@example.com", "example.com")
+        self.assertEqual(authenticator.authenticate(token, AUDIENCE), expected)
+        with mock.patch.object(middleware.jwt, "decode") as decode:
+            self.assertEqual(authenticator.authenticate(token, AUDIENCE), expected)
+            decode.assert_not_called()
+        self.assertEqual(middleware.token_cache().hits, 1)
+
+    def test_cache_is_per_audience(self):
+        token = make_token(self.private_pem, "k1")
+        authenticator = JWTAuthenticator()
+        self.assertTrue(authenticator.authenticate(token, AUDIENCE)[0])
+        self.assertFalse(authenticator.authenticate(token, "/projects/other")[0])
+
+    def test_failures_are_not_cached(self):
+        authenticator = JWTAuthenticator()
+        self.assertFalse(authenticator.authenticate("not.a.jwt", AUDIENCE)[0])
+        self.assertEqual(len(middleware.token_cache()), 0)
+
+    def test_token_close_to_expiry_is_not_cached(self):
+        token = make_token(self.private_pem, "k1", lifetime=10)
+        self.assertTrue(JWTAuthenticator().authenticate(token, AUDIENCE)[0])
+        self.assertEqual(len(middleware.token_cache()), 0)
+
+    @override_settings(IAPAUTH_TOKEN_CACHE_SIZE=0)
+    def test_cache_can_be_disabled(self):
+        token = make_token(self.private_pem, "k1")
+        self.assertTrue(JWTAuthenticator().authenticate(token, AUDIENCE)[0])
+        self.assertIsNone(middleware.token_cache())
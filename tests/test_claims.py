@@ -0,0 +1,120 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from iapauth import middleware
+from iapauth.claims import IAPClaims
+from iapauth.keys import KeyStore
+from iapauth.middleware import (
+    ES256Authenticator,
+    JWTAuthenticator,
+    StubAuthenticator,
+)
+
+from .utils import AUDIENCE, make_key, make_token
+
+
+HEADERS = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+CLAIMS = {
+    "sub": "accounts.google.com:1234",
+    "exp": 1700000000,
+    "google": {"access_levels": ["corp"]},
+}
+
+
+class IAPClaimsTest(SimpleTestCase):
+    def test_attributes(self):
+        claims = IAPClaims(dict(CLAIMS, email="testuser@example.com"))
+        self.assertEqual(claims.email, "testuser@example.com")
+        self.assertIsNone(claims.hd)
+        self.assertEqual(claims.sub, "accounts.google.com:1234")
+        self.assertEqual(claims["google"], {"access_levels": ["corp"]})
+        self.assertIn("google", claims)
+        self.assertIsNone(claims.get("identity_source"))
+        with self.assertRaises(AttributeError):
+            claims.anything = 1
+
+
+class VerifyTest(SimpleTestCase):
+    def setUp(self):
+        private_pem, public_pem = make_key()
+        self.token = make_token(private_pem, "k1", access_levels=["corp"])
+        store = KeyStore(fetch=lambda: {"k1": public_pem})
+        for name, value in (("KEY_STORE", store), ("TOKEN_CACHE", None)):
+            patcher = mock.patch.object(middleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_verify(self):
+        for authenticator in (JWTAuthenticator(), ES256Authenticator()):
+            claims = authenticator.verify(self.token, AUDIENCE)
+            self.assertEqual(claims.email, "testuser@example.com")
+            self.assertEqual(claims.hd, "example.com")
+            self.assertEqual(claims.sub, "accounts.google.com:testuser@example.com")
+            self.assertEqual(claims.aud, AUDIENCE)
+            self.assertEqual(claims["access_levels"], ["corp"])
+            self.assertGreater(claims.exp, claims.iat)
+
+    def test_cached_claims_are_shared(self):
+        authenticator = JWTAuthenticator()
+        first = authenticator.verify(self.token, AUDIENCE)
+        self.assertIs(authenticator.verify(self.token, AUDIENCE), first)
+
+    def test_rejected(self):
+        self.assertIsNone(JWTAuthenticator().verify(self.token, "/projects/other"))
+        self.assertIsNone(JWTAuthenticator().verify("not.a.jwt", AUDIENCE))
+
+    def test_authenticate_still_returns_a_tuple(self):
+        result = JWTAuthenticator().authenticate(self.token, AUDIENCE)
+        self.assertEqual(result, (True, "testuser@example.com", "example.com"))
+
+
+class LegacyAuthenticator(object):
+    """one that only has `authenticate()`"""
+
+    def authenticate(self, jwt_token, audience):
+        return (True, "testuser@example.com", "example.com")
+
+
+@override_settings(
+    JWT_AUDIENCE="/projects/foo",
+    IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(
+        True, "testuser@example.com", "example.com", claims=CLAIMS
+    ),
+)
+class RequestClaimsTest(TestCase):
+    def test_claims_on_request(self):
+        r = self.client.get(reverse("claims"), **HEADERS)
+        self.assertContains(
+            r, "sub: accounts.google.com:1234 exp: 1700000000 level: ['corp']"
+        )
+
+    async def test_claims_on_async_request(self):
+        # the async test client takes raw ASGI header names
+        headers = {"x-goog-iap-jwt-assertion": "totally not a legit JWT"}
+        r = await self.async_client.get(reverse("claims"), **headers)
+        self.assertContains(r, "sub: accounts.google.com:1234")
+
+    def test_no_assertion(self):
+        self.assertContains(self.client.get(reverse("claims")), "claims: None")
+
+    @override_settings(IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(False, None, None))
+    def test_rejected(self):
+        r = self.client.get(reverse("claims"), **HEADERS)
+        self.assertContains(r, "claims: None")
+
+    @override_settings(IAPAUTH_LAZY=True)
+    def test_lazy(self):
+        r = self.client.get(reverse("claims"), **HEADERS)
+        self.assertContains(r, "sub: accounts.google.com:1234")
+
+    @override_settings(IAPAUTH_STATELESS=True)
+    def test_stateless(self):
+        r = self.client.get(reverse("claims"), **HEADERS)
+        self.assertContains(r, "sub: accounts.google.com:1234")
+
+    @override_settings(IAPAUTH_JWT_AUTHENTICATOR=LegacyAuthenticator())
+    def test_authenticator_without_verify(self):
+        r = self.client.get(reverse("claims"), **HEADERS)
+        self.assertContains(r, "sub: None exp: None level: None")
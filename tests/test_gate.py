@@ -0,0 +1,201 @@
+import os
+import subprocess
+import sys
+from unittest import mock
+from wsgiref.util import setup_testing_defaults
+
+from asgiref.sync import async_to_sync
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
+from django.test import SimpleTestCase, TestCase, override_settings
+
+import iapauth
+from iapauth import metrics, middleware
+from iapauth.claims import IAPClaims
+from iapauth.gate import ASGIGate, WSGIGate
+from iapauth.keys import KeyStore
+from iapauth.middleware import GATE_CLAIMS
+
+from .utils import AUDIENCE, CountingAuthenticator, make_key, make_token
+
+
+def environ(path="/", token=None):
+    env = {"PATH_INFO": path, "HTTP_HOST": "testserver"}
+    if token is not None:
+        env["HTTP_X_GOOG_IAP_JWT_ASSERTION"] = token
+    setup_testing_defaults(env)
+    return env
+
+
+def scope(path="/", token=None, kind="http"):
+    headers = []
+    if token is not None:
+        headers.append((b"x-goog-iap-jwt-assertion", token.encode("latin1")))
+    return {
+        "type": kind,
+        "path": path,
+        "root_path": "",
+        "headers": headers,
+        "method": "GET",
+        "query_string": b"",
+        "server": ("testserver", 80),
+    }
+
+
+class Inner(object):
+    """records what reached the wrapped application"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, environ, start_response):
+        self.calls.append(environ)
+        start_response("200 OK", [])
+        return [b"ok"]
+
+    async def asgi(self, scope, receive, send):
+        self.calls.append(scope)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+
+@override_settings(JWT_AUDIENCE=AUDIENCE, IAPAUTH_EXCLUDE_PATHS=["/healthz"])
+class GateTest(SimpleTestCase):
+    def setUp(self):
+        private_pem, public_pem = make_key()
+        self.token = make_token(private_pem, "k1")
+        self.store = KeyStore(fetch=mock.Mock(return_value={"k1": public_pem}))
+        for name, value in (("KEY_STORE", self.store), ("TOKEN_CACHE", None)):
+            patcher = mock.patch.object(middleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.inner = Inner()
+
+    def wsgi(self, env):
+        statuses = []
+        body = WSGIGate(self.inner)(env, lambda s, h: statuses.append((s, h)))
+        return statuses[0][0], b"".join(body)
+
+    def asgi(self, scope):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async_to_sync(ASGIGate(self.inner.asgi))(scope, receive, send)
+        return sent[0]["status"], sent[1]["body"]
+
+    def test_wsgi_no_token(self):
+        self.assertEqual(self.wsgi(environ())[0], "401 Unauthorized")
+        self.assertEqual(self.inner.calls, [])
+        self.assertEqual(self.store.fetch.call_count, 0)
+
+    def test_wsgi_rejected(self):
+        status, body = self.wsgi(environ(token="totally.not.legit"))
+        self.assertEqual(status, "403 Forbidden")
+        self.assertEqual(body, b"IAP assertion rejected\n")
+        self.assertEqual(self.inner.calls, [])
+
+    def test_wsgi_accepted(self):
+        self.assertEqual(self.wsgi(environ(token=self.token)), ("200 OK", b"ok"))
+        claims = self.inner.calls[0][GATE_CLAIMS]
+        self.assertIsInstance(claims, IAPClaims)
+        self.assertEqual(claims.email, "testuser@example.com")
+
+    def test_wsgi_excluded_path(self):
+        self.assertEqual(self.wsgi(environ("/healthz")), ("200 OK", b"ok"))
+        self.assertNotIn(GATE_CLAIMS, self.inner.calls[0])
+
+    def test_asgi(self):
+        self.assertEqual(self.asgi(scope())[0], 401)
+        self.assertEqual(self.asgi(scope(token="totally.not.legit"))[0], 403)
+        self.assertEqual(self.inner.calls, [])
+        self.assertEqual(self.asgi(scope(token=self.token)), (200, b"ok"))
+        self.assertEqual(self.inner.calls[0][GATE_CLAIMS].email, "testuser@example.com")
+
+    def test_asgi_passes_through(self):
+        self.assertEqual(self.asgi(scope("/healthz")), (200, b"ok"))
+        self.assertEqual(self.asgi(scope(kind="websocket")), (200, b"ok"))
+        self.assertNotIn(GATE_CLAIMS, self.inner.calls[0])
+        self.assertNotIn(GATE_CLAIMS, self.inner.calls[1])
+
+    def test_asgi_root_path(self):
+        request = dict(scope("/app/healthz"), root_path="/app")
+        self.assertEqual(self.asgi(request), (200, b"ok"))
+
+    @override_settings(IAPAUTH_METRICS=True)
+    def test_counted(self):
+        metrics.clear()
+        self.wsgi(environ())
+        self.wsgi(environ(token="totally.not.legit"))
+        self.assertEqual(metrics.COUNTERS.get("no_token"), 1)
+        self.assertEqual(metrics.COUNTERS.get("rejected"), 1)
+
+    def test_import_before_setup(self):
+        # as wsgi.py and asgi.py do, before get_wsgi_application()
+        env = dict(os.environ)
+        env.pop("DJANGO_SETTINGS_MODULE", None)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(iapauth.__file__))
+        subprocess.run(
+            [sys.executable, "-c", "from iapauth.gate import ASGIGate, WSGIGate"],
+            env=env,
+            check=True,
+        )
+
+
+@override_settings(JWT_AUDIENCE=AUDIENCE)
+class GatedMiddlewareTest(TestCase):
+    claims = IAPClaims({"email": "gated@example.com", "hd": "example.com"})
+    headers = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "verified by the gate"}
+
+    def setUp(self):
+        # as the test client does, so the handlers don't close the test
+        # transaction's connection
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        self.authenticator = CountingAuthenticator(email="gated@example.com")
+        settings = override_settings(IAPAUTH_JWT_AUTHENTICATOR=self.authenticator)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_uses_gate_claims(self):
+        extra = dict(self.headers, **{GATE_CLAIMS: self.claims})
+        response = self.client.get("/test", **extra)
+        self.assertContains(response, "current user: gated")
+        self.assertContains(response, "is_authenticated: True")
+        self.assertEqual(self.authenticator.calls, 0)
+
+    def test_ignores_anything_else(self):
+        self.client.get("/test", **self.headers, **{GATE_CLAIMS: "x"})
+        self.assertEqual(self.authenticator.calls, 1)
+
+    def test_through_wsgi(self):
+        statuses = []
+        body = WSGIGate(WSGIHandler())(
+            environ("/test", "a token"), lambda s, h: statuses.append(s)
+        )
+        self.assertEqual(statuses, ["200 OK"])
+        self.assertIn(b"current user: gated", b"".join(body))
+        # by the gate only
+        self.assertEqual(self.authenticator.calls, 1)
+
+    def test_through_asgi(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        gate = ASGIGate(ASGIHandler())
+        async_to_sync(gate)(scope("/test", "a token"), receive, send)
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertIn(b"current user: gated", sent[1]["body"])
+        self.assertEqual(self.authenticator.calls, 1)
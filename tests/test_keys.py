@@ -0,0 +1,316 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from iapauth import middleware
+from iapauth.keys import (
+    KeyFetchError,
+    KeySnapshot,
+    KeyStore,
+    parse_public_keys,
+)
+from iapauth.middleware import JWTAuthenticator
+
+from .server import StubServer
+from .utils import AUDIENCE, make_key, make_token
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class CountingFetch(object):
+    def __init__(self, *key_sets, delay=0):
+        self.key_sets = list(key_sets)
+        self.calls = 0
+        self.delay = delay
+
+    def __call__(self):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        result = self.key_sets[min(self.calls, len(self.key_sets)) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def run_now(target):
+    target()
+
+
+class ParseTest(SimpleTestCase):
+    def test_parse(self):
+        _, public_pem = make_key()
+        parsed = parse_public_keys({"k1": public_pem})
+        self.assertEqual(list(parsed), ["k1"])
+
+    def test_rejects_garbage(self):
+        with self.assertRaises(KeyFetchError):
+            parse_public_keys({"k1": "not a pem"})
+        with self.assertRaises(KeyFetchError):
+            parse_public_keys({})
+        with self.assertRaises(KeyFetchError):
+            parse_public_keys(["error"])
+
+
+class KeyStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.pems = [make_key()[1] for i in range(2)]
+
+    def test_lookup_by_kid(self):
+        fetch = CountingFetch({"a": self.pems[0], "b": self.pems[1]})
+        store = KeyStore(fetch=fetch)
+        self.assertIsNotNone(store.get("a"))
+        self.assertIsNotNone(store.get("b"))
+        self.assertIsNot(store.get("a"), store.get("b"))
+        self.assertEqual(fetch.calls, 1)
+
+    def test_unknown_kid_refetches_once(self):
+        clock = FakeClock()
+        fetch = CountingFetch({"a": self.pems[0]}, {"b": self.pems[1]})
+        store = KeyStore(fetch=fetch, clock=clock, refetch_interval=30)
+        store.get("a")
+        clock.now += 60
+        # rotated: "b" is new
+        self.assertIsNotNone(store.get("b"))
+        self.assertEqual(fetch.calls, 2)
+        # a made up kid right after that doesn't hit the network again
+        self.assertIsNone(store.get("nope"))
+        self.assertEqual(fetch.calls, 2)
+        clock.now += 60
+        self.assertIsNone(store.get("nope"))
+        self.assertEqual(fetch.calls, 3)
+
+    def test_stale_while_revalidate(self):
+        clock = FakeClock()
+        fetch = CountingFetch({"a": self.pems[0]}, {"b": self.pems[1]})
+        spawned = []
+        store = KeyStore(
+            fetch=fetch, clock=clock, ttl=100, spawn=lambda t: spawned.append(t)
+        )
+        old = store.get("a")
+        clock.now += 200
+        # stale keys are still served while the refresh is scheduled
+        self.assertIs(store.get("a"), old)
+        self.assertEqual(len(spawned), 1)
+        # and only one refresh gets scheduled
+        store.get("a")
+        self.assertEqual(len(spawned), 1)
+        spawned[0]()
+        self.assertIsNotNone(store.get("b"))
+        self.assertEqual(fetch.calls, 2)
+
+    def test_failed_refresh_keeps_old_keys(self):
+        clock = FakeClock()
+        fetch = CountingFetch({"a": self.pems[0]}, KeyFetchError("down"))
+        store = KeyStore(fetch=fetch, clock=clock, ttl=100, spawn=run_now)
+        store.get("a")
+        clock.now += 200
+        self.assertIsNotNone(store.get("a"))
+        self.assertEqual(store.fetch_errors, 1)
+        self.assertIsNotNone(store.get("a"))
+
+    def test_initial_failure_is_rate_limited(self):
+        clock = FakeClock()
+        fetch = CountingFetch(KeyFetchError("down"), {"a": self.pems[0]})
+        store = KeyStore(fetch=fetch, clock=clock, refetch_interval=30)
+        self.assertIsNone(store.get("a"))
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(fetch.calls, 1)
+        clock.now += 60
+        self.assertIsNotNone(store.get("a"))
+
+    def test_concurrent_unknown_kid_is_single_flight(self):
+        fetch = CountingFetch({"a": self.pems[0]}, delay=0.05)
+        store = KeyStore(fetch=fetch)
+        barrier = threading.Barrier(8)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(store.get("a"))
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(fetch.calls, 1)
+        self.assertTrue(all(r is not None for r in results))
+
+    def test_failures_back_off(self):
+        clock = FakeClock()
+        fetch = CountingFetch(KeyFetchError("down"))
+        store = KeyStore(fetch=fetch, clock=clock, refetch_interval=30, max_backoff=200)
+        delays = []
+        for i in range(6):
+            store.get("a")
+            delays.append(store.retry_delay())
+            # not before the delay is up
+            clock.now += store.retry_delay() - 1
+            store.get("a")
+            clock.now += 1
+        self.assertEqual(delays, [30, 60, 120, 200, 200, 200])
+        self.assertEqual(fetch.calls, 6)
+
+    def test_success_resets_backoff(self):
+        clock = FakeClock()
+        fetch = CountingFetch(
+            KeyFetchError("down"), KeyFetchError("down"), {"a": self.pems[0]}
+        )
+        store = KeyStore(fetch=fetch, clock=clock, refetch_interval=30)
+        store.get("a")
+        clock.now += 30
+        store.get("a")
+        self.assertEqual(store.retry_delay(), 60)
+        clock.now += 60
+        self.assertIsNotNone(store.get("a"))
+        self.assertEqual(store.failures, 0)
+        self.assertEqual(store.retry_delay(), 30)
+
+
+class SnapshotTest(SimpleTestCase):
+    def setUp(self):
+        self.pems = [make_key()[1] for i in range(2)]
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "keys.json")
+
+    def write(self, data):
+        with open(self.path, "w") as f:
+            f.write(data if isinstance(data, str) else json.dumps(data))
+
+    def test_save_and_load(self):
+        wall = FakeClock(5000.0)
+        snapshot = KeySnapshot(self.path, clock=wall)
+        snapshot.save({"a": self.pems[0]})
+        wall.now += 40
+        self.assertEqual(snapshot.load(), ({"a": self.pems[0]}, 40.0))
+        # replaced in place, with nothing left behind
+        snapshot.save({"b": self.pems[1]})
+        self.assertEqual(snapshot.load()[0], {"b": self.pems[1]})
+        self.assertEqual(os.listdir(self.dir), ["keys.json"])
+
+    def test_failed_save_leaves_old_snapshot(self):
+        snapshot = KeySnapshot(self.path)
+        snapshot.save({"a": self.pems[0]})
+        with mock.patch("iapauth.keys.os.replace", side_effect=OSError("full")):
+            with self.assertRaises(OSError):
+                snapshot.save({"b": self.pems[1]})
+        self.assertEqual(snapshot.load()[0], {"a": self.pems[0]})
+        self.assertEqual(os.listdir(self.dir), ["keys.json"])
+
+    def test_missing_or_corrupt(self):
+        snapshot = KeySnapshot(self.path)
+        self.assertIsNone(snapshot.load())
+        for data in ["{not json", {"keys": {}}, ["a"], {"fetched_at": "x"}]:
+            self.write(data)
+            self.assertIsNone(snapshot.load())
+
+    def test_store_starts_from_snapshot(self):
+        KeySnapshot(self.path).save({"a": self.pems[0]})
+        fetch = CountingFetch({"b": self.pems[1]})
+        spawned = []
+        store = KeyStore(
+            fetch=fetch,
+            ttl=100,
+            snapshot=KeySnapshot(self.path),
+            spawn=lambda t: spawned.append(t),
+        )
+        self.assertIsNotNone(store.get("a"))
+        self.assertEqual(fetch.calls, 0)
+        self.assertEqual(spawned, [])
+
+    def test_stale_snapshot_is_revalidated(self):
+        wall = FakeClock(5000.0)
+        KeySnapshot(self.path, clock=wall).save({"a": self.pems[0]})
+        wall.now += 500
+        fetch = CountingFetch({"b": self.pems[1]})
+        spawned = []
+        store = KeyStore(
+            fetch=fetch,
+            ttl=100,
+            snapshot=KeySnapshot(self.path, clock=wall),
+            spawn=lambda t: spawned.append(t),
+        )
+        # served while the refresh runs in the background
+        self.assertIsNotNone(store.get("a"))
+        self.assertEqual(len(spawned), 1)
+        spawned[0]()
+        self.assertIsNotNone(store.get("b"))
+        # and the fresh set is written back
+        self.assertEqual(KeySnapshot(self.path).load()[0], {"b": self.pems[1]})
+
+    def test_invalid_snapshot_is_ignored(self):
+        self.write({"fetched_at": time.time(), "keys": {"a": "not a pem"}})
+        fetch = CountingFetch({"b": self.pems[1]})
+        store = KeyStore(fetch=fetch, snapshot=KeySnapshot(self.path))
+        self.assertIsNone(store.raw)
+        self.assertIsNotNone(store.get("b"))
+        self.assertEqual(fetch.calls, 1)
+
+    def test_bad_fetch_doesnt_replace_snapshot(self):
+        KeySnapshot(self.path).save({"a": self.pems[0]})
+        clock = FakeClock()
+        fetch = CountingFetch({"a": "not a pem"})
+        store = KeyStore(
+            fetch=fetch,
+            clock=clock,
+            refetch_interval=0,
+            snapshot=KeySnapshot(self.path),
+        )
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.failures, 1)
+        self.assertIsNotNone(store.get("a"))
+        self.assertEqual(KeySnapshot(self.path).load()[0], {"a": self.pems[0]})
+
+    def test_unwritable_snapshot_still_serves(self):
+        path = os.path.join(self.dir, "missing", "keys.json")
+        fetch = CountingFetch({"a": self.pems[0]})
+        store = KeyStore(fetch=fetch, snapshot=KeySnapshot(path))
+        self.assertIsNotNone(store.get("a"))
+
+    def test_cold_start_offline(self):
+        with StubServer({"k1": self.pems[0]}) as server, override_settings(
+            IAPAUTH_PUBLIC_KEY_URL=server.key_url, IAPAUTH_KEY_SNAPSHOT=self.path
+        ):
+            self.assertIsNotNone(middleware.key_store().get("k1"))
+            self.assertEqual(server.key_hits(), 1)
+        # a new worker, with the key server gone
+        middleware._reset_key_store()
+        with override_settings(
+            IAPAUTH_PUBLIC_KEY_URL="http://127.0.0.1:9/nothing",
+            IAPAUTH_KEY_SNAPSHOT=self.path,
+        ):
+            self.assertIsNotNone(middleware.key_store().get("k1"))
+        middleware._reset_key_store()
+
+
+class RotationTest(SimpleTestCase):
+    def test_token_signed_with_new_key_after_rotation(self):
+        old_private, old_public = make_key()
+        new_private, new_public = make_key()
+        fetch = CountingFetch({"old": old_public}, {"new": new_public})
+        store = KeyStore(fetch=fetch, refetch_interval=0)
+        with mock.patch.object(middleware, "KEY_STORE", store), mock.patch.object(
+            middleware, "TOKEN_CACHE", None
+        ):
+            authenticator = JWTAuthenticator()
+            token = make_token(old_private, "old")
+            self.assertTrue(authenticator.authenticate(token, AUDIENCE)[0])
+            token = make_token(new_private, "new")
+            self.assertTrue(authenticator.authenticate(token, AUDIENCE)[0])
+            # a token claiming a kid but signed with another key still fails
+            token = make_token(old_private, "new")
+            self.assertFalse(authenticator.authenticate(token, AUDIENCE)[0])
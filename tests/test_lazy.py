@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.handlers.wsgi import WSGIRequest
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from iapauth.middleware import IAPJWTAuthMiddleware
+
+from .utils import CountingAuthenticator
+
+
+HEADERS = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+
+
+@override_settings(JWT_AUDIENCE="/projects/foo", IAPAUTH_LAZY=True)
+class LazyTest(TestCase):
+    def setUp(self):
+        self.authenticator = CountingAuthenticator(
+            True, "testuser@example.com", "example.com"
+        )
+        settings = override_settings(IAPAUTH_JWT_AUTHENTICATOR=self.authenticator)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def reject(self):
+        self.authenticator.response = (False, None, None)
+
+    def request(self):
+        request = RequestFactory().get("/", **HEADERS)
+        SessionMiddleware(lambda r: None).process_request(request)
+        AuthenticationMiddleware(lambda r: None).process_request(request)
+        IAPJWTAuthMiddleware(lambda r: None).process_request(request)
+        return request
+
+    def test_not_verified_unless_used(self):
+        r = self.client.get(reverse("plain"), **HEADERS)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.authenticator.calls, 0)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, r.cookies)
+
+    def test_login_on_access(self):
+        r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertEqual(self.authenticator.calls, 1)
+        # logged in to the session as usual
+        r = self.client.get(reverse("testview"))
+        self.assertTrue("current user: testuser" in str(r.content))
+
+    def test_attributes_verify_once(self):
+        request = self.request()
+        self.assertEqual(self.authenticator.calls, 0)
+        self.assertEqual(request.jwt_user_email, "testuser@example.com")
+        self.assertEqual(request.jwt_domain, "example.com")
+        self.assertTrue(request.jwt_authenticated)
+        self.assertEqual(request.user.get_username(), "testuser")
+        self.assertEqual(self.authenticator.calls, 1)
+        # the real values are back on the request
+        self.assertIs(request.jwt_authenticated, True)
+
+    def test_rejected_attributes(self):
+        self.reject()
+        request = self.request()
+        self.assertFalse(request.jwt_authenticated)
+        self.assertIsNone(request.jwt_user_email)
+        self.assertFalse(request.user.is_authenticated)
+
+    def test_bad_token_logs_out(self):
+        self.client.get(reverse("testview"), **HEADERS)
+        self.reject()
+        r = self.client.get(reverse("protected"), **HEADERS)
+        self.assertEqual(r.status_code, 302)
+        r = self.client.get(reverse("testview"))
+        self.assertTrue("is_authenticated: False" in str(r.content))
+
+    def test_bad_token_logs_out_when_only_session_is_used(self):
+        self.client.get(reverse("testview"), **HEADERS)
+        self.reject()
+        self.client.get(reverse("session"), **HEADERS)
+        self.assertEqual(self.authenticator.calls, 2)
+        r = self.client.get(reverse("testview"))
+        self.assertTrue("is_authenticated: False" in str(r.content))
+
+    @override_settings(IAPAUTH_STATELESS=True)
+    def test_stateless(self):
+        r = self.client.get(reverse("plain"), **HEADERS)
+        self.assertEqual(self.authenticator.calls, 0)
+        r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, r.cookies)
+
+    async def test_async(self):
+        header = {"x-goog-iap-jwt-assertion": "not legit"}
+        r = await self.async_client.get(reverse("plain"), **header)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.authenticator.calls, 0)
+        r = await self.async_client.get(reverse("testview"), **header)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertEqual(self.authenticator.calls, 1)
+
+    @override_settings(IAPAUTH_STATELESS=True)
+    async def test_auser(self):
+        request = RequestFactory().get("/", **HEADERS)
+        await IAPJWTAuthMiddleware(lambda r: None).aprocess_request(request)
+        self.assertEqual(self.authenticator.calls, 0)
+        user = await request.auser()
+        self.assertEqual(user.get_username(), "testuser")
+        self.assertEqual(self.authenticator.calls, 1)
+
+    def test_rejected_values_are_real(self):
+        self.reject()
+        request = self.request()
+        self.assertIs(request.iap_claims, None)
+        self.assertIs(request.jwt_user_email, None)
+        self.assertIs(request.jwt_domain, None)
+        self.assertIs(request.jwt_authenticated, False)
+        self.assertEqual(self.authenticator.calls, 1)
+
+    def test_valid_values_are_real(self):
+        request = self.request()
+        self.assertIsNotNone(request.iap_claims)
+        self.assertEqual(request.iap_claims.email, "testuser@example.com")
+        self.assertIs(request.jwt_authenticated, True)
+        self.assertEqual(self.authenticator.calls, 1)
+        # still the request it was, apart from its class
+        self.assertIsInstance(request, WSGIRequest)
+        with self.assertRaises(AttributeError):
+            request.no_such_attribute
@@ -0,0 +1,131 @@
+import logging
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from iapauth import log, middleware
+from iapauth.keys import KeyStore
+from iapauth.log import RejectionLog
+from iapauth.middleware import JWTAuthenticator
+
+from .test_keys import FakeClock
+from .utils import AUDIENCE, make_key, make_token
+
+
+class RejectionLogTest(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.log = RejectionLog(rate=1, burst=2, interval=60, clock=self.clock)
+
+    def messages(self, logs):
+        return [record.getMessage() for record in logs.records]
+
+    def test_burst_then_rate(self):
+        with self.assertLogs("iapauth.rejections") as logs:
+            for i in range(5):
+                self.log.record("invalid", "Signature has expired.")
+            self.clock.now += 1
+            self.log.record("invalid", "Signature has expired.")
+            # other reasons have their own bucket
+            self.log.record("malformed")
+        self.assertEqual(
+            self.messages(logs),
+            ["rejected IAP assertion: invalid: Signature has expired."] * 3
+            + ["rejected IAP assertion: malformed"],
+        )
+
+    def test_summary(self):
+        with self.assertLogs("iapauth.rejections") as logs:
+            for i in range(6):
+                self.log.record("invalid", "Signature has expired.")
+            for i in range(3):
+                self.log.record("unknown_kid")
+            self.clock.now += 61
+            self.log.record("too_long")
+        summary = logs.records[-1]
+        self.assertEqual(
+            summary.getMessage(),
+            "5 rejected IAP assertions not logged in the last 61s:"
+            " invalid: Signature has expired. (x4); unknown_kid (x1)",
+        )
+        self.assertEqual(
+            summary.iapauth_suppressed,
+            {"invalid: Signature has expired.": 4, "unknown_kid": 1},
+        )
+        # and then nothing until more is held back
+        self.clock.now += 61
+        with mock.patch.object(self.log, "_emit") as emit:
+            self.log.flush()
+        emit.assert_not_called()
+
+    def test_flush(self):
+        with self.assertLogs("iapauth.rejections") as logs:
+            for i in range(4):
+                self.log.record("malformed")
+            self.log.flush()
+        self.assertEqual(logs.records[-1].iapauth_suppressed, {"malformed": 2})
+
+    def test_distinct_reasons_are_bounded(self):
+        with mock.patch.object(log, "MAX_REASONS", 2), self.assertLogs(
+            "iapauth.rejections"
+        ) as logs:
+            for reason in ("a", "b", "c", "d"):
+                for i in range(3):
+                    self.log.record(reason)
+            self.log.flush()
+        self.assertEqual(
+            logs.records[-1].iapauth_suppressed, {"a": 1, "b": 1, "other": 2}
+        )
+
+    def test_disabled(self):
+        logger = logging.getLogger("iapauth.rejections")
+        with mock.patch.object(logger, "isEnabledFor", return_value=False):
+            self.log.record("malformed")
+        self.assertEqual(self.log._buckets, {})
+
+
+class Recorder(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.done = threading.Event()
+
+    def emit(self, record):
+        self.records.append((record.getMessage(), threading.current_thread()))
+        self.done.set()
+
+
+class QueueTest(SimpleTestCase):
+    def test_records_are_handled_off_thread(self):
+        recorder = Recorder()
+        parent = logging.getLogger("iapauth")
+        parent.addHandler(recorder)
+        self.addCleanup(parent.removeHandler, recorder)
+        with override_settings(IAPAUTH_LOG_QUEUE=True):
+            self.assertIsNotNone(log.LISTENER)
+            RejectionLog().record("malformed")
+            self.assertTrue(recorder.done.wait(5))
+        self.assertIsNone(log.LISTENER)
+        self.assertFalse(log.logger.handlers)
+        [(message, thread)] = recorder.records
+        self.assertEqual(message, "rejected IAP assertion: malformed")
+        self.assertIsNot(thread, threading.current_thread())
+
+
+class MiddlewareLogTest(SimpleTestCase):
+    def test_bad_signature_is_logged_not_printed(self):
+        private_pem, public_pem = make_key()
+        token = make_token(make_key()[0], "k1")
+        store = KeyStore(fetch=lambda: {"k1": public_pem})
+        with mock.patch.object(middleware, "KEY_STORE", store), mock.patch.object(
+            log, "REJECTION_LOG", None
+        ), mock.patch("builtins.print") as printed, self.assertLogs(
+            "iapauth.rejections"
+        ) as logs:
+            self.assertIsNone(JWTAuthenticator().verify(token, AUDIENCE))
+        printed.assert_not_called()
+        self.assertEqual(
+            logs.records[0].getMessage(),
+            "rejected IAP assertion: invalid: Signature verification failed.",
+        )
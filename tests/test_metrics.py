@@ -0,0 +1,183 @@
+import json
+import os
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from iapauth import metrics, middleware
+from iapauth.keys import KeyStore
+from iapauth.metrics import Histogram
+from iapauth.middleware import StubAuthenticator
+
+from .server import StubServer
+from .utils import make_key
+
+
+HEADERS = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+
+
+class HistogramTest(SimpleTestCase):
+    def test_buckets(self):
+        h = Histogram((0.001, 0.01))
+        for value in (0.0005, 0.001, 0.005, 5):
+            h.observe(value)
+        data = h.snapshot()
+        self.assertEqual(data["counts"], [2, 1, 1])
+        self.assertAlmostEqual(data["sum"], 5.0065)
+        self.assertEqual(h.count, 4)
+        self.assertEqual(metrics.quantile(data, 0.5), 0.001)
+        self.assertEqual(metrics.quantile(data, 0.75), 0.01)
+        self.assertEqual(metrics.quantile(data, 0.99), float("inf"))
+
+    def test_empty(self):
+        self.assertIsNone(metrics.quantile(Histogram().snapshot(), 0.5))
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+
+    def counters(self):
+        return metrics.snapshot()["counters"]
+
+    def counts(self, phase):
+        return sum(metrics.snapshot()["histograms"][phase]["counts"])
+
+
+class DisabledTest(MetricsTestCase):
+    def test_off_by_default(self):
+        metrics.incr("no_token")
+        self.assertIs(metrics.timer("verify"), metrics.NULL_TIMER)
+        self.client.get(reverse("testview"))
+        self.assertEqual(self.counters()["no_token"], 0)
+
+
+@override_settings(
+    IAPAUTH_METRICS=True,
+    JWT_AUDIENCE="/projects/foo",
+    IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(
+        True, "testuser@example.com", "example.com"
+    ),
+)
+class MiddlewareMetricsTest(MetricsTestCase):
+    def test_login(self):
+        self.client.get(reverse("testview"))
+        self.client.get(reverse("testview"), **HEADERS)
+        self.client.get(reverse("testview"), **HEADERS)
+        counters = self.counters()
+        self.assertEqual(counters["no_token"], 1)
+        self.assertEqual(counters["authenticated"], 2)
+        self.assertEqual(counters["already_authenticated"], 1)
+        self.assertEqual(self.counts("verify"), 2)
+        self.assertEqual(self.counts("resolve_user"), 1)
+        self.assertEqual(self.counts("login"), 1)
+
+    def test_rejected_and_switch(self):
+        self.client.get(reverse("testview"), **HEADERS)
+        with override_settings(
+            IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(
+                True, "other@example.com", "example.com"
+            )
+        ):
+            self.client.get(reverse("testview"), **HEADERS)
+        with override_settings(
+            IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(False, None, None)
+        ):
+            self.client.get(reverse("testview"), **HEADERS)
+        counters = self.counters()
+        self.assertEqual(counters["user_switch"], 1)
+        self.assertEqual(counters["rejected"], 1)
+        self.assertEqual(self.counts("login"), 2)
+
+    async def test_async(self):
+        await self.async_client.get(
+            reverse("testview"), **{"x-goog-iap-jwt-assertion": "not legit"}
+        )
+        self.assertEqual(self.counters()["authenticated"], 1)
+        self.assertEqual(self.counts("verify"), 1)
+        self.assertEqual(self.counts("login"), 1)
+
+    def test_key_fetch(self):
+        _, public_pem = make_key()
+        KeyStore(fetch=lambda: {"k1": public_pem}).get("k1")
+        self.assertEqual(self.counters()["key_fetch"], 1)
+        self.assertEqual(self.counts("key_fetch"), 1)
+
+    def test_audience_fetch(self):
+        with StubServer({}, project_number=42) as server, mock.patch.object(
+            middleware, "AUDIENCE", None
+        ), mock.patch.dict(
+            os.environ, {"GOOGLE_CLOUD_PROJECT": "proj"}
+        ), override_settings(
+            IAPAUTH_METADATA_URL=server.url
+        ):
+            middleware.gcp_jwt_audience()
+        self.assertEqual(self.counters()["audience_fetch"], 1)
+
+
+@override_settings(IAPAUTH_METRICS=True)
+class ExpositionTest(MetricsTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.incr("no_token", 3)
+        with mock.patch("iapauth.metrics.time.perf_counter", side_effect=[1.0, 1.003]):
+            with metrics.timer("verify"):
+                pass
+
+    def test_prometheus(self):
+        text = metrics.prometheus()
+        self.assertIn('iapauth_events_total{event="no_token"} 3\n', text)
+        self.assertIn(
+            'iapauth_phase_seconds_bucket{phase="verify",le="0.0025"} 0\n', text
+        )
+        self.assertIn(
+            'iapauth_phase_seconds_bucket{phase="verify",le="0.005"} 1\n', text
+        )
+        self.assertIn(
+            'iapauth_phase_seconds_bucket{phase="verify",le="+Inf"} 1\n', text
+        )
+        self.assertIn('iapauth_phase_seconds_count{phase="verify"} 1\n', text)
+        self.assertIn('iapauth_phase_seconds_count{phase="login"} 0\n', text)
+
+    def test_view(self):
+        with override_settings(IAPAUTH_EXCLUDE_PATHS=["/metrics"]):
+            r = self.client.get(reverse("metrics"))
+            self.assertTrue(r["Content-Type"].startswith("text/plain; version=0.0.4"))
+            self.assertIn(b'iapauth_events_total{event="no_token"} 3', r.content)
+            r = self.client.get(reverse("metrics"), {"format": "json"})
+            self.assertEqual(r.json()["counters"]["no_token"], 3)
+
+    def test_command(self):
+        out = StringIO()
+        call_command("iapauth_metrics", stdout=out)
+        self.assertIn("no_token", out.getvalue())
+        self.assertIn("verify", out.getvalue())
+        out = StringIO()
+        call_command("iapauth_metrics", "--format", "json", stdout=out)
+        self.assertEqual(json.loads(out.getvalue())["counters"]["no_token"], 3)
+        out = StringIO()
+        call_command("iapauth_metrics", "--format", "prometheus", stdout=out)
+        self.assertEqual(out.getvalue(), metrics.prometheus())
+
+    def test_command_url(self):
+        data = metrics.snapshot()
+        metrics.clear()
+        out = StringIO()
+        with mock.patch(
+            "iapauth.management.commands.iapauth_metrics.get_json",
+            return_value=data,
+        ) as get_json:
+            call_command(
+                "iapauth_metrics",
+                "--format",
+                "json",
+                "--url",
+                "http://app/metrics",
+                stdout=out,
+            )
+        get_json.assert_called_once_with("http://app/metrics?format=json")
+        self.assertEqual(json.loads(out.getvalue())["counters"]["no_token"], 3)
@@ -161,3 +161,17 @@ class MiddlewareTest(TestCase):
         # should not be staff or superuser
         self.assertTrue("is_staff: False" in str(r.content))
         self.assertTrue("is_superuser: False" in str(r.content))
+
+    @override_settings(
+        JWT_AUDIENCE="/projects/foo",
+        IAP_JWT_ADMIN_DOMAIN="example.com",
+        IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(True, "evil@example.com", None),
+    )
+    def test_missing_hd_with_admin_domain(self):
+        """a personal Google account can have an address on the admin
+        domain, but its assertion has no `hd`"""
+        headers = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+        r = self.client.get(reverse("testview"), **headers)
+        self.assertTrue("current user: evil" in str(r.content))
+        self.assertTrue("is_staff: False" in str(r.content))
+        self.assertTrue("is_superuser: False" in str(r.content))
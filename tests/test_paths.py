@@ -0,0 +1,124 @@
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from iapauth.paths import PathMatcher
+
+from .utils import CountingAuthenticator
+
+
+HEADERS = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+
+
+class PathMatcherTest(SimpleTestCase):
+    def test_empty(self):
+        matcher = PathMatcher()
+        self.assertFalse(matcher)
+        self.assertFalse(matcher.match("/"))
+
+    def test_prefixes(self):
+        matcher = PathMatcher(["/static/", "/healthz", "/st"])
+        self.assertTrue(matcher)
+        self.assertTrue(matcher.match("/static/app.css"))
+        self.assertTrue(matcher.match("/healthz"))
+        self.assertTrue(matcher.match("/healthz/ready"))
+        self.assertTrue(matcher.match("/stats"))
+        self.assertFalse(matcher.match("/health"))
+        self.assertFalse(matcher.match("/"))
+        self.assertFalse(matcher.match(""))
+
+    def test_empty_prefix_matches_everything(self):
+        self.assertTrue(PathMatcher([""]).match("/anything"))
+
+    def test_regexes(self):
+        matcher = PathMatcher([r"^/api/v\d+/ping$", re.compile(r"^/media/.*\.png$")])
+        self.assertTrue(matcher.match("/api/v2/ping"))
+        self.assertFalse(matcher.match("/api/v2/ping/x"))
+        self.assertTrue(matcher.match("/media/a/b.png"))
+        self.assertFalse(matcher.match("/media/a/b.jpg"))
+
+    def test_compiled_flags_are_kept(self):
+        matcher = PathMatcher([re.compile(r"^/metrics", re.IGNORECASE), r"^/x$"])
+        self.assertTrue(matcher.match("/METRICS"))
+        self.assertFalse(matcher.match("/X"))
+
+    def test_prefixes_and_regexes(self):
+        matcher = PathMatcher(["/static/", r"^/readyz$"])
+        self.assertTrue(matcher.match("/static/x"))
+        self.assertTrue(matcher.match("/readyz"))
+        self.assertFalse(matcher.match("/readyz/x"))
+
+    def test_regexes_sharing_literal_text(self):
+        matcher = PathMatcher(
+            [r"^/api/v\d+/ping$", r"^/api/status$", r"^/apix?$", r"^/(a|b)/x$"]
+        )
+        self.assertTrue(matcher.match("/api/v1/ping"))
+        self.assertTrue(matcher.match("/api/status"))
+        self.assertTrue(matcher.match("/api"))
+        self.assertTrue(matcher.match("/apix"))
+        self.assertTrue(matcher.match("/b/x"))
+        self.assertFalse(matcher.match("/api/v1/pong"))
+        self.assertFalse(matcher.match("/c/x"))
+
+    def test_regex_under_a_prefix(self):
+        matcher = PathMatcher(["/static/", r"^/static/admin/.*\.js$"])
+        self.assertTrue(matcher.match("/static/x"))
+        matcher = PathMatcher(["/api/v1/", r"^/api/v\d+$"])
+        self.assertTrue(matcher.match("/api/v2"))
+        self.assertTrue(matcher.match("/api/v1/x"))
+        self.assertTrue(matcher.match("/api/v1"))
+        self.assertFalse(matcher.match("/api/vx"))
+
+    def test_bad_regex(self):
+        with self.assertRaises(ImproperlyConfigured):
+            PathMatcher(["^/(unclosed"])
+
+
+@override_settings(JWT_AUDIENCE="/projects/foo")
+class PathFilterTest(TestCase):
+    def setUp(self):
+        self.authenticator = CountingAuthenticator(
+            True, "testuser@example.com", "example.com"
+        )
+        settings = override_settings(IAPAUTH_JWT_AUTHENTICATOR=self.authenticator)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    @override_settings(IAPAUTH_EXCLUDE_PATHS=["/plain", r"^/api/.*$"])
+    def test_exclude(self):
+        r = self.client.get(reverse("api-testview"), **HEADERS)
+        self.assertTrue("is_authenticated: False" in str(r.content))
+        self.client.get(reverse("plain"), **HEADERS)
+        self.assertEqual(self.authenticator.calls, 0)
+        r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertEqual(self.authenticator.calls, 1)
+
+    @override_settings(IAPAUTH_INCLUDE_PATHS=["/api/"])
+    def test_include(self):
+        r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("is_authenticated: False" in str(r.content))
+        self.assertEqual(self.authenticator.calls, 0)
+        r = self.client.get(reverse("api-testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+
+    @override_settings(
+        IAPAUTH_INCLUDE_PATHS=["/api/"], IAPAUTH_EXCLUDE_PATHS=[r"^/api/test$"]
+    )
+    def test_exclude_wins(self):
+        self.client.get(reverse("api-testview"), **HEADERS)
+        self.assertEqual(self.authenticator.calls, 0)
+
+    @override_settings(IAPAUTH_STATELESS_PATHS=[r"^/api/"])
+    def test_stateless_regex(self):
+        r = self.client.get(reverse("api-testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertFalse(r.cookies)
+
+    @override_settings(IAPAUTH_EXCLUDE_PATHS=["/plain"])
+    async def test_exclude_async(self):
+        header = {"x-goog-iap-jwt-assertion": "not legit"}
+        await self.async_client.get(reverse("plain"), **header)
+        self.assertEqual(self.authenticator.calls, 0)
@@ -0,0 +1,205 @@
+import re
+
+from django.contrib.auth.models import Group, User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from iapauth import policy
+from iapauth.backends import IAPJWTUserBackend
+from iapauth.policy import Policy, Role
+
+from .test_backends import jwt_request, writes
+
+
+class PolicyTest(SimpleTestCase):
+    def test_no_rules(self):
+        rules = Policy()
+        self.assertFalse(rules)
+        self.assertIsNone(rules.decide("alice@example.com", "example.com"))
+
+    def test_domain(self):
+        rules = Policy([{"domain": "Example.com", "is_staff": True}])
+        self.assertEqual(rules.decide("alice@example.com", "example.com"), Role(True))
+        self.assertIsNone(rules.decide("alice@example.org", "example.org"))
+        # without an hd (a personal account), the email's domain counts
+        # for nothing
+        self.assertIsNone(rules.decide("bob@example.com"))
+        self.assertIsNone(rules.decide("bob@example.com", None))
+
+    def test_email(self):
+        rules = Policy([{"email": "alice@example.com", "is_superuser": True}])
+        self.assertEqual(rules.decide("Alice@example.com"), Role(is_superuser=True))
+        self.assertIsNone(rules.decide("bob@example.com"))
+
+    def test_patterns(self):
+        rules = Policy(
+            [
+                {"pattern": r"ops-.*@example\.com", "groups": ["ops"]},
+                {"pattern": re.compile(r".*@eng\.example\.com"), "groups": ["eng"]},
+                {"pattern": r".*@(eng\.)?example\.com", "groups": ["everyone"]},
+            ]
+        )
+        self.assertEqual(rules.decide("ops-alice@example.com").groups, {"ops"})
+        self.assertEqual(rules.decide("bob@eng.example.com").groups, {"eng"})
+        self.assertEqual(rules.decide("carol@example.com").groups, {"everyone"})
+        # the whole email has to match
+        self.assertIsNone(rules.decide("carol@example.com.evil.org"))
+
+    def test_first_pattern_wins(self):
+        rules = Policy(
+            [
+                {"pattern": r".*@example\.com", "groups": ["everyone"]},
+                {"pattern": r"ops-.*", "groups": ["ops"]},
+            ]
+        )
+        self.assertEqual(rules.decide("ops-alice@example.com").groups, {"everyone"})
+        self.assertEqual(rules.decide("ops-alice@example.org").groups, {"ops"})
+
+    def test_most_specific_wins(self):
+        rules = Policy(
+            [
+                {"email": "alice@example.com", "is_staff": False},
+                {"domain": "example.com", "is_staff": True, "groups": ["staff"]},
+                {"pattern": r"a.*", "is_superuser": True},
+            ]
+        )
+        self.assertEqual(
+            rules.decide("alice@example.com", "example.com"),
+            Role(False, True, ["staff"]),
+        )
+        self.assertEqual(
+            rules.decide("adam@example.com", "example.com"),
+            Role(True, True, ["staff"]),
+        )
+        self.assertEqual(
+            rules.decide("bob@example.com", "example.com"),
+            Role(True, None, ["staff"]),
+        )
+
+    def test_same_domain_merged(self):
+        rules = Policy(
+            [
+                {"domain": "example.com", "is_staff": True, "is_superuser": True},
+                {"domain": "example.com", "is_superuser": False},
+            ]
+        )
+        self.assertEqual(
+            rules.decide("alice@example.com", "example.com"), Role(True, False)
+        )
+
+    def test_managed_groups(self):
+        rules = Policy(
+            [
+                {"domain": "example.com", "groups": ["staff"]},
+                {"email": "alice@example.com", "groups": ["ops", "staff"]},
+            ]
+        )
+        self.assertEqual(rules.managed_groups, {"ops", "staff"})
+
+    def test_memoized(self):
+        rules = Policy([{"domain": "example.com", "is_staff": True}])
+        for _ in range(3):
+            rules.decide("alice@example.com", "example.com")
+        self.assertEqual(rules.decide.cache_info().hits, 2)
+
+    def test_bad_rules(self):
+        for rule in (
+            {"is_staff": True},
+            {"domain": "example.com", "email": "alice@example.com"},
+            {"domain": "example.com", "is_admin": True},
+            {"domain": "example.com", "groups": "ops"},
+            {"pattern": "(unclosed"},
+        ):
+            with self.assertRaises(ImproperlyConfigured):
+                Policy([rule])
+
+    @override_settings(
+        IAP_JWT_ADMIN_DOMAIN="example.com",
+        IAPAUTH_ROLE_POLICY=[{"email": "guest@example.com", "is_superuser": False}],
+    )
+    def test_admin_domain_is_a_rule(self):
+        rules = policy.policy()
+        self.assertEqual(
+            rules.decide("alice@example.com", "example.com"), Role(True, True)
+        )
+        self.assertEqual(
+            rules.decide("guest@example.com", "example.com"), Role(True, False)
+        )
+        self.assertIsNone(rules.decide("alice@example.com"))
+
+
+USER_TABLE = '"auth_user"'
+POLICY = [
+    {"domain": "example.com", "is_staff": True, "groups": ["staff"]},
+    {"email": "root@example.com", "is_superuser": True, "groups": ["staff", "ops"]},
+    {"email": "intern@example.com", "is_staff": False},
+]
+
+
+@override_settings(IAPAUTH_ROLE_POLICY=POLICY)
+class BackendPolicyTest(TestCase):
+    def authenticate(self, email):
+        username = email.split("@")[0]
+        request = jwt_request(email, email.split("@")[1])
+        return IAPJWTUserBackend().authenticate(request, username)
+
+    def groups(self, username):
+        user = User.objects.get(username=username)
+        return set(user.groups.values_list("name", flat=True))
+
+    def test_new_user(self):
+        user = self.authenticate("root@example.com")
+        user.refresh_from_db()
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.is_superuser)
+        self.assertEqual(self.groups("root"), {"staff", "ops"})
+
+    def test_new_user_flags_in_the_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.authenticate("intern@example.com")
+        self.assertEqual(writes(queries, USER_TABLE), ["INSERT"])
+        self.assertFalse(User.objects.get(username="intern").is_staff)
+
+    def test_promoted_on_login(self):
+        User.objects.create(username="alice")
+        with CaptureQueriesContext(connection) as queries:
+            user = self.authenticate("alice@example.com")
+        self.assertTrue(user.is_staff)
+        self.assertEqual(writes(queries, USER_TABLE), ["UPDATE"])
+        self.assertTrue(User.objects.get(username="alice").is_staff)
+        self.assertEqual(self.groups("alice"), {"staff"})
+
+    def test_nothing_written_when_unchanged(self):
+        self.authenticate("alice@example.com")
+        with CaptureQueriesContext(connection) as queries:
+            self.authenticate("alice@example.com")
+        self.assertEqual(writes(queries), [])
+
+    def test_demoted_on_login(self):
+        User.objects.create(username="intern", is_staff=True)
+        self.authenticate("intern@example.com")
+        self.assertFalse(User.objects.get(username="intern").is_staff)
+
+    def test_groups_follow_the_policy(self):
+        user = User.objects.create(username="root")
+        other = Group.objects.create(name="other")
+        user.groups.add(other)
+        self.authenticate("root@example.com")
+        self.assertEqual(self.groups("root"), {"staff", "ops", "other"})
+        moved = POLICY[:1] + [{"email": "x@example.com", "groups": ["ops"]}]
+        with override_settings(IAPAUTH_ROLE_POLICY=moved):
+            self.authenticate("root@example.com")
+        # ops is still managed but no longer granted; other never was
+        self.assertEqual(self.groups("root"), {"staff", "other"})
+        # superuser isn't mentioned any more, so it's left alone
+        self.assertTrue(User.objects.get(username="root").is_superuser)
+
+    @override_settings(IAPAUTH_ROLE_POLICY=(), IAP_JWT_ADMIN_DOMAIN="example.com")
+    def test_admin_domain_applies_on_login(self):
+        User.objects.create(username="alice")
+        self.authenticate("alice@example.com")
+        user = User.objects.get(username="alice")
+        self.assertTrue(user.is_staff)
+        self.assertTrue(user.is_superuser)
@@ -0,0 +1,97 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from iapauth import middleware
+from iapauth.keys import KeyStore
+from iapauth.middleware import REJECTIONS, JWTAuthenticator
+from iapauth.verify import inspect_token
+
+from .utils import AUDIENCE, make_key, make_token, sign
+
+
+class InspectTokenTest(SimpleTestCase):
+    def test_reasons(self):
+        private_pem, _ = make_key()
+        self.assertEqual(inspect_token("abc")[0], "malformed")
+        self.assertEqual(inspect_token("a.b.c.d")[0], "malformed")
+        self.assertEqual(inspect_token("!!!.b.c")[0], "malformed")
+        # header is a json list
+        self.assertEqual(inspect_token("W10.b.c")[0], "malformed")
+        hs256 = sign("secret", {"a": 1}, {"kid": "k1"}, algorithm="HS256")
+        self.assertEqual(inspect_token(hs256)[0], "bad_alg")
+        self.assertEqual(inspect_token(sign(private_pem, {"a": 1}))[0], "no_kid")
+        self.assertEqual(inspect_token(make_token(private_pem, "k1")), (None, "k1"))
+
+
+class PreFilterTest(SimpleTestCase):
+    def setUp(self):
+        self.private_pem, public_pem = make_key()
+        self.store = KeyStore(fetch=lambda: {"k1": public_pem}, refetch_interval=3600)
+        for name, value in [
+            ("KEY_STORE", self.store),
+            ("TOKEN_CACHE", None),
+            ("NEGATIVE_CACHE", None),
+        ]:
+            patcher = mock.patch.object(middleware, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        REJECTIONS.clear()
+        self.decode = mock.patch.object(
+            JWTAuthenticator,
+            "decode",
+            side_effect=JWTAuthenticator.decode,
+            autospec=True,
+        )
+
+    def test_junk_is_rejected_without_verification(self):
+        with self.decode as decode:
+            for token in ["junk", "a.b.c", "x" * 10000]:
+                self.assertFalse(JWTAuthenticator().authenticate(token, AUDIENCE)[0])
+            decode.assert_not_called()
+        self.assertEqual(REJECTIONS.get("malformed"), 2)
+        self.assertEqual(REJECTIONS.get("too_long"), 1)
+
+    @override_settings(IAPAUTH_MAX_TOKEN_LENGTH=100)
+    def test_max_length_setting(self):
+        token = make_token(self.private_pem, "k1")
+        self.assertFalse(JWTAuthenticator().authenticate(token, AUDIENCE)[0])
+        self.assertEqual(REJECTIONS.get("too_long"), 1)
+
+    def test_unknown_kid_is_rejected_without_verification(self):
+        token = make_token(self.private_pem, "nope")
+        with self.decode as decode:
+            self.assertFalse(JWTAuthenticator().authenticate(token, AUDIENCE)[0])
+            decode.assert_not_called()
+        self.assertEqual(REJECTIONS.get("unknown_kid"), 1)
+        # the kid might show up after a rotation, so this isn't remembered
+        self.assertEqual(len(middleware.negative_cache()), 0)
+
+    def test_bad_signature_is_remembered(self):
+        other_private_pem, _ = make_key()
+        token = make_token(other_private_pem, "k1")
+        authenticator = JWTAuthenticator()
+        with self.decode as decode:
+            self.assertFalse(authenticator.authenticate(token, AUDIENCE)[0])
+            self.assertFalse(authenticator.authenticate(token, AUDIENCE)[0])
+            self.assertEqual(decode.call_count, 1)
+        self.assertEqual(REJECTIONS.get("invalid"), 1)
+        self.assertEqual(REJECTIONS.get("recently_rejected"), 1)
+        # the same token for another audience is a different cache entry
+        with self.decode as decode:
+            authenticator.authenticate(token, "/projects/other")
+            self.assertEqual(decode.call_count, 1)
+
+    @override_settings(IAPAUTH_NEGATIVE_CACHE_SIZE=0)
+    def test_negative_cache_can_be_disabled(self):
+        other_private_pem, _ = make_key()
+        token = make_token(other_private_pem, "k1")
+        with self.decode as decode:
+            JWTAuthenticator().authenticate(token, AUDIENCE)
+            JWTAuthenticator().authenticate(token, AUDIENCE)
+            self.assertEqual(decode.call_count, 2)
+
+    def test_valid_token_still_accepted(self):
+        token = make_token(self.private_pem, "k1")
+        self.assertTrue(JWTAuthenticator().authenticate(token, AUDIENCE)[0])
+        self.assertEqual(REJECTIONS.snapshot(), {})
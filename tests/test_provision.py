@@ -0,0 +1,160 @@
+import io
+import os
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from iapauth.backends import IAPJWTUserBackend, provision_users
+from iapauth.middleware import IAPJWTAuthMiddleware
+
+
+def provision(text, **kwargs):
+    return list(provision_users(io.StringIO(text), **kwargs))[-1]
+
+
+class ProvisionTest(TestCase):
+    def test_creates_users(self):
+        totals = provision("alice@example.com\nbob@example.org\n")
+        self.assertEqual(totals["created"], 2)
+        alice = User.objects.get(username="alice")
+        self.assertEqual(alice.email, "alice@example.com")
+        self.assertFalse(alice.has_usable_password())
+        self.assertFalse(alice.is_staff)
+        self.assertTrue(User.objects.filter(username="bob").exists())
+
+    @override_settings(IAP_JWT_ADMIN_DOMAIN="example.com")
+    def test_admin_domain(self):
+        User.objects.create(username="carol", email="carol@example.com")
+        provision(
+            "alice@example.com\nbob@example.org\ncarol@example.com\n",
+            domain_from_email=True,
+        )
+        for username in ("alice", "carol"):
+            user = User.objects.get(username=username)
+            self.assertTrue(user.is_staff)
+            self.assertTrue(user.is_superuser)
+        self.assertFalse(User.objects.get(username="bob").is_staff)
+
+    @override_settings(IAP_JWT_ADMIN_DOMAIN="example.com")
+    def test_no_domain_by_default(self):
+        # a personal account can have any address
+        provision("alice@example.com\n")
+        self.assertFalse(User.objects.get(username="alice").is_superuser)
+
+    def test_existing_users(self):
+        User.objects.create(username="alice", email="old@example.com")
+        User.objects.create(username="bob", email="bob@example.com", is_staff=True)
+        User.objects.create_user(username="carol", password="secret")
+        totals = provision("alice@example.com\nbob@example.com\ncarol@example.com\n")
+        self.assertEqual(
+            (totals["created"], totals["updated"], totals["unchanged"]), (0, 2, 1)
+        )
+        self.assertEqual(User.objects.get(username="alice").email, "alice@example.com")
+        # never demoted
+        self.assertTrue(User.objects.get(username="bob").is_staff)
+        # and their password is left alone
+        self.assertTrue(User.objects.get(username="carol").check_password("secret"))
+
+    def test_skips(self):
+        totals = provision(
+            "# comment\n\n  alice@example.com  \nnot an email\nalice@example.org\n"
+        )
+        self.assertEqual(totals["read"], 3)
+        self.assertEqual(totals["skipped"], 2)
+        self.assertEqual(totals["created"], 1)
+        self.assertEqual(User.objects.get(username="alice").email, "alice@example.org")
+
+    def test_queries_per_batch(self):
+        emails = "".join("user{}@example.com\n".format(i) for i in range(10))
+        with CaptureQueriesContext(connection) as queries:
+            totals = provision(emails, batch_size=5)
+        self.assertEqual(totals["created"], 10)
+        inserts = [q for q in queries if q["sql"].startswith("INSERT")]
+        selects = [q for q in queries if q["sql"].startswith("SELECT")]
+        self.assertEqual((len(inserts), len(selects)), (2, 2))
+
+    def test_reads_lazily(self):
+        read = []
+
+        def lines():
+            for i in range(10):
+                read.append(i)
+                yield "user{}@example.com".format(i)
+
+        batches = provision_users(lines(), batch_size=3)
+        self.assertEqual(next(batches)["created"], 3)
+        self.assertEqual(len(read), 3)
+        self.assertEqual(len(list(batches)), 3)
+
+    def test_created_concurrently(self):
+        class RacingBackend(IAPJWTUserBackend):
+            def prepare_user(self, request, user):
+                super().prepare_user(request, user)
+                if not User.objects.filter(username="alice").exists():
+                    User.objects.create(username="alice")
+
+        totals = provision("alice@example.com\n", backend=RacingBackend())
+        self.assertEqual(totals["updated"], 1)
+        self.assertEqual(User.objects.get(username="alice").email, "alice@example.com")
+
+    def test_clean_username_hook(self):
+        class Middleware(IAPJWTAuthMiddleware):
+            def clean_username(self, username, request):
+                return username.replace("@", ".")
+
+        middleware = Middleware(lambda request: None)
+        provision("alice@example.com\n", middleware=middleware)
+        self.assertTrue(User.objects.filter(username="alice.example.com").exists())
+
+
+class ProvisionCommandTest(TestCase):
+    def test_file(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, "w") as f:
+            f.write("alice@example.com\nbob@example.com\ncarol@example.com\n")
+        out = io.StringIO()
+        call_command("iapauth_provision", path, "--batch-size", "2", stdout=out)
+        progress = out.getvalue().splitlines()
+        self.assertEqual(len(progress), 2)
+        self.assertTrue(progress[-1].startswith("3 read, 3 created"))
+        self.assertEqual(User.objects.count(), 3)
+
+    def test_stdin(self):
+        out = io.StringIO()
+        with mock.patch("sys.stdin", io.StringIO("alice@example.com\n")):
+            call_command("iapauth_provision", stdout=out, verbosity=0)
+        self.assertEqual(out.getvalue(), "")
+        self.assertTrue(User.objects.filter(username="alice").exists())
+
+    @override_settings(IAP_JWT_ADMIN_DOMAIN="example.com")
+    def test_domain_from_email(self):
+        with mock.patch("sys.stdin", io.StringIO("alice@example.com\n")):
+            call_command("iapauth_provision", "--domain-from-email", verbosity=0)
+        self.assertTrue(User.objects.get(username="alice").is_superuser)
+
+    def test_bad_batch_size(self):
+        with self.assertRaises(CommandError):
+            call_command("iapauth_provision", "--batch-size", "0")
+
+
+@override_settings(
+    IAPAUTH_ROLE_POLICY=[
+        {"domain": "example.com", "is_staff": True},
+        {"email": "bob@example.com", "is_staff": False},
+    ]
+)
+class ProvisionPolicyTest(TestCase):
+    def test_flags_follow_the_policy(self):
+        User.objects.create(username="bob", email="bob@example.com", is_staff=True)
+        totals = provision(
+            "alice@example.com\nbob@example.com\n", domain_from_email=True
+        )
+        self.assertEqual((totals["created"], totals["updated"]), (1, 1))
+        self.assertTrue(User.objects.get(username="alice").is_staff)
+        self.assertFalse(User.objects.get(username="bob").is_staff)
@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from iapauth import middleware
+from iapauth.keys import KeyStore, fetch_public_keys, parse_public_keys
+from iapauth.shared import SharedFetcher, cache_key
+
+from .server import StubServer
+from .utils import make_key
+
+
+class SharedCacheTests(object):
+    """run against each cache backend by the subclasses below"""
+
+    # whether the backend's `add` is atomic, so that the fetch lock is
+    # exclusive even between threads racing for it
+    atomic_add = True
+
+    def setUp(self):
+        super().setUp()
+        caches["shared"].clear()
+        self.pems = [make_key()[1] for i in range(2)]
+        self.server = StubServer({"k1": self.pems[0]}, project_number=42)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def fetcher(self, **kwargs):
+        url = self.server.key_url
+        return SharedFetcher(
+            "shared",
+            cache_key("keys", url),
+            lambda: fetch_public_keys(url),
+            3600,
+            validate=parse_public_keys,
+            **kwargs
+        )
+
+    def worker(self, **kwargs):
+        return KeyStore(fetch=self.fetcher(**kwargs), refetch_interval=0)
+
+    def test_workers_share_one_fetch(self):
+        workers = [self.worker() for i in range(5)]
+        for w in workers:
+            self.assertIsNotNone(w.get("k1"))
+        self.assertEqual(self.server.key_hits(), 1)
+
+    def test_concurrent_workers_fetch_once(self):
+        self.server.delay = 0.1
+        workers = [self.worker() for i in range(6)]
+        barrier = threading.Barrier(len(workers))
+        results = []
+
+        def run(w):
+            barrier.wait()
+            results.append(w.get("k1"))
+
+        threads = [threading.Thread(target=run, args=(w,)) for w in workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(all(r is not None for r in results))
+        if self.atomic_add:
+            self.assertEqual(self.server.key_hits(), 1)
+
+    def test_rotation(self):
+        a, b = self.worker(), self.worker()
+        a.get("k1")
+        b.get("k1")
+        self.server.keys = {"k2": self.pems[1]}
+        # the first worker to see the new kid goes upstream...
+        self.assertIsNotNone(a.get("k2"))
+        self.assertEqual(self.server.key_hits(), 2)
+        # ...and the rest pick the new set up from the shared cache
+        self.assertIsNotNone(b.get("k2"))
+        self.assertEqual(self.server.key_hits(), 2)
+
+    def test_bad_payload_is_not_shared(self):
+        self.server.keys = {"k1": "not a key"}
+        self.assertIsNone(self.worker().get("k1"))
+        self.assertIsNone(caches["shared"].get(self.fetcher().key))
+
+    def test_broken_cache_falls_back_to_upstream(self):
+        with mock.patch.object(caches["shared"], "get", side_effect=OSError("down")):
+            with self.assertLogs("iapauth.shared", "WARNING"):
+                self.assertIsNotNone(self.worker().get("k1"))
+        self.assertEqual(self.server.key_hits(), 1)
+
+    def test_middleware_uses_shared_cache(self):
+        patchers = [
+            mock.patch.object(middleware, "KEY_STORE", None),
+            mock.patch.object(middleware, "AUDIENCE", None),
+            mock.patch.dict(os.environ, {"GOOGLE_CLOUD_PROJECT": "proj"}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        settings = override_settings(
+            IAPAUTH_SHARED_CACHE="shared",
+            IAPAUTH_PUBLIC_KEY_URL=self.server.key_url,
+            IAPAUTH_METADATA_URL=self.server.url,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.assertEqual(middleware.gcp_jwt_audience(), "/projects/42/apps/proj")
+        self.assertIsNotNone(middleware.key_store().get("k1"))
+        # a new worker starts with nothing
+        middleware.AUDIENCE = None
+        middleware.KEY_STORE = None
+        self.assertEqual(middleware.gcp_jwt_audience(), "/projects/42/apps/proj")
+        self.assertIsNotNone(middleware.key_store().get("k1"))
+        self.assertEqual(self.server.metadata_hits(), 1)
+        self.assertEqual(self.server.key_hits(), 1)
+
+
+@override_settings(
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "shared": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "iapauth-tests",
+        },
+    }
+)
+class LocMemSharedCacheTest(SharedCacheTests, SimpleTestCase):
+    pass
+
+
+class FileBasedSharedCacheTest(SharedCacheTests, SimpleTestCase):
+    # FileBasedCache.add is a has_key() followed by a set()
+    atomic_add = False
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = override_settings(
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+                "shared": {
+                    "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                    "LOCATION": directory,
+                },
+            }
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        super().setUp()
@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from iapauth import backends
+from iapauth.middleware import StubAuthenticator
+
+
+HEADERS = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+STUB = StubAuthenticator(True, "testuser@example.com", "example.com")
+REJECT = StubAuthenticator(False, None, None)
+
+
+@override_settings(JWT_AUDIENCE="/projects/foo", IAPAUTH_JWT_AUTHENTICATOR=STUB)
+class StatelessTest(TestCase):
+    def assertNoSession(self, r, queries=()):
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, r.cookies)
+        self.assertFalse(Session.objects.exists())
+        self.assertFalse(any("django_session" in q["sql"] for q in queries))
+
+    @override_settings(IAPAUTH_STATELESS=True)
+    def test_stateless(self):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertTrue("is_authenticated: True" in str(r.content))
+        self.assertNoSession(r, queries)
+
+    @override_settings(IAPAUTH_STATELESS=True)
+    def test_protected_view(self):
+        r = self.client.get(reverse("protected"), **HEADERS)
+        self.assertEqual(r.status_code, 200)
+        self.assertNoSession(r)
+
+    @override_settings(IAPAUTH_STATELESS=True, IAPAUTH_JWT_AUTHENTICATOR=REJECT)
+    def test_bad_token(self):
+        r = self.client.get(reverse("protected"), **HEADERS)
+        self.assertEqual(r.status_code, 302)
+        r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("is_authenticated: False" in str(r.content))
+        self.assertNoSession(r)
+
+    @override_settings(IAPAUTH_STATELESS_PATHS=["/api/"])
+    def test_path_prefix(self):
+        r = self.client.get(reverse("api-testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertNoSession(r)
+        r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertIn(settings.SESSION_COOKIE_NAME, r.cookies)
+
+    @override_settings(IAPAUTH_STATELESS_PATHS=["/api/"])
+    def test_bad_token_leaves_session_alone(self):
+        self.client.get(reverse("testview"), **HEADERS)
+        with override_settings(IAPAUTH_JWT_AUTHENTICATOR=REJECT):
+            r = self.client.get(reverse("api-testview"), **HEADERS)
+        self.assertTrue("is_authenticated: False" in str(r.content))
+        # the browser session on the rest of the site is still there
+        r = self.client.get(reverse("testview"))
+        self.assertTrue("current user: testuser" in str(r.content))
+
+    @override_settings(
+        IAPAUTH_STATELESS=True,
+        MIDDLEWARE=["iapauth.middleware.IAPJWTAuthMiddleware"],
+    )
+    def test_no_session_middleware_needed(self):
+        r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+
+    @override_settings(
+        IAPAUTH_STATELESS=True,
+        IAPAUTH_EXCLUDE_PATHS=["/api/"],
+        MIDDLEWARE=["iapauth.middleware.IAPJWTAuthMiddleware"],
+    )
+    def test_anonymous_without_session_middleware(self):
+        r = self.client.get(reverse("testview"))
+        self.assertTrue("is_authenticated: False" in str(r.content))
+        r = self.client.get(reverse("api-testview"), **HEADERS)
+        self.assertTrue("is_authenticated: False" in str(r.content))
+
+    @override_settings(
+        IAPAUTH_STATELESS=True,
+        MIDDLEWARE=["iapauth.middleware.IAPJWTAuthMiddleware"],
+    )
+    async def test_async_anonymous_without_session_middleware(self):
+        r = await self.async_client.get(reverse("testview"))
+        self.assertTrue("is_authenticated: False" in str(r.content))
+
+    @override_settings(IAPAUTH_STATELESS=True, IAPAUTH_USER_CACHE_SIZE=16)
+    def test_no_queries_with_user_cache(self):
+        self.addCleanup(backends._reset_user_cache)
+        self.client.get(reverse("testview"), **HEADERS)
+        with self.assertNumQueries(0):
+            r = self.client.get(reverse("testview"), **HEADERS)
+        self.assertTrue("current user: testuser" in str(r.content))
+
+    @override_settings(IAPAUTH_STATELESS=True)
+    async def test_async(self):
+        r = await self.async_client.get(
+            reverse("testview"), **{"x-goog-iap-jwt-assertion": "not legit"}
+        )
+        self.assertTrue("current user: testuser" in str(r.content))
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, r.cookies)
@@ -0,0 +1,165 @@
+import functools
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from iapauth import tracing
+from iapauth.middleware import StubAuthenticator
+
+
+class FakeBeeline(object):
+    """records what would have been sent to Honeycomb"""
+
+    def __init__(self):
+        self.spans = []
+        self.contexts = []
+        self.fields = []
+
+    def traced(self, name):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                self.spans.append(name)
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def add_context(self, data):
+        self.contexts.append(dict(data))
+
+    def add_context_field(self, name, value):
+        self.fields.append((name, value))
+
+
+class TracingTestCase(SimpleTestCase):
+    def setUp(self):
+        self.beeline = FakeBeeline()
+        patcher = mock.patch.object(tracing, "beeline", self.beeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(tracing.reset_rate)
+
+    def sample_rate(self, n):
+        settings = override_settings(IAPAUTH_TRACE_SAMPLE_RATE=n)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def traced_function(self):
+        @tracing.traced("work")
+        def work():
+            tracing.add_field("worked", True)
+            return 42
+
+        return work
+
+
+class DisabledTest(TracingTestCase):
+    def test_no_wrapper(self):
+        self.sample_rate(0)
+
+        def work():
+            pass
+
+        self.assertIs(tracing.traced("work")(work), work)
+
+    def test_nothing_sent(self):
+        self.sample_rate(0)
+        self.assertIs(tracing.request(), tracing.NULL_REQUEST)
+        with tracing.request():
+            tracing.add_field("a", 1)
+            tracing.fail()
+        self.assertEqual(self.beeline.contexts, [])
+        self.assertEqual(self.beeline.fields, [])
+
+
+class FullTest(TracingTestCase):
+    def test_fields_sent_at_once(self):
+        self.sample_rate(1)
+        work = self.traced_function()
+        with tracing.request():
+            tracing.add_field("a", 1)
+            self.assertEqual(work(), 42)
+            self.assertEqual(self.beeline.contexts, [])
+        self.assertEqual(self.beeline.contexts, [{"a": 1, "worked": True}])
+        self.assertEqual(self.beeline.spans, ["work"])
+
+    def test_outside_a_request(self):
+        self.sample_rate(1)
+        self.traced_function()()
+        self.assertEqual(self.beeline.spans, ["work"])
+        self.assertEqual(self.beeline.fields, [("worked", True)])
+
+
+class SampledTest(TracingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sample_rate(10)
+
+    def test_picked(self):
+        work = self.traced_function()
+        with mock.patch("iapauth.tracing.random.random", return_value=0.05):
+            with tracing.request():
+                work()
+        self.assertEqual(self.beeline.spans, ["work"])
+        self.assertEqual(self.beeline.contexts, [{"worked": True}])
+
+    def test_not_picked(self):
+        work = self.traced_function()
+        with mock.patch("iapauth.tracing.random.random", return_value=0.5):
+            with tracing.request():
+                self.assertEqual(work(), 42)
+        self.assertEqual(self.beeline.spans, [])
+        self.assertEqual(self.beeline.contexts, [])
+
+    def test_failures_always_sent(self):
+        with mock.patch("iapauth.tracing.random.random", return_value=0.5):
+            with tracing.request():
+                tracing.add_field("iapauth.rejected", "malformed")
+                tracing.fail()
+        self.assertEqual(self.beeline.contexts, [{"iapauth.rejected": "malformed"}])
+
+    def test_exceptions_always_sent(self):
+        with mock.patch("iapauth.tracing.random.random", return_value=0.5):
+            with self.assertRaises(ValueError):
+                with tracing.request():
+                    tracing.add_field("a", 1)
+                    raise ValueError("boom")
+        self.assertEqual(
+            self.beeline.contexts, [{"a": 1, "iapauth.error": "ValueError('boom')"}]
+        )
+
+
+@override_settings(JWT_AUDIENCE="/projects/foo", IAPAUTH_TRACE_SAMPLE_RATE=1)
+class MiddlewareTracingTest(TestCase):
+    def setUp(self):
+        self.beeline = FakeBeeline()
+        patcher = mock.patch.object(tracing, "beeline", self.beeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(tracing.reset_rate)
+
+    @override_settings(
+        IAPAUTH_JWT_AUTHENTICATOR=StubAuthenticator(
+            True, "testuser@example.com", "example.com"
+        )
+    )
+    def test_one_call_per_request(self):
+        headers = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+        self.client.get(reverse("testview"), **headers)
+        self.assertEqual(len(self.beeline.contexts), 1)
+        fields = self.beeline.contexts[0]
+        self.assertEqual(fields["iapauth.authenticated"], True)
+        self.assertEqual(fields["iapauth.username"], "testuser")
+        self.assertEqual(fields["iapauth.already_authenticated"], False)
+
+    @override_settings(IAPAUTH_TRACE_SAMPLE_RATE=1000)
+    def test_rejection_sent_when_not_sampled(self):
+        headers = {"HTTP_X_GOOG_IAP_JWT_ASSERTION": "totally not a legit JWT"}
+        with mock.patch("iapauth.tracing.random.random", return_value=0.5):
+            self.client.get(reverse("testview"), **headers)
+            self.client.get(reverse("testview"))
+        self.assertEqual(len(self.beeline.contexts), 1)
+        self.assertEqual(self.beeline.contexts[0]["iapauth.rejected"], "malformed")
@@ -0,0 +1,143 @@
+import os
+import threading
+from unittest import mock
+
+from django.apps import apps
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from iapauth import conf, fetch, middleware
+from iapauth.fetch import FetchError, get_json
+
+from .server import StubServer
+from .utils import make_key
+
+
+class ConfTest(SimpleTestCase):
+    def test_default(self):
+        self.assertEqual(conf.get("IAPAUTH_KEY_TTL"), 3600)
+
+    def test_resolved_once(self):
+        conf.get("IAPAUTH_KEY_TTL")
+        with mock.patch.object(
+            type(settings), "__getattr__", side_effect=AssertionError
+        ):
+            conf.get("IAPAUTH_KEY_TTL")
+
+    def test_override_settings(self):
+        self.assertIsNone(conf.get("JWT_AUDIENCE"))
+        with override_settings(JWT_AUDIENCE="/projects/foo"):
+            self.assertEqual(conf.get("JWT_AUDIENCE"), "/projects/foo")
+        self.assertIsNone(conf.get("JWT_AUDIENCE"))
+
+    def test_changes_reset_dependent_state(self):
+        with mock.patch.object(middleware, "TOKEN_CACHE", None):
+            middleware.token_cache()
+            with override_settings(IAPAUTH_TOKEN_CACHE_SIZE=0):
+                self.assertIsNone(middleware.token_cache())
+
+
+class WarmUpTest(SimpleTestCase):
+    def setUp(self):
+        _, public_pem = make_key()
+        self.server = StubServer({"k1": public_pem}, project_number=42)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        for name in ("KEY_STORE", "AUDIENCE"):
+            patcher = mock.patch.object(middleware, name, None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(os.environ, {"GOOGLE_CLOUD_PROJECT": "proj"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings = override_settings(
+            IAPAUTH_PUBLIC_KEY_URL=self.server.key_url,
+            IAPAUTH_METADATA_URL=self.server.url,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_warm_up(self):
+        middleware.warm_up()
+        self.assertEqual(middleware.AUDIENCE, "/projects/42/apps/proj")
+        self.assertEqual(list(middleware.keys()), ["k1"])
+        middleware.warm_up()
+        self.assertEqual(self.server.key_hits(), 1)
+        self.assertEqual(self.server.metadata_hits(), 1)
+
+    def test_warm_up_failure_is_not_fatal(self):
+        with override_settings(IAPAUTH_METADATA_URL="http://127.0.0.1:1"):
+            with self.assertLogs("iapauth.middleware", "WARNING"):
+                middleware.warm_up()
+        self.assertIsNone(middleware.AUDIENCE)
+
+    @override_settings(IAPAUTH_WARM_UP=True)
+    def test_app_ready(self):
+        threads = []
+        start_warm_up = middleware.start_warm_up
+
+        def start():
+            threads.append(start_warm_up())
+
+        with mock.patch.object(middleware, "start_warm_up", start):
+            apps.get_app_config("iapauth").ready()
+        self.assertEqual(len(threads), 1)
+        threads[0].join()
+        self.assertEqual(self.server.metadata_hits(), 1)
+        self.assertEqual(self.server.key_hits(), 1)
+
+    def test_app_ready_without_warm_up(self):
+        apps.get_app_config("iapauth").ready()
+        self.assertEqual(self.server.key_hits(), 0)
+
+    @override_settings(IAPAUTH_WARM_UP=True)
+    def test_not_in_management_commands(self):
+        with mock.patch.object(middleware, "start_warm_up") as start:
+            with mock.patch("sys.argv", ["manage.py", "iapauth_audit", "log"]):
+                apps.get_app_config("iapauth").ready()
+            start.assert_not_called()
+            # and not in forked children, e.g. iapauth_audit's workers
+            middleware._after_fork()
+            start.assert_not_called()
+
+    def test_serves_requests(self):
+        for argv, serves in (
+            (["/srv/app/manage.py", "runserver"], True),
+            (["/srv/app/manage.py", "migrate"], False),
+            (["/usr/bin/django-admin", "iapauth_audit"], False),
+            (["/lib/python3/site-packages/django/__main__.py", "shell"], False),
+            (["/usr/bin/gunicorn", "app.wsgi"], True),
+            (["/lib/python3/site-packages/gunicorn/__main__.py"], True),
+            ([], True),
+        ):
+            self.assertIs(middleware.serves_requests(argv), serves, argv)
+
+    def test_concurrent_first_audience_is_single_flight(self):
+        self.server.delay = 0.05
+        barrier = threading.Barrier(8)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(middleware.gcp_jwt_audience())
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.server.metadata_hits(), 1)
+        self.assertEqual(set(results), {"/projects/42/apps/proj"})
+
+    def test_fetch_timeout(self):
+        self.server.delay = 1
+        with self.assertRaises(FetchError):
+            get_json(self.server.key_url, timeout=0.05)
+
+    def test_session_is_shared(self):
+        get_json(self.server.key_url)
+        session = fetch.session()
+        get_json(self.server.key_url)
+        self.assertIs(fetch.session(), session)
+        fetch._reset_after_fork()
+        self.assertIsNot(fetch.session(), session)
@@ -1,9 +1,16 @@
 from django.urls import path
 
+import iapauth.views
+
 from . import views
 
 
 urlpatterns = [
     path("test", views.testview, name="testview"),
     path("protected", views.protected, name="protected"),
+    path("api/test", views.testview, name="api-testview"),
+    path("plain", views.plain, name="plain"),
+    path("session", views.session, name="session"),
+    path("claims", views.claims, name="claims"),
+    path("metrics", iapauth.views.metrics, name="metrics"),
 ]
@@ -0,0 +1,79 @@
+"""
+helpers for building real IAP-style assertions in tests.
+
+keys are generated locally, so nothing here needs the network.
+"""
+import time
+from typing import Tuple
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from jose import jws, jwt  # type: ignore
+
+from iapauth.middleware import StubAuthenticator
+
+
+AUDIENCE = "/projects/1234/apps/test-project"
+ISSUER = "https://cloud.google.com/iap"
+
+
+def make_key() -> Tuple[str, str]:
+    """returns a (private, public) pair of PEM encoded P-256 keys"""
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("ascii")
+    public_pem = (
+        private_key.public_key()
+        .public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        .decode("ascii")
+    )
+    return private_pem, public_pem
+
+
+def make_token(
+    private_pem: str,
+    kid: str,
+    email: str = "testuser@example.com",
+    hd: str = "example.com",
+    audience: str = AUDIENCE,
+    lifetime: int = 600,
+    **claims
+) -> str:
+    now = int(time.time())
+    payload = {
+        "aud": audience,
+        "email": email,
+        "exp": now + lifetime,
+        "iat": now,
+        "iss": ISSUER,
+        "sub": "accounts.google.com:{}".format(email),
+    }
+    if hd is not None:
+        payload["hd"] = hd
+    payload.update(claims)
+    return jwt.encode(payload, private_pem, algorithm="ES256", headers={"kid": kid})
+
+
+def sign(private_pem: str, payload, headers=None, algorithm: str = "ES256") -> str:
+    """sign an arbitrary payload, for building tokens IAP would never send"""
+    return jws.sign(payload, private_pem, headers=headers, algorithm=algorithm)
+
+
+class CountingAuthenticator(StubAuthenticator):
+    """a StubAuthenticator that counts how often it is asked"""
+
+    calls = 0
+
+    def authenticate(self, jwt_token, audience):
+        self.calls += 1
+        return super().authenticate(jwt_token, audience)
+
+    async def aauthenticate(self, jwt_token, audience):
+        self.calls += 1
+        return await super().aauthenticate(jwt_token, audience)
@@ -31,3 +31,22 @@ def protected(request):
         request.user.is_superuser,
     )
     return HttpResponse(output)
+
+
+def plain(request):
+    return HttpResponse("ok")
+
+
+def session(request):
+    return HttpResponse("visits: {}".format(request.session.get("visits", 0)))
+
+
+def claims(request):
+    claims = request.iap_claims
+    if claims is None:
+        return HttpResponse("claims: None")
+    return HttpResponse(
+        "sub: {} exp: {} level: {}".format(
+            claims.sub, claims.exp, claims.get("google", {}).get("access_levels")
+        )
+    )